@@ -3,17 +3,36 @@ import json
 import uuid
 import time
 import base64
+import copy
 import sys
 import inspect
 import secrets
+import hashlib
+import itertools
+import math
+import multiprocessing
+import queue
+import random
+import re
+import signal
+import socket
+import threading
+import tempfile
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from loguru import logger
 from pathlib import Path
 from dotenv import load_dotenv
 
 import requests
-from flask import Flask, request, Response, jsonify, stream_with_context, render_template, redirect, session
+from flask import Flask, request, Response, jsonify, stream_with_context, render_template, redirect, session, send_file
 from curl_cffi import requests as curl_requests
+from curl_cffi import CurlOpt
 from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.serving import make_server
+from werkzeug.wsgi import ClosingIterator
+from image_worker import downscale_image
 
 # 加载 .env 文件
 load_dotenv()
@@ -84,7 +103,7 @@ class Logger:
         self.logger.bind(**caller_info).info(f"请求: {request.method} {request.path}", "Request")
 
 logger = Logger(level="INFO")
-DATA_DIR = Path("/data")
+DATA_DIR = Path(os.environ.get("DATA_DIR", "/data"))
 
 if not DATA_DIR.exists():
     DATA_DIR.mkdir(parents=True, exist_ok=True)
@@ -105,13 +124,18 @@ CONFIG = {
     "API": {
         "IS_TEMP_CONVERSATION": os.environ.get("IS_TEMP_CONVERSATION", "true").lower() == "true",
         "IS_CUSTOM_SSO": os.environ.get("IS_CUSTOM_SSO", "false").lower() == "true",
-        "BASE_URL": "https://grok.com",
+        "BASE_URL": os.environ.get("BASE_URL", "https://grok.com"),
+        "ASSETS_URL": os.environ.get("ASSETS_URL", "https://assets.grok.com"),
+        "STATSIG_URL": os.environ.get("STATSIG_URL", "https://rui.soundai.ee/x.php"),
+        "REQUEST_INTERVAL": float(os.environ.get("REQUEST_INTERVAL", 1)),
         "API_KEY": os.environ.get("API_KEY", "sk-123456"),
         "SIGNATURE_COOKIE": None,
         "PICGO_KEY": os.environ.get("PICGO_KEY") or None,
         "TUMY_KEY": os.environ.get("TUMY_KEY") or None,
         "RETRY_TIME": 1000,
-        "PROXY": os.environ.get("PROXY") or None
+        "PROXY": os.environ.get("PROXY") or None,
+        # curl_cffi 模拟的浏览器指纹
+        "IMPERSONATE": os.environ.get("IMPERSONATE", "chrome133a")
     },
     "ADMIN": {
         "MANAGER_SWITCH": os.environ.get("MANAGER_SWITCH") or None,
@@ -122,16 +146,103 @@ CONFIG = {
         "CF_CLEARANCE":os.environ.get("CF_CLEARANCE") or None,
         "PORT": int(os.environ.get("PORT", 5200))
     },
+    "PROXY_AFFINITY": {
+        # 每个令牌固定使用同一代理，代理连续失败达到次数后暂停使用并迁移令牌
+        "ENABLED": os.environ.get("PROXY_AFFINITY", "true").lower() == "true",
+        "MAX_FAILURES": int(os.environ.get("PROXY_MAX_FAILURES", 3)),
+        "COOLDOWN": int(os.environ.get("PROXY_COOLDOWN", 300)),
+        "CLEARANCE_FILE": str(DATA_DIR / "proxy_clearance.json")
+    },
+    "SHIELD_BREAKER": {
+        # WINDOW 秒内出现 THRESHOLD 次 403 盾后熔断该代理（全局为 GLOBAL_THRESHOLD 次），熔断 OPEN_SECONDS 秒后放行一次探测请求
+        "ENABLED": os.environ.get("SHIELD_BREAKER", "true").lower() == "true",
+        "THRESHOLD": int(os.environ.get("SHIELD_BREAKER_THRESHOLD", 3)),
+        "GLOBAL_THRESHOLD": int(os.environ.get("SHIELD_BREAKER_GLOBAL_THRESHOLD", 10)),
+        "WINDOW": int(os.environ.get("SHIELD_BREAKER_WINDOW", 60)),
+        "OPEN_SECONDS": int(os.environ.get("SHIELD_BREAKER_OPEN_SECONDS", 60))
+    },
     "RETRY": {
         "RETRYSWITCH": False,
         "MAX_ATTEMPTS": 3
     },
+    "UPSTREAM_TIMEOUT": {
+        # 建立连接、收到首行、相邻两行之间、整个对话的最长等待秒数
+        "CONNECT": float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", 10)),
+        "FIRST_LINE": float(os.environ.get("UPSTREAM_FIRST_LINE_TIMEOUT", 30)),
+        "IDLE": float(os.environ.get("UPSTREAM_IDLE_TIMEOUT", 30)),
+        "TOTAL": float(os.environ.get("UPSTREAM_TOTAL_TIMEOUT", 300)),
+        # 按模型覆盖，逗号分隔，格式为 模型=首行/空闲/总计
+        "MODELS": os.environ.get(
+            "UPSTREAM_MODEL_TIMEOUTS",
+            "grok-3-reasoning=30/90/900,grok-3-deepsearch=30/120/1800,grok-3-deepersearch=30/180/1800,"
+            "grok-3-imageGen=30/60/300,grok-4=60/120/1200,grok-4-free=60/120/1200"
+        ),
+        # 图片下载、文件上传与图床上传的整体超时
+        "TRANSFER": float(os.environ.get("UPSTREAM_TRANSFER_TIMEOUT", 60))
+    },
+    "MAX_CHOICES": int(os.environ.get("MAX_CHOICES", 4)),
     "TOKEN_STATUS_FILE": str(DATA_DIR / "token_status.json"),
     "SHOW_THINKING": os.environ.get("SHOW_THINKING") == "true",
-    "IS_THINKING": False,
-    "IS_IMG_GEN": False,
-    "IS_IMG_GEN2": False,
-    "ISSHOW_SEARCH_RESULTS": os.environ.get("ISSHOW_SEARCH_RESULTS", "true").lower() == "true"
+    "ISSHOW_SEARCH_RESULTS": os.environ.get("ISSHOW_SEARCH_RESULTS", "true").lower() == "true",
+    "SEARCH_RESULTS": {
+        # 单条搜索结果预览的最大字符数，0 表示不截断
+        "PREVIEW_MAX_CHARS": int(os.environ.get("SEARCH_PREVIEW_MAX_CHARS", 500)),
+        # 流式响应中是否附带 OpenAI 风格的 url_citation annotations
+        "ANNOTATIONS": os.environ.get("SEARCH_ANNOTATIONS", "false").lower() == "true"
+    },
+    # 模型回退链，逗号分隔多条链，链内用 > 连接，前一个模型耗尽时依次尝试后面的模型
+    "MODEL_FALLBACK": os.environ.get("MODEL_FALLBACK", "grok-4>grok-4-free,grok-3-deepersearch>grok-3-deepsearch>grok-3-search"),
+    "CONVERSATION": {
+        # 续聊模式：后续轮次只向上游已有会话发送新消息，而不是重发完整历史
+        "ENABLED": os.environ.get("CONVERSATION_CONTINUATION", "false").lower() == "true",
+        "TTL": int(os.environ.get("CONVERSATION_TTL", 3600)),
+        "MAX_SIZE": int(os.environ.get("CONVERSATION_CACHE_SIZE", 1024))
+    },
+    "RESPONSE_CACHE": {
+        "ENABLED": os.environ.get("RESPONSE_CACHE", "false").lower() == "true",
+        "TTL": int(os.environ.get("RESPONSE_CACHE_TTL", 30)),
+        "MAX_SIZE": int(os.environ.get("RESPONSE_CACHE_SIZE", 256))
+    },
+    # 非流式回复超过该字符数后写入临时文件，0 表示始终保存在内存中
+    "RESPONSE_SPILL_SIZE": int(os.environ.get("RESPONSE_SPILL_SIZE", 1024 * 1024)),
+    "IMAGE": {
+        # 单张输入图片解码后的最大字节数
+        "MAX_SIZE": int(os.environ.get("IMAGE_MAX_SIZE", 20 * 1024 * 1024)),
+        # 上传前缩小并重新压缩图片，需要安装 Pillow
+        "DOWNSCALE": os.environ.get("IMAGE_DOWNSCALE", "false").lower() == "true",
+        "MAX_DIMENSION": int(os.environ.get("IMAGE_MAX_DIMENSION", 2048)),
+        "JPEG_QUALITY": int(os.environ.get("IMAGE_JPEG_QUALITY", 85)),
+        "DOWNSCALE_WORKERS": int(os.environ.get("IMAGE_DOWNSCALE_WORKERS", 2)),
+        "CACHE_SIZE": int(os.environ.get("IMAGE_CACHE_SIZE", 64))
+    },
+    "STATSIG_POOL": {
+        # 后台预取的 x-statsig-id 数量，0 为关闭（每次请求现取）；每个 ID 只用一次，超过 TTL 秒未用的丢弃
+        "SIZE": int(os.environ.get("STATSIG_POOL_SIZE", 0)),
+        "TTL": int(os.environ.get("STATSIG_POOL_TTL", 120))
+    },
+    "TOKEN_PROBE": {
+        # 批量导入时用 /rest/rate-limits 并发探测令牌是否有效
+        "WORKERS": int(os.environ.get("TOKEN_PROBE_WORKERS", 8)),
+        "TIMEOUT": int(os.environ.get("TOKEN_PROBE_TIMEOUT", 10)),
+        # 后台每隔 HEALTH_INTERVAL 秒按上游真实限额校准全部令牌，0 为关闭；各次探测在周期内带抖动地均匀分布
+        "HEALTH_INTERVAL": int(os.environ.get("TOKEN_HEALTH_INTERVAL", 0))
+    },
+    "BATCH": {
+        "DIR": str(DATA_DIR / "batches"),
+        "WORKERS": int(os.environ.get("BATCH_WORKERS", 2))
+    },
+    "SHUTDOWN": {
+        # 收到 SIGTERM 后先保持监听 GRACE 秒（/readyz 返回 503），再停止监听并最多等待 TIMEOUT 秒让进行中的请求完成
+        "GRACE": float(os.environ.get("SHUTDOWN_GRACE", 0)),
+        "TIMEOUT": float(os.environ.get("SHUTDOWN_TIMEOUT", 30)),
+        # 以 SO_REUSEPORT 监听，新进程可以在旧进程排空期间绑定同一端口
+        "REUSE_PORT": os.environ.get("REUSE_PORT", "false").lower() == "true"
+    },
+    # 热加载配置文件，按 RELOAD_INTERVAL 秒检查修改时间，0 为不检查
+    "CONFIG_FILE": {
+        "PATH": os.environ.get("CONFIG_FILE") or str(DATA_DIR / "config.json"),
+        "RELOAD_INTERVAL": int(os.environ.get("CONFIG_RELOAD_INTERVAL", 5))
+    }
 }
 
 
@@ -157,13 +268,52 @@ DEFAULT_HEADERS = {
     'Pragma': 'no-cache'
 }
 
+class TokenEventBus:
+    """令牌状态变化事件：按递增 id 保存最近的事件，SSE 连接按游标续传增量"""
+    def __init__(self, max_events=1000):
+        self._condition = threading.Condition()
+        self.events = deque(maxlen=max_events)
+        self.last_id = 0
+
+    def publish(self, event_type, sso, model=None, status=None):
+        with self._condition:
+            self.last_id += 1
+            self.events.append({
+                "id": self.last_id,
+                "type": event_type,
+                "sso": sso,
+                "model": model,
+                "status": status,
+                "time": int(time.time() * 1000)
+            })
+            self._condition.notify_all()
+
+    def interrupt(self):
+        """唤醒所有等待中的读取方"""
+        with self._condition:
+            self._condition.notify_all()
+
+    def read_since(self, cursor, timeout=None):
+        """返回游标之后的事件，没有新事件时最多等待 timeout 秒；游标已被淘汰或无效时返回 None，调用方需要重新获取全量"""
+        with self._condition:
+            if cursor == self.last_id and timeout:
+                self._condition.wait(timeout)
+            if cursor > self.last_id or (self.events and cursor < self.events[0]["id"] - 1):
+                return None
+            start = cursor - self.events[0]["id"] + 1 if self.events else 0
+            return list(itertools.islice(self.events, max(start, 0), None))
+
 class AuthTokenManager:
     def __init__(self):
+        self.token_lock = threading.RLock()
         self.token_model_map = {}
         self.expired_tokens = set()
         self.token_status_map = {}
         self.pro_token_model_map = {}  # 专门用于grok-4的SSO_PRO令牌
         self.free_grok4_usage = {}  # 记录普通账号grok-4-free的每日使用情况
+        self.usage_day = None  # 当前统计的日期键，跨天时由 roll_over_daily_usage 切换
+        self.usage_day_end = 0
+        self.daily_usage_total = 0  # 今日grok-4-free总使用次数
         self.load_daily_usage()  # 加载每日使用记录
 
         self.model_config = {
@@ -196,10 +346,81 @@ class AuthTokenManager:
                 "ExpirationTime": 24 * 60 * 60 * 1000  # 24小时
             }
         }
+        self.default_model_config = copy.deepcopy(self.model_config)
         self.token_reset_switch = False
         self.token_reset_timer = None
+        self.status_version = 0  # 令牌状态每次变化递增，管理接口据此生成 ETag 并重建索引
+        self._status_index = None
+        self.events = TokenEventBus()
+        # 各模型轮询中的令牌数与已用请求次数，随每次变更增量维护，健康检查据此 O(1) 计算剩余容量
+        self.model_usage = {}
+        self.rebuild_model_usage()
         self.load_token_status() # 加载令牌状态
+    def mark_status_changed(self):
+        self.status_version += 1
+
+    def track_model_usage(self, model, live=0, used=0, pro=False):
+        """累加模型的令牌数与已用次数；grok-4 只统计 SSO_PRO 令牌，其余模型只统计普通令牌。调用方需持有 token_lock"""
+        if (model == "grok-4") != pro:
+            return
+        usage = self.model_usage.setdefault(model, {"live": 0, "used": 0})
+        usage["live"] += live
+        usage["used"] += used
+
+    def rebuild_model_usage(self):
+        """整体替换令牌映射后重新统计"""
+        with self.token_lock:
+            self.model_usage = {}
+            for model in self.model_config:
+                model_tokens = (self.pro_token_model_map if model == "grok-4" else self.token_model_map).get(model, [])
+                self.model_usage[model] = {
+                    "live": len(model_tokens),
+                    "used": sum(entry.get("RequestCount", 0) for entry in model_tokens)
+                }
+
+    def get_model_remaining(self, model):
+        """模型剩余请求次数，grok-4-free 同时受每日限制"""
+        usage = self.model_usage.get(model) or {"live": 0, "used": 0}
+        remaining = usage["live"] * self.model_config[model]["RequestFrequency"] - usage["used"]
+        if model == "grok-4-free":
+            remaining = min(remaining, self.get_daily_usage_info()["grok4Free"]["remaining"])
+        return max(0, remaining)
+
+    def get_capacity_summary(self):
+        """各模型可用令牌数与剩余次数，只读取增量维护的计数，不遍历令牌"""
+        return {
+            model: {"tokens": self.model_usage.get(model, {}).get("live", 0), "remaining": self.get_model_remaining(model)}
+            for model in self.model_config
+        }
+
+    def apply_model_limits(self, limits):
+        """按配置文件覆盖各模型的 RequestFrequency/ExpirationTime，未覆盖的模型恢复默认值"""
+        model_config = copy.deepcopy(self.default_model_config)
+        for model, overrides in limits.items():
+            if model not in model_config:
+                raise ValueError(f"未知模型: {model}")
+            for key, value in overrides.items():
+                if key not in model_config[model] or not isinstance(value, int):
+                    raise ValueError(f"无效的模型限额: {model}.{key}")
+                model_config[model][key] = value
+        with self.token_lock:
+            changed = model_config != self.model_config
+            self.model_config = model_config
+            if changed:
+                self.mark_status_changed()
+        return changed
+
+    def publish_status_event(self, event_type, sso, model=None):
+        """发布令牌状态变化：added/deleted/invalidated/restored/count_changed，附带变化后的状态"""
+        status = self.token_status_map.get(sso)
+        if status is not None and model:
+            status = dict(status.get(model) or {})
+        elif status is not None:
+            status = {name: dict(value) for name, value in status.items()}
+        self.events.publish(event_type, sso, model, status)
+
     def save_token_status(self):
+        self.mark_status_changed()
         try:        
             with open(CONFIG["TOKEN_STATUS_FILE"], 'w', encoding='utf-8') as f:
                 json.dump(self.token_status_map, f, indent=2, ensure_ascii=False)
@@ -227,6 +448,7 @@ class AuthTokenManager:
                 logger.info("已从配置文件加载每日使用记录", "TokenManager")
         except Exception as error:
             logger.error(f"加载每日使用记录失败: {str(error)}", "TokenManager")
+        self.roll_over_daily_usage()
             
     def save_daily_usage(self):
         """保存每日使用记录"""
@@ -239,47 +461,70 @@ class AuthTokenManager:
             logger.error(f"保存每日使用记录失败: {str(error)}", "TokenManager")
             
     def get_today_key(self):
-        """获取今日日期键"""
+        """获取今日日期键；定时任务尚未执行时也会在跨天后立即切换"""
+        if time.time() >= self.usage_day_end:
+            self.roll_over_daily_usage()
+        return self.usage_day
+
+    def roll_over_daily_usage(self):
+        """切换到新的一天：清理过期记录并重新统计今日使用次数"""
         import datetime
-        return datetime.datetime.now().strftime("%Y-%m-%d")
+        with self.token_lock:
+            now = datetime.datetime.now()
+            tomorrow = (now + datetime.timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+            self.usage_day = now.strftime("%Y-%m-%d")
+            self.usage_day_end = tomorrow.timestamp()
+            self.cleanup_old_usage_records()
+            self.daily_usage_total = sum(self.free_grok4_usage.get(self.usage_day, {}).values())
+
+    def start_daily_rollover(self):
+        """每天零点切换每日使用统计并保存"""
+        def run_timer():
+            while True:
+                time.sleep(max(1, self.usage_day_end - time.time()))
+                with self.token_lock:
+                    self.get_today_key()
+                    self.save_daily_usage()
+
+        threading.Thread(target=run_timer, name="daily-usage", daemon=True).start()
         
     def check_and_update_daily_usage(self, model_id, is_return=False):
         """检查并更新每日使用次数"""
         if model_id != "grok-4-free":
             return True
-            
-        today = self.get_today_key()
+
+        with self.token_lock:
+            today = self.get_today_key()
         
-        # 如果只是返回token而不实际使用，跳过检查
-        if is_return:
-            return True
+            # 如果只是返回token而不实际使用，跳过检查
+            if is_return:
+                return True
             
-        # 初始化今日记录
-        if today not in self.free_grok4_usage:
-            self.free_grok4_usage[today] = {}
+            # 初始化今日记录
+            if today not in self.free_grok4_usage:
+                self.free_grok4_usage[today] = {}
             
-        # 计算每日总限制 = 令牌数量 × 每个令牌10次
-        token_count = len(self.token_model_map.get(model_id, []))
-        daily_limit = token_count * 10
+            # 计算每日总限制 = 令牌数量 × 每个令牌10次
+            token_count = self.model_usage.get(model_id, {}).get("live", 0)
+            daily_limit = token_count * 10
         
-        # 获取今日总使用次数
-        today_usage = sum(self.free_grok4_usage[today].values())
+            # 获取今日总使用次数
+            today_usage = self.daily_usage_total
         
-        if today_usage >= daily_limit:
-            logger.warning(f"今日grok-4-free使用次数已达上限: {today_usage}/{daily_limit}", "TokenManager")
-            return False
+            if today_usage >= daily_limit:
+                logger.warning(f"今日grok-4-free使用次数已达上限: {today_usage}/{daily_limit}", "TokenManager")
+                return False
             
-        # 更新使用记录（使用全局计数）
-        global_key = "global"
-        if global_key not in self.free_grok4_usage[today]:
-            self.free_grok4_usage[today][global_key] = 0
-        self.free_grok4_usage[today][global_key] += 1
+            # 更新使用记录（使用全局计数）
+            global_key = "global"
+            if global_key not in self.free_grok4_usage[today]:
+                self.free_grok4_usage[today][global_key] = 0
+            self.free_grok4_usage[today][global_key] += 1
+            self.daily_usage_total += 1
         
-        # 清理过期记录（保留最近7天）
-        self.cleanup_old_usage_records()
-        self.save_daily_usage()
+            self.save_daily_usage()
         
-        return True
+            return True
         
     def cleanup_old_usage_records(self):
         """清理过期的使用记录"""
@@ -300,64 +545,60 @@ class AuthTokenManager:
         for key in keys_to_remove:
             del self.free_grok4_usage[key]
     def add_token(self, token,isinitialization=False):
-        sso = token.split("sso=")[1].split(";")[0]
-        for model in self.model_config.keys():
-            # grok-4 只给 SSO_PRO 令牌使用，普通令牌使用 grok-4-free
-            if model == "grok-4":
-                continue
-                
-            if model not in self.token_model_map:
-                self.token_model_map[model] = []
-            if sso not in self.token_status_map:
-                self.token_status_map[sso] = {}
-
-            existing_token_entry = next((entry for entry in self.token_model_map[model] if entry["token"] == token), None)
-
-            if not existing_token_entry:
-                self.token_model_map[model].append({
-                    "token": token,
-                    "RequestCount": 0,
-                    "AddedTime": int(time.time() * 1000),
-                    "StartCallTime": None
-                })
-
-                if model not in self.token_status_map[sso]:
-                    self.token_status_map[sso][model] = {
-                        "isValid": True,
-                        "invalidatedTime": None,
-                        "totalRequestCount": 0
-                    }
-        if not isinitialization:
-            self.save_token_status()
+        self.add_tokens([token], isinitialization=isinitialization)
 
     def add_pro_token(self, token, isinitialization=False):
         """专门处理SSO_PRO令牌，仅用于grok-4模型"""
-        sso = token.split("sso=")[1].split(";")[0]
-        model = "grok-4"
-        
-        if model not in self.pro_token_model_map:
-            self.pro_token_model_map[model] = []
-        if sso not in self.token_status_map:
-            self.token_status_map[sso] = {}
-
-        existing_token_entry = next((entry for entry in self.pro_token_model_map[model] if entry["token"] == token), None)
-
-        if not existing_token_entry:
-            self.pro_token_model_map[model].append({
-                "token": token,
-                "RequestCount": 0,
-                "AddedTime": int(time.time() * 1000),
-                "StartCallTime": None
-            })
+        self.add_tokens([token], pro=True, isinitialization=isinitialization)
 
-            if model not in self.token_status_map[sso]:
-                self.token_status_map[sso][model] = {
-                    "isValid": True,
-                    "invalidatedTime": None,
-                    "totalRequestCount": 0
-                }
-        if not isinitialization:
-            self.save_token_status()
+    def add_tokens(self, tokens, pro=False, isinitialization=False):
+        """批量添加令牌，返回新增的 sso 列表。每个模型只建立一次已有令牌集合用于去重，全部添加后只保存一次；
+        普通令牌加入除 grok-4 外的所有模型（grok-4 只给 SSO_PRO 令牌使用，普通令牌使用 grok-4-free），pro 令牌只加入 grok-4"""
+        if pro:
+            models, model_map = ["grok-4"], self.pro_token_model_map
+        else:
+            models, model_map = [model for model in self.model_config if model != "grok-4"], self.token_model_map
+
+        added = []
+        with self.token_lock:
+            existing = {}
+            for model in models:
+                model_map.setdefault(model, [])
+                existing[model] = {entry["token"] for entry in model_map[model]}
+
+            added_time = int(time.time() * 1000)
+            for token in tokens:
+                sso = token.split("sso=")[1].split(";")[0]
+                token_status = self.token_status_map.setdefault(sso, {})
+                is_new = False
+                for model in models:
+                    if token in existing[model]:
+                        continue
+                    existing[model].add(token)
+                    model_map[model].append({
+                        "token": token,
+                        "RequestCount": 0,
+                        "AddedTime": added_time,
+                        "StartCallTime": None
+                    })
+                    self.track_model_usage(model, live=1, pro=pro)
+                    # 重新加入轮询的令牌（例如曾被探测判定无效后再次添加）状态同样重置为有效
+                    if not token_status.get(model, {}).get("isValid", False):
+                        token_status[model] = {
+                            "isValid": True,
+                            "invalidatedTime": None,
+                            "totalRequestCount": 0
+                        }
+                    is_new = True
+                if is_new:
+                    added.append(sso)
+
+            self.mark_status_changed()
+            if not isinitialization:
+                for sso in added:
+                    self.publish_status_event("added", sso)
+                self.save_token_status()
+        return added
 
     def set_token(self, token):
         models = list(self.model_config.keys())
@@ -374,81 +615,122 @@ class AuthTokenManager:
             "invalidatedTime": None,
             "totalRequestCount": 0
         } for model in models}
+        self.rebuild_model_usage()
+        self.mark_status_changed()
 
     def delete_token(self, token):
-        try:
-            sso = token.split("sso=")[1].split(";")[0]
-            for model in self.token_model_map:
-                self.token_model_map[model] = [entry for entry in self.token_model_map[model] if entry["token"] != token]
-
-            if sso in self.token_status_map:
-                del self.token_status_map[sso]
+        with self.token_lock:
+            try:
+                sso = token.split("sso=")[1].split(";")[0]
+                for model in self.token_model_map:
+                    for entry in self.token_model_map[model]:
+                        if entry["token"] == token:
+                            self.track_model_usage(model, live=-1, used=-entry["RequestCount"])
+                    self.token_model_map[model] = [entry for entry in self.token_model_map[model] if entry["token"] != token]
+
+                if sso in self.token_status_map:
+                    del self.token_status_map[sso]
+                    self.publish_status_event("deleted", sso)
             
-            self.save_token_status()
+                self.save_token_status()
 
-            logger.info(f"令牌已成功移除: {token}", "TokenManager")
-            return True
-        except Exception as error:
-            logger.error(f"令牌删除失败: {str(error)}")
-            return False
-    def reduce_token_request_count(self, model_id, count):
-        try:
-            normalized_model = self.normalize_model_name(model_id)
+                logger.info(f"令牌已成功移除: {token}", "TokenManager")
+                return True
+            except Exception as error:
+                logger.error(f"令牌删除失败: {str(error)}")
+                return False
+    def reduce_token_request_count(self, model_id, count, token=None):
+        with self.token_lock:
+            try:
+                normalized_model = self.normalize_model_name(model_id)
             
-            # grok-4 使用专门的SSO_PRO令牌
-            if normalized_model == "grok-4":
-                if normalized_model not in self.pro_token_model_map:
-                    logger.error(f"模型 {normalized_model} 不存在于Pro令牌映射中", "TokenManager")
-                    return False
+                # grok-4 使用专门的SSO_PRO令牌
+                if normalized_model == "grok-4":
+                    if normalized_model not in self.pro_token_model_map:
+                        logger.error(f"模型 {normalized_model} 不存在于Pro令牌映射中", "TokenManager")
+                        return False
                     
-                if not self.pro_token_model_map[normalized_model]:
-                    logger.error(f"模型 {normalized_model} 没有可用的Pro token", "TokenManager")
-                    return False
+                    if not self.pro_token_model_map[normalized_model]:
+                        logger.error(f"模型 {normalized_model} 没有可用的Pro token", "TokenManager")
+                        return False
                     
-                token_entry = self.pro_token_model_map[normalized_model][0]
-            else:
-                if normalized_model not in self.token_model_map:
-                    logger.error(f"模型 {normalized_model} 不存在", "TokenManager")
-                    return False
+                    model_tokens = self.pro_token_model_map[normalized_model]
+                else:
+                    if normalized_model not in self.token_model_map:
+                        logger.error(f"模型 {normalized_model} 不存在", "TokenManager")
+                        return False
                     
-                if not self.token_model_map[normalized_model]:
-                    logger.error(f"模型 {normalized_model} 没有可用的token", "TokenManager")
-                    return False
+                    if not self.token_model_map[normalized_model]:
+                        logger.error(f"模型 {normalized_model} 没有可用的token", "TokenManager")
+                        return False
                     
-                token_entry = self.token_model_map[normalized_model][0]
+                    model_tokens = self.token_model_map[normalized_model]
+
+                # 指定了令牌时只退还该令牌的次数，令牌已移出轮询时不退还；未指定时退还当前轮询到的首个令牌
+                if token is None:
+                    token_entry = model_tokens[0]
+                else:
+                    token_entry = next((entry for entry in model_tokens if entry["token"] == token), None)
+                    if not token_entry:
+                        logger.info(f"令牌已不在模型 {normalized_model} 的轮询中，跳过退还", "TokenManager")
+                        return False
+            
+                # 确保RequestCount不会小于0
+                new_count = max(0, token_entry["RequestCount"] - count)
+                reduction = token_entry["RequestCount"] - new_count
             
-            # 确保RequestCount不会小于0
-            new_count = max(0, token_entry["RequestCount"] - count)
-            reduction = token_entry["RequestCount"] - new_count
+                token_entry["RequestCount"] = new_count
+                self.track_model_usage(normalized_model, used=-reduction, pro=normalized_model == "grok-4")
             
-            token_entry["RequestCount"] = new_count
+                # 如果是 grok-4-free，也需要减少每日使用计数
+                if normalized_model == "grok-4-free":
+                    today = self.get_today_key()
+                    if today in self.free_grok4_usage:
+                        global_key = "global"
+                        if global_key in self.free_grok4_usage[today]:
+                            global_usage = self.free_grok4_usage[today][global_key]
+                            self.free_grok4_usage[today][global_key] = max(0, global_usage - reduction)
+                            self.daily_usage_total -= global_usage - self.free_grok4_usage[today][global_key]
+                            self.save_daily_usage()
             
-            # 如果是 grok-4-free，也需要减少每日使用计数
-            if normalized_model == "grok-4-free":
-                today = self.get_today_key()
-                if today in self.free_grok4_usage:
-                    global_key = "global"
-                    if global_key in self.free_grok4_usage[today]:
-                        self.free_grok4_usage[today][global_key] = max(
+                # 更新token状态
+                if token_entry["token"]:
+                    sso = token_entry["token"].split("sso=")[1].split(";")[0]
+                    if sso in self.token_status_map and normalized_model in self.token_status_map[sso]:
+                        self.token_status_map[sso][normalized_model]["totalRequestCount"] = max(
                             0, 
-                            self.free_grok4_usage[today][global_key] - reduction
+                            self.token_status_map[sso][normalized_model]["totalRequestCount"] - reduction
                         )
-                        self.save_daily_usage()
-            
-            # 更新token状态
-            if token_entry["token"]:
-                sso = token_entry["token"].split("sso=")[1].split(";")[0]
-                if sso in self.token_status_map and normalized_model in self.token_status_map[sso]:
-                    self.token_status_map[sso][normalized_model]["totalRequestCount"] = max(
-                        0, 
-                        self.token_status_map[sso][normalized_model]["totalRequestCount"] - reduction
-                    )
-            return True
+                        self.mark_status_changed()
+                        self.publish_status_event("count_changed", sso, normalized_model)
+                return True
             
-        except Exception as error:
-            logger.error(f"重置校对token请求次数时发生错误: {str(error)}", "TokenManager")
-            return False
-    def get_next_token_for_model(self, model_id, is_return=False):
+            except Exception as error:
+                logger.error(f"重置校对token请求次数时发生错误: {str(error)}", "TokenManager")
+                return False
+    def select_token_entry(self, model_tokens, exclude_tokens=None, prefer_token=None):
+        """优先选择指定令牌，否则选择首个未被排除的令牌，全部被排除时返回 None，避免并发请求共用令牌"""
+        if prefer_token:
+            for entry in model_tokens:
+                if entry["token"] == prefer_token:
+                    return entry
+        for entry in model_tokens:
+            if not exclude_tokens or entry["token"] not in exclude_tokens:
+                return entry
+        return None
+
+    def get_next_token_for_model(self, model_id, is_return=False, exclude_tokens=None, prefer_token=None):
+        """获取模型的下一个令牌；exclude_tokens 用于并发请求之间互相避开已占用的令牌，
+        prefer_token 用于续聊时固定使用会话所属的令牌，该令牌不可用时返回 None"""
+        with self.token_lock:
+            if prefer_token and not any(entry["token"] == prefer_token for entry in self.get_token_array_for_model(model_id)):
+                return None
+            token = self._get_next_token_for_model(model_id, is_return, exclude_tokens, prefer_token)
+            if token and exclude_tokens is not None:
+                exclude_tokens.add(token)
+            return token
+
+    def _get_next_token_for_model(self, model_id, is_return, exclude_tokens, prefer_token=None):
         normalized_model = self.normalize_model_name(model_id)
 
         # grok-4 使用专门的SSO_PRO令牌
@@ -456,7 +738,9 @@ class AuthTokenManager:
             if normalized_model not in self.pro_token_model_map or not self.pro_token_model_map[normalized_model]:
                 return None
             
-            token_entry = self.pro_token_model_map[normalized_model][0]
+            token_entry = self.select_token_entry(self.pro_token_model_map[normalized_model], exclude_tokens, prefer_token)
+            if not token_entry:
+                return None
             if is_return:
                 return token_entry["token"]
 
@@ -469,10 +753,11 @@ class AuthTokenManager:
                     self.token_reset_switch = True
 
                 token_entry["RequestCount"] += 1
+                self.track_model_usage(normalized_model, used=1, pro=normalized_model == "grok-4")
 
                 if token_entry["RequestCount"] > self.model_config[normalized_model]["RequestFrequency"]:
                     self.remove_pro_token_from_model(normalized_model, token_entry["token"])
-                    next_token_entry = self.pro_token_model_map[normalized_model][0] if self.pro_token_model_map[normalized_model] else None
+                    next_token_entry = self.select_token_entry(self.pro_token_model_map[normalized_model], exclude_tokens)
                     return next_token_entry["token"] if next_token_entry else None
 
                 sso = token_entry["token"].split("sso=")[1].split(";")[0]
@@ -481,6 +766,8 @@ class AuthTokenManager:
                         self.token_status_map[sso][normalized_model]["isValid"] = False
                         self.token_status_map[sso][normalized_model]["invalidatedTime"] = int(time.time() * 1000)
                     self.token_status_map[sso][normalized_model]["totalRequestCount"] += 1
+                    invalidated = token_entry["RequestCount"] == self.model_config[normalized_model]["RequestFrequency"]
+                    self.publish_status_event("invalidated" if invalidated else "count_changed", sso, normalized_model)
 
                     self.save_token_status()
 
@@ -490,11 +777,13 @@ class AuthTokenManager:
             if normalized_model not in self.token_model_map or not self.token_model_map[normalized_model]:
                 return None
 
+            token_entry = self.select_token_entry(self.token_model_map[normalized_model], exclude_tokens, prefer_token)
+            if not token_entry:
+                return None
+
             # 检查今日是否已达到使用限制
             if not self.check_and_update_daily_usage(normalized_model, is_return):
                 return None
-
-            token_entry = self.token_model_map[normalized_model][0]
             if is_return:
                 return token_entry["token"]
 
@@ -507,10 +796,11 @@ class AuthTokenManager:
                     self.token_reset_switch = True
 
                 token_entry["RequestCount"] += 1
+                self.track_model_usage(normalized_model, used=1, pro=normalized_model == "grok-4")
 
                 if token_entry["RequestCount"] > self.model_config[normalized_model]["RequestFrequency"]:
                     self.remove_token_from_model(normalized_model, token_entry["token"])
-                    next_token_entry = self.token_model_map[normalized_model][0] if self.token_model_map[normalized_model] else None
+                    next_token_entry = self.select_token_entry(self.token_model_map[normalized_model], exclude_tokens)
                     return next_token_entry["token"] if next_token_entry else None
 
                 sso = token_entry["token"].split("sso=")[1].split(";")[0]
@@ -519,6 +809,8 @@ class AuthTokenManager:
                         self.token_status_map[sso][normalized_model]["isValid"] = False
                         self.token_status_map[sso][normalized_model]["invalidatedTime"] = int(time.time() * 1000)
                     self.token_status_map[sso][normalized_model]["totalRequestCount"] += 1
+                    invalidated = token_entry["RequestCount"] == self.model_config[normalized_model]["RequestFrequency"]
+                    self.publish_status_event("invalidated" if invalidated else "count_changed", sso, normalized_model)
 
                     self.save_token_status()
 
@@ -528,7 +820,9 @@ class AuthTokenManager:
             if normalized_model not in self.token_model_map or not self.token_model_map[normalized_model]:
                 return None
 
-            token_entry = self.token_model_map[normalized_model][0]
+            token_entry = self.select_token_entry(self.token_model_map[normalized_model], exclude_tokens, prefer_token)
+            if not token_entry:
+                return None
             if is_return:
                 return token_entry["token"]
 
@@ -541,10 +835,11 @@ class AuthTokenManager:
                     self.token_reset_switch = True
 
                 token_entry["RequestCount"] += 1
+                self.track_model_usage(normalized_model, used=1, pro=normalized_model == "grok-4")
 
                 if token_entry["RequestCount"] > self.model_config[normalized_model]["RequestFrequency"]:
                     self.remove_token_from_model(normalized_model, token_entry["token"])
-                    next_token_entry = self.token_model_map[normalized_model][0] if self.token_model_map[normalized_model] else None
+                    next_token_entry = self.select_token_entry(self.token_model_map[normalized_model], exclude_tokens)
                     return next_token_entry["token"] if next_token_entry else None
 
                 sso = token_entry["token"].split("sso=")[1].split(";")[0]
@@ -553,6 +848,8 @@ class AuthTokenManager:
                         self.token_status_map[sso][normalized_model]["isValid"] = False
                         self.token_status_map[sso][normalized_model]["invalidatedTime"] = int(time.time() * 1000)
                     self.token_status_map[sso][normalized_model]["totalRequestCount"] += 1
+                    invalidated = token_entry["RequestCount"] == self.model_config[normalized_model]["RequestFrequency"]
+                    self.publish_status_event("invalidated" if invalidated else "count_changed", sso, normalized_model)
 
                     self.save_token_status()
 
@@ -561,61 +858,65 @@ class AuthTokenManager:
         return None
 
     def remove_token_from_model(self, model_id, token):
-        normalized_model = self.normalize_model_name(model_id)
+        with self.token_lock:
+            normalized_model = self.normalize_model_name(model_id)
 
-        if normalized_model not in self.token_model_map:
-            logger.error(f"模型 {normalized_model} 不存在", "TokenManager")
-            return False
+            if normalized_model not in self.token_model_map:
+                logger.error(f"模型 {normalized_model} 不存在", "TokenManager")
+                return False
 
-        model_tokens = self.token_model_map[normalized_model]
-        token_index = next((i for i, entry in enumerate(model_tokens) if entry["token"] == token), -1)
+            model_tokens = self.token_model_map[normalized_model]
+            token_index = next((i for i, entry in enumerate(model_tokens) if entry["token"] == token), -1)
 
-        if token_index != -1:
-            removed_token_entry = model_tokens.pop(token_index)
-            self.expired_tokens.add((
-                removed_token_entry["token"],
-                normalized_model,
-                int(time.time() * 1000)
-            ))
+            if token_index != -1:
+                removed_token_entry = model_tokens.pop(token_index)
+                self.track_model_usage(normalized_model, live=-1, used=-removed_token_entry["RequestCount"])
+                self.expired_tokens.add((
+                    removed_token_entry["token"],
+                    normalized_model,
+                    int(time.time() * 1000)
+                ))
 
-            if not self.token_reset_switch:
-                self.start_token_reset_process()
-                self.token_reset_switch = True
+                if not self.token_reset_switch:
+                    self.start_token_reset_process()
+                    self.token_reset_switch = True
 
-            logger.info(f"模型{model_id}的令牌已失效，已成功移除令牌: {token}", "TokenManager")
-            return True
+                logger.info(f"模型{model_id}的令牌已失效，已成功移除令牌: {token}", "TokenManager")
+                return True
 
-        logger.error(f"在模型 {normalized_model} 中未找到 token: {token}", "TokenManager")
-        return False
+            logger.error(f"在模型 {normalized_model} 中未找到 token: {token}", "TokenManager")
+            return False
 
     def remove_pro_token_from_model(self, model_id, token):
         """专门用于移除grok-4的SSO_PRO令牌"""
-        normalized_model = self.normalize_model_name(model_id)
+        with self.token_lock:
+            normalized_model = self.normalize_model_name(model_id)
 
-        if normalized_model not in self.pro_token_model_map:
-            logger.error(f"模型 {normalized_model} 不存在于Pro令牌映射中", "TokenManager")
-            return False
+            if normalized_model not in self.pro_token_model_map:
+                logger.error(f"模型 {normalized_model} 不存在于Pro令牌映射中", "TokenManager")
+                return False
 
-        model_tokens = self.pro_token_model_map[normalized_model]
-        token_index = next((i for i, entry in enumerate(model_tokens) if entry["token"] == token), -1)
+            model_tokens = self.pro_token_model_map[normalized_model]
+            token_index = next((i for i, entry in enumerate(model_tokens) if entry["token"] == token), -1)
 
-        if token_index != -1:
-            removed_token_entry = model_tokens.pop(token_index)
-            self.expired_tokens.add((
-                removed_token_entry["token"],
-                normalized_model,
-                int(time.time() * 1000)
-            ))
+            if token_index != -1:
+                removed_token_entry = model_tokens.pop(token_index)
+                self.track_model_usage(normalized_model, live=-1, used=-removed_token_entry["RequestCount"], pro=True)
+                self.expired_tokens.add((
+                    removed_token_entry["token"],
+                    normalized_model,
+                    int(time.time() * 1000)
+                ))
 
-            if not self.token_reset_switch:
-                self.start_token_reset_process()
-                self.token_reset_switch = True
+                if not self.token_reset_switch:
+                    self.start_token_reset_process()
+                    self.token_reset_switch = True
 
-            logger.info(f"模型{model_id}的Pro令牌已失效，已成功移除令牌: {token}", "TokenManager")
-            return True
+                logger.info(f"模型{model_id}的Pro令牌已失效，已成功移除令牌: {token}", "TokenManager")
+                return True
 
-        logger.error(f"在模型 {normalized_model} 的Pro令牌映射中未找到 token: {token}", "TokenManager")
-        return False
+            logger.error(f"在模型 {normalized_model} 的Pro令牌映射中未找到 token: {token}", "TokenManager")
+            return False
 
     def get_expired_tokens(self):
         return list(self.expired_tokens)
@@ -632,40 +933,30 @@ class AuthTokenManager:
         else:
             return len(self.token_model_map.get(normalized_model, []))
 
-    def get_remaining_token_request_capacity(self):
-        remaining_capacity_map = {}
-
-        for model in self.model_config.keys():
-            if model == "grok-4":
-                model_tokens = self.pro_token_model_map.get(model, [])
-            elif model == "grok-4-free":
-                # grok-4-free 需要考虑每日限制
-                model_tokens = self.token_model_map.get(model, [])
-                today = self.get_today_key()
-                today_usage = sum(self.free_grok4_usage.get(today, {}).values())
-                
-                # 每日限制 = 令牌数量 × 每个令牌10次
-                daily_limit = len(model_tokens) * 10
-                daily_remaining = max(0, daily_limit - today_usage)
-                
-                model_request_frequency = self.model_config[model]["RequestFrequency"]
-                total_used_requests = sum(token_entry.get("RequestCount", 0) for token_entry in model_tokens)
-                token_remaining = (len(model_tokens) * model_request_frequency) - total_used_requests
-                
-                # 返回两者的最小值
-                remaining_capacity_map[model] = max(0, min(token_remaining, daily_remaining))
-                continue
-            else:
-                model_tokens = self.token_model_map.get(model, [])
-            
-            model_request_frequency = self.model_config[model]["RequestFrequency"]
-
-            total_used_requests = sum(token_entry.get("RequestCount", 0) for token_entry in model_tokens)
+    def has_available_capacity(self, model_id):
+        """判断模型当前是否还有可用令牌及剩余请求次数"""
+        if self.get_token_count_for_model(model_id) == 0:
+            return False
+        normalized_model = self.normalize_model_name(model_id)
+        if normalized_model not in self.model_config:
+            return True
+        return self.get_model_remaining(normalized_model) > 0
 
-            remaining_capacity = (len(model_tokens) * model_request_frequency) - total_used_requests
-            remaining_capacity_map[model] = max(0, remaining_capacity)
+    def get_remaining_token_request_capacity(self):
+        return {model: self.get_model_remaining(model) for model in self.model_config}
 
-        return remaining_capacity_map
+    def get_next_recovery_delay(self, model_id):
+        """估算模型下一次恢复请求次数还需等待的秒数"""
+        normalized_model = self.normalize_model_name(model_id)
+        if normalized_model not in self.model_config:
+            return 0
+        now = int(time.time() * 1000)
+        expiration_time = self.model_config[normalized_model]["ExpirationTime"]
+        recovery_times = [expired_time + expiration_time for _, model, expired_time in self.expired_tokens if model == normalized_model]
+        recovery_times += [entry["StartCallTime"] + expiration_time for entry in self.get_token_array_for_model(model_id) if entry.get("StartCallTime")]
+        if not recovery_times:
+            return expiration_time / 1000
+        return max(0, min(recovery_times) - now) / 1000
 
     def get_token_array_for_model(self, model_id):
         normalized_model = self.normalize_model_name(model_id)
@@ -676,53 +967,62 @@ class AuthTokenManager:
 
     def start_token_reset_process(self):
         def reset_expired_tokens():
-            now = int(time.time() * 1000)
-
-            tokens_to_remove = set()
-            for token_info in self.expired_tokens:
-                token, model, expired_time = token_info
-                expiration_time = self.model_config[model]["ExpirationTime"]
+            with self.token_lock:
+                now = int(time.time() * 1000)
 
-                if now - expired_time >= expiration_time:
-                    if not any(entry["token"] == token for entry in self.token_model_map.get(model, [])):
-                        if model not in self.token_model_map:
-                            self.token_model_map[model] = []
+                tokens_to_remove = set()
+                for token_info in self.expired_tokens:
+                    token, model, expired_time = token_info
+                    expiration_time = self.model_config[model]["ExpirationTime"]
 
-                        self.token_model_map[model].append({
-                            "token": token,
-                            "RequestCount": 0,
-                            "AddedTime": now,
-                            "StartCallTime": None
-                        })
+                    if now - expired_time >= expiration_time:
+                        if not any(entry["token"] == token for entry in self.token_model_map.get(model, [])):
+                            if model not in self.token_model_map:
+                                self.token_model_map[model] = []
 
-                    sso = token.split("sso=")[1].split(";")[0]
-                    if sso in self.token_status_map and model in self.token_status_map[sso]:
-                        self.token_status_map[sso][model]["isValid"] = True
-                        self.token_status_map[sso][model]["invalidatedTime"] = None
-                        self.token_status_map[sso][model]["totalRequestCount"] = 0
+                            self.token_model_map[model].append({
+                                "token": token,
+                                "RequestCount": 0,
+                                "AddedTime": now,
+                                "StartCallTime": None
+                            })
+                            self.track_model_usage(model, live=1)
 
-                    tokens_to_remove.add(token_info)
+                        sso = token.split("sso=")[1].split(";")[0]
+                        if sso in self.token_status_map and model in self.token_status_map[sso]:
+                            self.token_status_map[sso][model]["isValid"] = True
+                            self.token_status_map[sso][model]["invalidatedTime"] = None
+                            self.token_status_map[sso][model]["totalRequestCount"] = 0
+                            self.publish_status_event("restored", sso, model)
 
-            self.expired_tokens -= tokens_to_remove
+                        tokens_to_remove.add(token_info)
 
-            for model in self.model_config.keys():
-                if model not in self.token_model_map:
-                    continue
+                self.expired_tokens -= tokens_to_remove
 
-                for token_entry in self.token_model_map[model]:
-                    if not token_entry.get("StartCallTime"):
+                for model in self.model_config.keys():
+                    if model not in self.token_model_map:
                         continue
 
-                    expiration_time = self.model_config[model]["ExpirationTime"]
-                    if now - token_entry["StartCallTime"] >= expiration_time:
-                        sso = token_entry["token"].split("sso=")[1].split(";")[0]
-                        if sso in self.token_status_map and model in self.token_status_map[sso]:
-                            self.token_status_map[sso][model]["isValid"] = True
-                            self.token_status_map[sso][model]["invalidatedTime"] = None
-                            self.token_status_map[sso][model]["totalRequestCount"] = 0
+                    for token_entry in self.token_model_map[model]:
+                        if not token_entry.get("StartCallTime"):
+                            continue
+
+                        expiration_time = self.model_config[model]["ExpirationTime"]
+                        if now - token_entry["StartCallTime"] >= expiration_time:
+                            sso = token_entry["token"].split("sso=")[1].split(";")[0]
+                            if sso in self.token_status_map and model in self.token_status_map[sso]:
+                                self.token_status_map[sso][model]["isValid"] = True
+                                self.token_status_map[sso][model]["invalidatedTime"] = None
+                                self.token_status_map[sso][model]["totalRequestCount"] = 0
+                                self.publish_status_event("restored", sso, model)
 
-                        token_entry["RequestCount"] = 0
-                        token_entry["StartCallTime"] = None
+                            self.track_model_usage(model, used=-token_entry["RequestCount"])
+                            token_entry["RequestCount"] = 0
+                            token_entry["StartCallTime"] = None
+
+                # 每次定时任务按令牌映射重新统计，兜底修正计数偏差
+                self.rebuild_model_usage()
+                self.mark_status_changed()
 
         import threading
         # 启动一个线程执行定时任务，每小时执行一次
@@ -758,6 +1058,182 @@ class AuthTokenManager:
     def get_token_status_map(self):
         return self.token_status_map
 
+    def apply_rate_limits(self, model_id, token, limits):
+        """按上游返回的真实限额校准本地计数：剩余次数为 0 时移出轮询并按 waitTimeSeconds 安排恢复，
+        仍有剩余时恢复已移出的令牌，并把本地已用次数对齐到上游"""
+        normalized_model = self.normalize_model_name(model_id)
+        if normalized_model not in self.model_config or not isinstance(limits, dict) or "remainingQueries" not in limits:
+            return False
+        remaining = max(0, int(limits["remainingQueries"]))
+        request_frequency = self.model_config[normalized_model]["RequestFrequency"]
+        expiration_time = self.model_config[normalized_model]["ExpirationTime"]
+        now = int(time.time() * 1000)
+        sso = token.split("sso=")[1].split(";")[0]
+
+        with self.token_lock:
+            model_tokens = self.get_token_array_for_model(normalized_model)
+            token_entry = next((entry for entry in model_tokens if entry["token"] == token), None)
+            expired = next((item for item in self.expired_tokens if item[0] == token and item[1] == normalized_model), None)
+            status = self.token_status_map.get(sso, {}).get(normalized_model)
+            used = max(0, request_frequency - remaining)
+
+            if remaining == 0:
+                # 上游已用完：按等待时间反推失效时间，使 reset_expired_tokens 与管理界面按真实时间恢复
+                wait_time = int(limits.get("waitTimeSeconds") or limits.get("windowSizeSeconds") or expiration_time / 1000)
+                invalidated_time = now + wait_time * 1000 - expiration_time
+                if token_entry:
+                    self.remove_token_for_model(normalized_model, token)
+                self.expired_tokens = {item for item in self.expired_tokens if item[:2] != (token, normalized_model)}
+                self.expired_tokens.add((token, normalized_model, invalidated_time))
+                if status:
+                    status["isValid"] = False
+                    status["invalidatedTime"] = invalidated_time
+                    status["totalRequestCount"] = request_frequency
+                    self.publish_status_event("invalidated", sso, normalized_model)
+            else:
+                if not token_entry and expired:
+                    # 本地判定失效但上游仍有额度，提前放回轮询
+                    self.expired_tokens.discard(expired)
+                    token_entry = {"token": token, "RequestCount": 0, "AddedTime": now, "StartCallTime": None}
+                    model_tokens.append(token_entry)
+                    self.track_model_usage(normalized_model, live=1, pro=normalized_model == "grok-4")
+                if not token_entry:
+                    return False
+                self.track_model_usage(normalized_model, used=used - token_entry["RequestCount"], pro=normalized_model == "grok-4")
+                token_entry["RequestCount"] = used
+                if used == 0:
+                    token_entry["StartCallTime"] = None
+                if status:
+                    was_valid = status["isValid"]
+                    changed = not was_valid or status["totalRequestCount"] != used
+                    status["isValid"] = True
+                    status["invalidatedTime"] = None
+                    status["totalRequestCount"] = used
+                    if changed:
+                        self.publish_status_event("count_changed" if was_valid else "restored", sso, normalized_model)
+            self.mark_status_changed()
+        return True
+
+    def get_daily_usage_info(self):
+        today = self.get_today_key()
+        today_usage = self.daily_usage_total
+        # 计算每日限制：令牌数量 × 每个令牌10次
+        grok4_free_token_count = self.model_usage.get("grok-4-free", {}).get("live", 0)
+        daily_limit = grok4_free_token_count * 10
+        return {
+            "today": today,
+            "grok4Free": {
+                "used": today_usage,
+                "limit": daily_limit,
+                "remaining": max(0, daily_limit - today_usage),
+                "tokenCount": grok4_free_token_count
+            }
+        }
+
+    def get_status_index(self):
+        """按状态版本缓存的令牌索引：每个令牌的有效/失效模型、最早恢复时间、请求总数，以及各模型剩余次数汇总"""
+        version = self.status_version
+        if self._status_index and self._status_index["version"] == version:
+            return self._status_index
+
+        rows = []
+        model_remaining = {model: 0 for model in self.model_config}
+        with self.token_lock:
+            for sso, models in self.token_status_map.items():
+                valid_models = set()
+                invalid_models = set()
+                recovery_times = {}
+                total_requests = 0
+                for model, status in models.items():
+                    if not status:
+                        continue
+                    total_requests += status.get("totalRequestCount", 0)
+                    if status.get("isValid"):
+                        valid_models.add(model)
+                        if model in self.model_config:
+                            model_remaining[model] += self.model_config[model]["RequestFrequency"] - status.get("totalRequestCount", 0)
+                    else:
+                        invalid_models.add(model)
+                        if status.get("invalidatedTime") and model in self.model_config:
+                            recovery_times[model] = status["invalidatedTime"] + self.model_config[model]["ExpirationTime"]
+                rows.append({
+                    "sso": sso,
+                    "key": sso.lower(),
+                    "models": models,
+                    "valid": valid_models,
+                    "invalid": invalid_models,
+                    "recovery": recovery_times,
+                    "nextRecovery": min(recovery_times.values()) if recovery_times else None,
+                    "requests": total_requests
+                })
+        daily_remaining = self.get_daily_usage_info()["grok4Free"]["remaining"]
+        model_remaining["grok-4-free"] = min(model_remaining.get("grok-4-free", 0), daily_remaining)
+
+        self._status_index = {
+            "version": version,
+            "rows": rows,
+            "summary": {
+                "totalTokens": len(rows),
+                "modelRemaining": {model: max(0, remaining) for model, remaining in model_remaining.items()}
+            }
+        }
+        return self._status_index
+
+    def query_token_status(self, page=1, page_size=30, search="", status="all", model=None, recover_within=None, sort="added"):
+        """在索引上筛选、排序并分页；status 为 all/active/expired，指定 model 时只看该模型，
+        recover_within（秒）筛选在该时间内恢复的失效令牌，sort 为 added/token/requests/recovery，前缀 - 表示倒序"""
+        index = self.get_status_index()
+        search = search.lower()
+
+        def matches(row):
+            if search and search not in row["key"]:
+                return False
+            if model:
+                if model not in row["models"]:
+                    return False
+                if status == "active" and model not in row["valid"]:
+                    return False
+                if status == "expired" and model not in row["invalid"]:
+                    return False
+            else:
+                if status == "active" and not row["valid"]:
+                    return False
+                if status == "expired" and not row["invalid"]:
+                    return False
+            if recover_within is not None:
+                recovery = row["recovery"].get(model) if model else row["nextRecovery"]
+                if recovery is None or recovery > int(time.time() * 1000) + recover_within * 1000:
+                    return False
+            return True
+
+        rows = [row for row in index["rows"] if matches(row)]
+        descending = sort.startswith("-")
+        sort_field = sort.lstrip("-")
+        if sort_field == "requests":
+            rows.sort(key=lambda row: row["requests"], reverse=descending)
+        elif sort_field == "recovery":
+            # 没有恢复时间的令牌始终排在最后
+            direction = -1 if descending else 1
+            rows.sort(key=lambda row: (row["nextRecovery"] is None, direction * (row["nextRecovery"] or 0)))
+        elif sort_field == "token":
+            rows.sort(key=lambda row: row["key"], reverse=descending)
+        elif descending:
+            rows.reverse()
+
+        total = len(rows)
+        total_pages = max(1, -(-total // page_size))
+        page = min(max(1, page), total_pages)
+        start = (page - 1) * page_size
+        return {
+            "items": [{"sso": row["sso"], "models": row["models"]} for row in rows[start:start + page_size]],
+            "total": total,
+            "page": page,
+            "pageSize": page_size,
+            "totalPages": total_pages,
+            "version": index["version"],
+            "summary": index["summary"]
+        }
+
     def remove_token_for_model(self, model_id, token):
         """通用的令牌移除方法，根据模型类型选择合适的移除方式"""
         normalized_model = self.normalize_model_name(model_id)
@@ -766,40 +1242,40 @@ class AuthTokenManager:
         else:
             return self.remove_token_from_model(model_id, token)
 
+    def revoke_token_for_model(self, model_id, token):
+        """移除被上游拒绝的令牌：不进入 expired_tokens，定时任务不会自动恢复，状态标记为无效且无恢复时间"""
+        normalized_model = self.normalize_model_name(model_id)
+        sso = token.split("sso=")[1].split(";")[0]
+        with self.token_lock:
+            model_tokens = self.get_token_array_for_model(normalized_model)
+            token_entry = next((entry for entry in model_tokens if entry["token"] == token), None)
+            if token_entry:
+                model_tokens.remove(token_entry)
+                self.track_model_usage(normalized_model, live=-1, used=-token_entry["RequestCount"], pro=normalized_model == "grok-4")
+            self.expired_tokens = {item for item in self.expired_tokens if item[:2] != (token, normalized_model)}
+            status = self.token_status_map.get(sso, {}).get(normalized_model)
+            if status:
+                status["isValid"] = False
+                status["invalidatedTime"] = None
+                self.publish_status_event("invalidated", sso, normalized_model)
+            self.mark_status_changed()
+        logger.info(f"模型{model_id}的令牌已被上游拒绝，已移出轮询: {token}", "TokenManager")
+        return token_entry is not None
+
 class Utils:
     # 代理池配置
     _proxy_pool = []
     _proxy_index = 0
     _proxy_lock = None
 
-    @staticmethod
-    def is_network_error(error):
-        """判断是否为网络连接错误，这类错误不应该移除令牌"""
-        error_str = str(error).lower()
-        network_error_keywords = [
-            'curl: (18)',  # curl数据传输过早结束
-            'curl: (6)',   # 无法解析主机
-            'curl: (7)',   # 连接失败
-            'curl: (28)',  # 操作超时
-            'curl: (35)',  # SSL连接错误
-            'curl: (52)',  # 服务器返回空回复
-            'curl: (56)',  # 接收网络数据失败
-            'connection timeout',
-            'connection reset',
-            'network unreachable',
-            'timeout',
-            'connection refused',
-            'connection aborted'
-        ]
-        return any(keyword in error_str for keyword in network_error_keywords)
-    
     @staticmethod
     def init_proxy_pool():
         """初始化代理池"""
-        import threading
-        Utils._proxy_lock = threading.Lock()
-        
-        proxy_env = os.environ.get("PROXY")
+        Utils._proxy_lock = Utils._proxy_lock or threading.Lock()
+        Utils._proxy_pool = []
+        Utils._proxy_index = 0
+
+        proxy_env = CONFIG["API"]["PROXY"]
         if proxy_env:
             if ',' in proxy_env:
                 # 多个代理，逗号分隔
@@ -831,31 +1307,88 @@ class Utils:
             logger.info(f"使用代理 {current_index + 1}/{len(Utils._proxy_pool)}: {proxy[:30]}...", "ProxyPool")
             return proxy
 
+    @staticmethod
+    def get_model_fallback_chain(model):
+        """根据 MODEL_FALLBACK 配置返回模型的回退链（不含模型自身）"""
+        chains = {}
+        for chain in CONFIG["MODEL_FALLBACK"].split(','):
+            models = [m.strip() for m in chain.split('>') if m.strip() in CONFIG["MODELS"]]
+            for index, name in enumerate(models):
+                chains.setdefault(name, models[index + 1:])
+        return chains.get(model, [])
+
+    @staticmethod
+    def get_upstream_timeouts(model, config=None):
+        """返回模型的分阶段超时：CONNECT、FIRST_LINE、IDLE、TOTAL（秒）"""
+        config = (config or CONFIG)["UPSTREAM_TIMEOUT"]
+        timeouts = {phase: config[phase] for phase in ("CONNECT", "FIRST_LINE", "IDLE", "TOTAL")}
+        for item in config["MODELS"].split(','):
+            name, _, values = item.partition('=')
+            if name.strip() == model:
+                for phase, value in zip(("FIRST_LINE", "IDLE", "TOTAL"), values.split('/')):
+                    if value.strip():
+                        timeouts[phase] = float(value)
+                break
+        return timeouts
+
+    @staticmethod
+    def get_stream_curl_options(timeouts):
+        """libcurl 层面的兜底超时，保证放弃读取后上游连接最终也会断开"""
+        return {
+            CurlOpt.CONNECTTIMEOUT_MS: int(timeouts["CONNECT"] * 1000),
+            CurlOpt.LOW_SPEED_LIMIT: 1,
+            CurlOpt.LOW_SPEED_TIME: math.ceil(max(timeouts["FIRST_LINE"], timeouts["IDLE"])),
+            CurlOpt.TIMEOUT_MS: int((timeouts["CONNECT"] + timeouts["TOTAL"]) * 1000)
+        }
+
+    @staticmethod
+    def get_transfer_timeout(config=None):
+        """非流式传输的 (连接, 读取) 超时"""
+        config = config or CONFIG
+        return config["UPSTREAM_TIMEOUT"]["CONNECT"], config["UPSTREAM_TIMEOUT"]["TRANSFER"]
+
+    @staticmethod
+    def resolve_available_model(model):
+        """按回退链选择第一个仍有容量的模型，全部耗尽时返回 None"""
+        for candidate in [model] + Utils.get_model_fallback_chain(model):
+            if token_manager.has_available_capacity(candidate):
+                return candidate
+        return None
+
     @staticmethod
     def organize_search_results(search_results):
         if not search_results or 'results' not in search_results:
             return ''
 
-        results = search_results['results']
-        formatted_results = []
-
-        for index, result in enumerate(results):
-            title = result.get('title', '未知标题')
-            url = result.get('url', '#')
-            preview = result.get('preview', '无预览内容')
+        return '\n\n'.join(
+            Utils.format_search_result(Utils.normalize_search_result(index, result))
+            for index, result in enumerate(search_results['results'])
+        )
 
-            formatted_result = f"\r\n<details><summary>资料[{index}]: {title}</summary>\r\n{preview}\r\n\n[Link]({url})\r\n</details>"
-            formatted_results.append(formatted_result)
+    @staticmethod
+    def normalize_search_result(index, result):
+        preview = result.get('preview', '无预览内容')
+        max_chars = CONFIG["SEARCH_RESULTS"]["PREVIEW_MAX_CHARS"]
+        if max_chars and len(preview) > max_chars:
+            preview = preview[:max_chars] + "…"
+        return {
+            "index": index,
+            "title": result.get('title', '未知标题'),
+            "url": result.get('url', '#'),
+            "preview": preview
+        }
 
-        return '\n\n'.join(formatted_results)
+    @staticmethod
+    def format_search_result(result):
+        return f"\r\n<details><summary>资料[{result['index']}]: {result['title']}</summary>\r\n{result['preview']}\r\n\n[Link]({result['url']})\r\n</details>"
 
     @staticmethod
-    def create_auth_headers(model, is_return=False):
-        return token_manager.get_next_token_for_model(model, is_return)
+    def create_auth_headers(model, is_return=False, exclude_tokens=None, prefer_token=None):
+        return token_manager.get_next_token_for_model(model, is_return, exclude_tokens, prefer_token)
 
     @staticmethod
-    def get_proxy_options():
-        proxy = Utils.get_next_proxy()
+    def get_proxy_options(proxy=None):
+        proxy = proxy or Utils.get_next_proxy()
         proxy_options = {}
 
         if proxy:
@@ -891,7 +1424,7 @@ class Utils:
         try:
             proxy_options = Utils.get_proxy_options_for_requests()
             response = requests.get(
-                "https://rui.soundai.ee/x.php",
+                CONFIG["API"]["STATSIG_URL"],
                 timeout=10,
                 **proxy_options
             )
@@ -912,97 +1445,735 @@ class Utils:
             logger.error(f"获取 x-statsig-id 异常: {str(error)}", "Server")
             return None
 
-class GrokApiClient:
-    def __init__(self, model_id):
-        if model_id not in CONFIG["MODELS"]:
-            raise ValueError(f"不支持的模型: {model_id}")
-        self.model_id = CONFIG["MODELS"][model_id]
-
-    def process_message_content(self, content):
-        if isinstance(content, str):
-            return content
-        return None
-
-    def get_image_type(self, base64_string):
-        mime_type = 'image/jpeg'
-        if 'data:image' in base64_string:
-            import re
-            matches = re.search(r'data:([a-zA-Z0-9]+\/[a-zA-Z0-9-.+]+);base64,', base64_string)
-            if matches:
-                mime_type = matches.group(1)
-
-        extension = mime_type.split('/')[1]
-        file_name = f"image.{extension}"
+    # 本地模型对应的 /rest/rate-limits 查询参数 (modelName, requestKind)
+    RATE_LIMIT_KINDS = {
+        "grok-2": ("grok-2", "DEFAULT"),
+        "grok-3": ("grok-3", "DEFAULT"),
+        "grok-3-deepsearch": ("grok-3", "DEEPSEARCH"),
+        "grok-3-deepersearch": ("grok-3", "DEEPERSEARCH"),
+        "grok-3-reasoning": ("grok-3", "REASONING"),
+        "grok-4": ("grok-4", "DEFAULT"),
+        "grok-4-free": ("grok-4", "DEFAULT")
+    }
 
-        return {
-            "mimeType": mime_type,
-            "fileName": file_name
+    @staticmethod
+    def probe_token(token, model="grok-3", statsig_id=None):
+        """用 /rest/rate-limits 轻量探测令牌在某个模型上的限额，返回 (状态, 限额信息)。
+        状态为 valid、invalid（上游拒绝该令牌），或 unknown（被盾、网络错误等无法判断）"""
+        model_name, request_kind = Utils.RATE_LIMIT_KINDS.get(model, (model, "DEFAULT"))
+        proxy = proxy_bindings.get_proxy(token)
+        headers = {
+            **DEFAULT_HEADERS,
+            "Cookie": proxy_bindings.get_cookie(token, proxy),
+            "x-xai-request-id": Utils.generate_xai_request_id()
         }
-    def upload_base64_file(self, message, model):
+        if statsig_id:
+            headers["x-statsig-id"] = statsig_id
         try:
-            message_base64 = base64.b64encode(message.encode('utf-8')).decode('utf-8')
-            upload_data = {
-                "fileName": "message.txt",
-                "fileMimeType": "text/plain",
-                "content": message_base64
-            }
-
-            logger.info("发送文字文件请求", "Server")
-            cookie = f"{Utils.create_auth_headers(model, True)};{CONFIG['SERVER']['CF_CLEARANCE']}" 
-            proxy_options = Utils.get_proxy_options()
             response = curl_requests.post(
-                "https://grok.com/rest/app-chat/upload-file",
-                headers={
-                    **DEFAULT_HEADERS,
-                    "Cookie":cookie
-                },
-                json=upload_data,
-                impersonate="chrome133a",
-                **proxy_options
-            )
-
-            if response.status_code != 200:
-                logger.error(f"上传文件失败,状态码:{response.status_code}", "Server")
-                raise Exception(f"上传文件失败,状态码:{response.status_code}")
+                f"{CONFIG['API']['BASE_URL']}/rest/rate-limits",
+                headers=headers,
+                data=json.dumps({"requestKind": request_kind, "modelName": model_name}),
+                impersonate=CONFIG["API"]["IMPERSONATE"],
+                timeout=CONFIG["TOKEN_PROBE"]["TIMEOUT"],
+                **Utils.get_proxy_options(proxy))
+        except Exception as error:
+            logger.warning(f"令牌探测失败: {str(error)}", "TokenProbe")
+            return "unknown", None
 
-            result = response.json()
-            logger.info(f"上传文件成功: {result}", "Server")
-            return result.get("fileMetadataId", "")
+        if response.status_code == 200:
+            try:
+                return "valid", response.json()
+            except ValueError:
+                return "valid", None
+        # 403 返回 HTML 时是 Cloudflare 盾，与令牌本身无关
+        is_shield = response.status_code == 403 and "text/html" in response.headers.get("Content-Type", "")
+        if response.status_code in (401, 403) and not is_shield:
+            return "invalid", None
+        return "unknown", None
+
+class ProxyBindingTable:
+    """令牌与代理的绑定表：每个令牌按 rendezvous 哈希固定使用同一代理，每个代理使用各自的 cf_clearance；
+    代理连续失败时暂停使用，绑定在其上的令牌迁移到其他代理"""
+    MAX_BINDINGS = 10000
 
-        except Exception as error:
-            logger.error(str(error), "Server")
-            raise Exception(f"上传文件失败,状态码:{response.status_code}")
-    def upload_base64_image(self, base64_data, url):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.bindings = OrderedDict()  # 令牌 -> 代理
+        self.failures = {}  # 代理 -> 连续失败次数
+        self.disabled_until = {}  # 代理 -> 恢复时间
+        self.pair_disabled_until = {}  # (令牌, 代理) -> 恢复时间
+        self.clearances = {}  # 代理 -> cf_clearance
+        self.load_clearances()
+
+    def load_clearances(self):
         try:
-            if 'data:image' in base64_data:
-                image_buffer = base64_data.split(',')[1]
-            else:
-                image_buffer = base64_data
+            if Path(CONFIG["PROXY_AFFINITY"]["CLEARANCE_FILE"]).exists():
+                with open(CONFIG["PROXY_AFFINITY"]["CLEARANCE_FILE"], 'r', encoding='utf-8') as f:
+                    self.clearances = json.load(f)
+        except Exception as error:
+            logger.error(f"加载代理 cf_clearance 失败: {str(error)}", "ProxyPool")
 
-            image_info = self.get_image_type(base64_data)
-            mime_type = image_info["mimeType"]
-            file_name = image_info["fileName"]
+    def save_clearances(self):
+        try:
+            with open(CONFIG["PROXY_AFFINITY"]["CLEARANCE_FILE"], 'w', encoding='utf-8') as f:
+                json.dump(self.clearances, f, indent=2)
+        except Exception as error:
+            logger.error(f"保存代理 cf_clearance 失败: {str(error)}", "ProxyPool")
+
+    def resolve_proxy(self, proxy):
+        """按代理地址或从 1 开始的序号查找代理"""
+        pool = Utils._proxy_pool
+        if isinstance(proxy, int) or str(proxy).isdigit():
+            index = int(proxy) - 1
+            return pool[index] if 0 <= index < len(pool) else None
+        return proxy if proxy in pool else None
+
+    def set_clearance(self, proxy, cf_clearance):
+        with self._lock:
+            self.clearances[proxy] = cf_clearance
+        self.save_clearances()
+
+    def _is_available(self, token, proxy, now):
+        return (
+            self.disabled_until.get(proxy, 0) <= now
+            and self.pair_disabled_until.get((token, proxy), 0) <= now
+            and not shield_breakers.get(proxy).is_blocking(now)
+        )
 
-            upload_data = {
-                "rpc": "uploadFile",
-                "req": {
-                    "fileName": file_name,
-                    "fileMimeType": mime_type,
-                    "content": image_buffer
+    def get_proxy(self, token):
+        """返回令牌绑定的代理，未绑定或代理不可用时重新绑定"""
+        pool = Utils._proxy_pool
+        if not pool or not token or not CONFIG["PROXY_AFFINITY"]["ENABLED"]:
+            return Utils.get_next_proxy()
+
+        now = time.time()
+        with self._lock:
+            proxy = self.bindings.get(token)
+            if proxy in pool and self._is_available(token, proxy, now):
+                self.bindings.move_to_end(token)
+                return proxy
+
+            ranked = sorted(pool, key=lambda candidate: hashlib.sha256(f"{token}|{candidate}".encode('utf-8')).digest(), reverse=True)
+            new_proxy = next((candidate for candidate in ranked if self._is_available(token, candidate, now)), ranked[0])
+            if proxy and proxy != new_proxy:
+                logger.info(f"令牌迁移到代理 {pool.index(new_proxy) + 1}/{len(pool)}", "ProxyPool")
+            self.bindings[token] = new_proxy
+            self.bindings.move_to_end(token)
+            while len(self.bindings) > self.MAX_BINDINGS:
+                self.bindings.popitem(last=False)
+            return new_proxy
+
+    def get_cookie(self, token, proxy):
+        """拼接令牌与代理对应的 cf_clearance，代理未单独设置时使用全局 CF_CLEARANCE"""
+        cf_clearance = self.clearances.get(proxy) if proxy else None
+        cf_clearance = cf_clearance or CONFIG['SERVER']['CF_CLEARANCE']
+        return f"{token};{cf_clearance}" if cf_clearance else token
+
+    def report_success(self, proxy):
+        if proxy:
+            with self._lock:
+                self.failures[proxy] = 0
+
+    def report_failure(self, token, proxy, rebind=True):
+        """记录失败：rebind 时该令牌暂时换用其他代理，代理连续失败达到上限后暂停使用"""
+        if not proxy or not CONFIG["PROXY_AFFINITY"]["ENABLED"]:
+            return
+        now = time.time()
+        cooldown = CONFIG["PROXY_AFFINITY"]["COOLDOWN"]
+        with self._lock:
+            if rebind:
+                if len(self.pair_disabled_until) > self.MAX_BINDINGS:
+                    self.pair_disabled_until = {pair: until for pair, until in self.pair_disabled_until.items() if until > now}
+                self.pair_disabled_until[(token, proxy)] = now + cooldown
+            self.failures[proxy] = self.failures.get(proxy, 0) + 1
+            if self.failures[proxy] >= CONFIG["PROXY_AFFINITY"]["MAX_FAILURES"]:
+                self.failures[proxy] = 0
+                self.disabled_until[proxy] = now + cooldown
+                logger.warning(f"代理连续失败，暂停使用 {cooldown} 秒: {proxy[:30]}...", "ProxyPool")
+
+    def get_status(self):
+        now = time.time()
+        with self._lock:
+            bound_counts = {}
+            for proxy in self.bindings.values():
+                bound_counts[proxy] = bound_counts.get(proxy, 0) + 1
+            return [
+                {
+                    "index": index + 1,
+                    "proxy": proxy[:20] + "..." if len(proxy) > 20 else proxy,
+                    "available": self.disabled_until.get(proxy, 0) <= now,
+                    "failures": self.failures.get(proxy, 0),
+                    "boundTokens": bound_counts.get(proxy, 0),
+                    "hasClearance": bool(self.clearances.get(proxy)),
+                    "breaker": shield_breakers.get(proxy).state
                 }
-            }
+                for index, proxy in enumerate(Utils._proxy_pool)
+            ]
+
+class CircuitBreaker:
+    """403 盾熔断器：closed 正常放行；window 秒内失败 threshold 次后 open 并快速失败；
+    open_seconds 秒后进入 half_open，只放行一个探测请求，成功则恢复，失败则重新熔断"""
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, threshold_key):
+        self.name = name
+        self.threshold_key = threshold_key
+        self.state = self.CLOSED
+        self.failures = deque()
+        self.opened_at = 0
+        self.probe_started_at = None
+        self.open_count = 0
+
+    def is_blocking(self, now=None):
+        """不消耗探测名额地判断当前是否会拒绝请求"""
+        now = now or time.time()
+        open_seconds = CONFIG["SHIELD_BREAKER"]["OPEN_SECONDS"]
+        if self.state == self.OPEN:
+            return now - self.opened_at < open_seconds
+        if self.state == self.HALF_OPEN:
+            # 探测请求长时间没有结果时允许重新探测
+            return self.probe_started_at is not None and now - self.probe_started_at < open_seconds
+        return False
 
-            logger.info("发送图片请求", "Server")
+    def allow(self, now):
+        if self.is_blocking(now):
+            return False
+        if self.state != self.CLOSED:
+            self.state = self.HALF_OPEN
+            self.probe_started_at = now
+        return True
 
-            proxy_options = Utils.get_proxy_options()
-            response = curl_requests.post(
-                url,
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info(f"熔断器 {self.name} 探测成功，恢复放行", "ShieldBreaker")
+        self.state = self.CLOSED
+        self.failures.clear()
+        self.probe_started_at = None
+
+    def record_failure(self, now):
+        if self.state == self.HALF_OPEN:
+            self.trip(now)
+            return
+        self.failures.append(now)
+        while self.failures and now - self.failures[0] > CONFIG["SHIELD_BREAKER"]["WINDOW"]:
+            self.failures.popleft()
+        if self.state == self.CLOSED and len(self.failures) >= CONFIG["SHIELD_BREAKER"][self.threshold_key]:
+            self.trip(now)
+
+    def release(self):
+        """探测请求以非 403 的结果结束（网络错误、429 等）时归还探测名额"""
+        self.probe_started_at = None
+
+    def trip(self, now):
+        self.state = self.OPEN
+        self.opened_at = now
+        self.probe_started_at = None
+        self.failures.clear()
+        self.open_count += 1
+        logger.warning(f"熔断器 {self.name} 连续遇到 403 盾，熔断 {CONFIG['SHIELD_BREAKER']['OPEN_SECONDS']} 秒", "ShieldBreaker")
+
+    def get_status(self):
+        return {
+            "state": self.state,
+            "recentFailures": len(self.failures),
+            "openedAt": int(self.opened_at * 1000) if self.opened_at else None,
+            "openCount": self.open_count
+        }
+
+class ShieldBreakerRegistry:
+    """全局与每个代理各一个熔断器；未配置代理时只使用全局熔断器"""
+    DIRECT = "direct"
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.global_breaker = CircuitBreaker("global", "GLOBAL_THRESHOLD")
+        self.proxy_breakers = {}
+
+    def get(self, proxy):
+        if not proxy:
+            return self.global_breaker
+        breaker = self.proxy_breakers.get(proxy)
+        if breaker is None:
+            with self._lock:
+                name = f"proxy {Utils._proxy_pool.index(proxy) + 1}" if proxy in Utils._proxy_pool else "proxy"
+                breaker = self.proxy_breakers.setdefault(proxy, CircuitBreaker(name, "THRESHOLD"))
+        return breaker
+
+    def _breakers(self, proxy):
+        return [self.global_breaker] if not proxy else [self.global_breaker, self.get(proxy)]
+
+    def global_open(self):
+        return CONFIG["SHIELD_BREAKER"]["ENABLED"] and self.global_breaker.is_blocking()
+
+    def allow(self, proxy):
+        """全局与代理熔断器都放行时返回 True，half_open 时占用探测名额"""
+        if not CONFIG["SHIELD_BREAKER"]["ENABLED"]:
+            return True
+        now = time.time()
+        with self._lock:
+            breakers = self._breakers(proxy)
+            if any(breaker.is_blocking(now) for breaker in breakers):
+                return False
+            for breaker in breakers:
+                breaker.allow(now)
+            return True
+
+    def record_success(self, proxy):
+        with self._lock:
+            for breaker in self._breakers(proxy):
+                breaker.record_success()
+
+    def record_shield(self, proxy):
+        if not CONFIG["SHIELD_BREAKER"]["ENABLED"]:
+            return
+        now = time.time()
+        with self._lock:
+            for breaker in self._breakers(proxy):
+                breaker.record_failure(now)
+
+    def release(self, proxy):
+        with self._lock:
+            for breaker in self._breakers(proxy):
+                breaker.release()
+
+    def count_blocking_proxies(self):
+        """当前拒绝请求的代理数"""
+        now = time.time()
+        with self._lock:
+            return sum(1 for proxy in Utils._proxy_pool if proxy in self.proxy_breakers and self.proxy_breakers[proxy].is_blocking(now))
+
+    def get_status(self):
+        with self._lock:
+            return {
+                "enabled": CONFIG["SHIELD_BREAKER"]["ENABLED"],
+                "global": self.global_breaker.get_status(),
+                "proxies": [
+                    {"index": index + 1, **self.proxy_breakers[proxy].get_status()}
+                    for index, proxy in enumerate(Utils._proxy_pool)
+                    if proxy in self.proxy_breakers
+                ]
+            }
+
+class ShieldOpenError(ValueError):
+    """熔断期间快速失败"""
+    status_code = 503
+
+proxy_bindings = ProxyBindingTable()
+shield_breakers = ShieldBreakerRegistry()
+
+class UpstreamErrorClassifier:
+    """上游错误分类：按 curl 错误码、异常类型、HTTP 状态码与响应体特征归类，并映射到处理动作"""
+    # 退还次数后沿用同一令牌重试
+    RETRY_SAME_TOKEN = "retry_same_token"
+    # 退还次数后沿用同一令牌，换用其他代理重试
+    ROTATE_PROXY = "rotate_proxy"
+    # 移除当前令牌，换下一个令牌重试
+    ROTATE_TOKEN = "rotate_token"
+    # 不再重试，直接返回错误
+    FAIL_FAST = "fail_fast"
+
+    # 分类 -> (动作, 是否退还次数)
+    CLASSES = {
+        "network": (RETRY_SAME_TOKEN, True),
+        "timeout": (RETRY_SAME_TOKEN, True),
+        "upstream_unavailable": (RETRY_SAME_TOKEN, True),
+        "proxy": (ROTATE_PROXY, True),
+        "tls": (ROTATE_PROXY, True),
+        "shield": (ROTATE_PROXY, True),
+        "rate_limited": (ROTATE_TOKEN, True),
+        "unauthorized": (ROTATE_TOKEN, False),
+        "upstream_error": (ROTATE_TOKEN, False),
+        "bad_request": (FAIL_FAST, True),
+        "config": (FAIL_FAST, True),
+        "internal": (FAIL_FAST, True),
+    }
+
+    # CURLE 错误码 -> 分类，未列出的 curl 错误按网络错误处理
+    CURL_CODE_CLASSES = {
+        **dict.fromkeys((5, 97), "proxy"),
+        **dict.fromkeys((6, 7, 16, 18, 52, 55, 56, 89, 92), "network"),
+        28: "timeout",
+        **dict.fromkeys((35, 58, 60, 77, 83, 90, 91), "tls"),
+        **dict.fromkeys((1, 3, 43, 48, 49), "config"),
+    }
+
+    SHIELD_MARKERS = ("just a moment", "cf-chl", "challenge-platform", "cf_chl")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(self.CLASSES, 0)
+
+    def classify_exception(self, error, proxy=None):
+        error_class = getattr(error, "error_class", None)
+        if error_class in self.CLASSES:
+            return error_class
+        if isinstance(error, curl_requests.exceptions.ProxyError):
+            return "proxy"
+        code = getattr(error, "code", None)
+        if isinstance(code, int) and isinstance(error, curl_requests.exceptions.CurlError):
+            # 经代理建立连接失败同样返回 CURLE_COULDNT_CONNECT
+            if code == 7 and proxy:
+                return "proxy"
+            return self.CURL_CODE_CLASSES.get(code, "network")
+        if isinstance(error, (TimeoutError, requests.Timeout)):
+            return "timeout"
+        if isinstance(error, (ConnectionError, requests.RequestException)):
+            return "network"
+        return "internal"
+
+    def classify_response(self, status_code, content_type="", body=""):
+        if status_code == 403:
+            if "text/html" in content_type or any(marker in body.lower() for marker in self.SHIELD_MARKERS):
+                return "shield"
+            return "unauthorized"
+        if status_code == 401:
+            return "unauthorized"
+        if status_code == 429:
+            return "rate_limited"
+        if status_code in (502, 503, 504):
+            return "upstream_unavailable"
+        if status_code in (400, 404, 413, 422):
+            return "bad_request"
+        return "upstream_error"
+
+    def record(self, error_class):
+        """计数并返回 (动作, 是否退还次数)"""
+        with self._lock:
+            self.counters[error_class] += 1
+        return self.CLASSES[error_class]
+
+    def get_status(self):
+        with self._lock:
+            counters = dict(self.counters)
+        return {
+            error_class: {"count": counters[error_class], "action": action, "refund": refund}
+            for error_class, (action, refund) in self.CLASSES.items()
+        }
+
+class UpstreamResponseError(ValueError):
+    """上游返回非 200 状态，携带分类结果"""
+    def __init__(self, message, status_code, error_class):
+        super().__init__(message)
+        self.status_code = status_code
+        self.error_class = error_class
+
+upstream_errors = UpstreamErrorClassifier()
+
+class StatsigPool:
+    """后台预取 x-statsig-id：请求直接从池中取用，池空或未启用时退回现取"""
+    def __init__(self):
+        self._ids = deque()
+        self._condition = threading.Condition()
+        self._thread = None
+        self.stats = {"hits": 0, "misses": 0, "fetched": 0, "failures": 0, "expired": 0}
+
+    def start(self):
+        if CONFIG["STATSIG_POOL"]["SIZE"] <= 0 or self._thread:
+            return
+        self._thread = threading.Thread(target=self.run, name="statsig-pool", daemon=True)
+        self._thread.start()
+        logger.info(f"x-statsig-id 预取已启动，池大小 {CONFIG['STATSIG_POOL']['SIZE']}", "Server")
+
+    def _discard_expired(self, now):
+        while self._ids and now - self._ids[0][1] > CONFIG["STATSIG_POOL"]["TTL"]:
+            self._ids.popleft()
+            self.stats["expired"] += 1
+
+    def depth(self):
+        """池中可用的 ID 数量，未启用时为 None"""
+        if not self._thread:
+            return None
+        with self._condition:
+            self._discard_expired(time.time())
+            return len(self._ids)
+
+    def get(self):
+        with self._condition:
+            self._discard_expired(time.time())
+            if self._ids:
+                self.stats["hits"] += 1
+                self._condition.notify()
+                return self._ids.popleft()[0]
+            if self._thread:
+                self.stats["misses"] += 1
+        return Utils.get_statsig_id()
+
+    def run(self):
+        backoff = 1
+        while True:
+            with self._condition:
+                self._discard_expired(time.time())
+                while len(self._ids) >= CONFIG["STATSIG_POOL"]["SIZE"]:
+                    # 等待被取用或最早的 ID 过期
+                    timeout = self._ids[0][1] + CONFIG["STATSIG_POOL"]["TTL"] - time.time() if self._ids else None
+                    self._condition.wait(None if timeout is None else max(timeout, 0.1))
+                    self._discard_expired(time.time())
+            statsig_id = Utils.get_statsig_id()
+            if statsig_id:
+                with self._condition:
+                    self._ids.append((statsig_id, time.time()))
+                    self.stats["fetched"] += 1
+                backoff = 1
+            else:
+                self.stats["failures"] += 1
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+
+    def get_status(self):
+        return {"enabled": self._thread is not None, "size": CONFIG["STATSIG_POOL"]["SIZE"], "depth": self.depth(), **self.stats}
+
+statsig_pool = StatsigPool()
+
+class ImageInputError(ValueError):
+    def __init__(self, message, status_code=413):
+        super().__init__(message)
+        self.status_code = status_code
+
+class ImageInput:
+    """base64 图片输入：按偏移引用原始数据，不切分复制，MIME 类型按文件头识别"""
+    MAGIC_NUMBERS = (
+        (b"\x89PNG\r\n\x1a\n", "image/png"),
+        (b"\xff\xd8\xff", "image/jpeg"),
+        (b"GIF87a", "image/gif"),
+        (b"GIF89a", "image/gif")
+    )
+    INVALID_BASE64 = re.compile(rb"[^A-Za-z0-9+/=]")
+    WHITESPACE = re.compile(rb"[ \t\r\n\f\v]")
+
+    @staticmethod
+    def is_data_url(url):
+        return url.startswith("data:")
+
+    def __init__(self, url):
+        # base64 只含 ASCII 字符，编码为 bytes 后按偏移切片；非 ASCII 字符替换为 ? 后在校验时拒绝
+        self.data = url.encode("ascii", "replace")
+        self.start = 0
+        declared_type = None
+        if self.is_data_url(url):
+            comma = self.data.find(b",")
+            header = self.data[5:comma] if comma != -1 else b""
+            self.start = comma + 1
+            if header.endswith(b";base64"):
+                declared_type = header[:-7].decode("ascii") or None
+
+        # 内容会原样写入 JSON 字符串，只允许 base64 字符；换行等空白只在出现时复制一次去除
+        invalid = self.INVALID_BASE64.search(self.data, self.start)
+        if invalid and self.WHITESPACE.match(self.data, invalid.start()):
+            self.data = self.WHITESPACE.sub(b"", self.data[self.start:])
+            self.start = 0
+            invalid = self.INVALID_BASE64.search(self.data)
+        if invalid:
+            raise ImageInputError("图片数据不是有效的 base64", 400)
+        if self.size > CONFIG["IMAGE"]["MAX_SIZE"]:
+            raise ImageInputError(f"图片大小超过限制: {self.size} > {CONFIG['IMAGE']['MAX_SIZE']} 字节")
+        self.mime_type = self.sniff_mime_type() or declared_type or "image/jpeg"
+
+    @property
+    def payload(self):
+        return memoryview(self.data)[self.start:]
+
+    def replace_payload(self, data, mime_type):
+        self.data = data
+        self.start = 0
+        self.mime_type = mime_type
+
+    @property
+    def size(self):
+        """解码后的字节数"""
+        length = len(self.data) - self.start
+        padding = self.data.count(b"=", max(self.start, len(self.data) - 2))
+        return length * 3 // 4 - padding
+
+    @property
+    def file_name(self):
+        return f"image.{self.mime_type.split('/')[1]}"
+
+    def sniff_mime_type(self):
+        try:
+            head = base64.b64decode(self.data[self.start:self.start + 16])
+        except ValueError:
+            return None
+        for magic, mime_type in self.MAGIC_NUMBERS:
+            if head.startswith(magic):
+                return mime_type
+        if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+            return "image/webp"
+        return None
+
+    def build_upload_body(self):
+        """拼接 uploadFile 请求体，base64 内容直接从原始数据切片写入"""
+        prefix, suffix = json.dumps({
+            "rpc": "uploadFile",
+            "req": {
+                "fileName": self.file_name,
+                "fileMimeType": self.mime_type,
+                "content": ""
+            }
+        }).encode("utf-8").split(b'"content": ""')
+        return b"".join((prefix, b'"content": "', self.payload, b'"', suffix))
+
+class ImageDownscaler:
+    """上传前的图片缩小：在进程池中执行，按内容哈希缓存结果，并统计节省的字节数"""
+    def __init__(self):
+        self._executor = None
+        self._cache = OrderedDict()  # sha256 -> (base64 数据, MIME 类型) 或 None
+        self._lock = threading.Lock()
+        self.stats = {"images": 0, "downscaled": 0, "cache_hits": 0, "bytes_in": 0, "bytes_out": 0}
+
+    def start(self):
+        """在 main() 中其他线程启动前创建进程池，以 fork 一次性启动全部工作进程"""
+        if not CONFIG["IMAGE"]["DOWNSCALE"] or "fork" not in multiprocessing.get_all_start_methods():
+            return
+        with self._lock:
+            self._executor = ProcessPoolExecutor(
+                max_workers=CONFIG["IMAGE"]["DOWNSCALE_WORKERS"], mp_context=multiprocessing.get_context("fork")
+            )
+        self._executor.submit(int).result()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # 未经 main() 预先创建（作为模块导入或运行中开启）时，不在多线程进程中直接 fork
+                method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+                self._executor = ProcessPoolExecutor(
+                    max_workers=CONFIG["IMAGE"]["DOWNSCALE_WORKERS"], mp_context=multiprocessing.get_context(method)
+                )
+            return self._executor
+
+    def process(self, image):
+        """返回处理后的 ImageInput，Pillow 不可用或处理失败时原样返回"""
+        key = hashlib.sha256(image.payload).hexdigest()
+        with self._lock:
+            cached = key in self._cache
+            if cached:
+                self._cache.move_to_end(key)
+                result = self._cache[key]
+                self.stats["cache_hits"] += 1
+
+        if not cached:
+            try:
+                result = self._get_executor().submit(
+                    downscale_image, bytes(image.payload), CONFIG["IMAGE"]["MAX_DIMENSION"], CONFIG["IMAGE"]["JPEG_QUALITY"]
+                ).result()
+            except ImportError:
+                logger.warning("未安装 Pillow，已关闭图片缩小", "ImageDownscaler")
+                CONFIG["IMAGE"]["DOWNSCALE"] = False
+                return image
+            except Exception as error:
+                logger.warning(f"图片缩小失败，使用原图上传: {str(error)}", "ImageDownscaler")
+                return image
+            with self._lock:
+                self._cache[key] = result
+                while len(self._cache) > CONFIG["IMAGE"]["CACHE_SIZE"]:
+                    self._cache.popitem(last=False)
+
+        size_in = image.size
+        if result:
+            image.replace_payload(*result)
+        with self._lock:
+            self.stats["images"] += 1
+            self.stats["downscaled"] += 1 if result else 0
+            self.stats["bytes_in"] += size_in
+            self.stats["bytes_out"] += image.size
+        if result:
+            logger.info(
+                f"图片已缩小: {size_in} -> {image.size} 字节，累计节省 {self.stats['bytes_in'] - self.stats['bytes_out']} 字节",
+                "ImageDownscaler"
+            )
+        return image
+
+image_downscaler = ImageDownscaler()
+
+class ChatRequestPayload(dict):
+    """上游对话请求体；attachments 为待上传的 (类型, 内容) 列表，选定令牌后再上传并填入 fileAttachments"""
+    def __init__(self, payload, attachments=()):
+        super().__init__(payload)
+        self.attachments = list(attachments)
+
+class GrokApiClient:
+    def __init__(self, model_id, config=None):
+        # 同一请求内使用同一份配置快照，处理过程中热加载不影响该请求
+        self.config = config or CONFIG
+        if model_id not in self.config["MODELS"]:
+            raise ValueError(f"不支持的模型: {model_id}")
+        self.model_id = self.config["MODELS"][model_id]
+        self.response_parser_class = RESPONSE_PARSERS.get(model_id, ResponseParser)
+
+    def create_response_parser(self):
+        return self.response_parser_class()
+
+    def process_message_content(self, content):
+        if isinstance(content, str):
+            return content
+        return None
+
+    def upload_base64_file(self, message, token, proxy):
+        try:
+            message_base64 = base64.b64encode(message.encode('utf-8')).decode('utf-8')
+            upload_data = {
+                "fileName": "message.txt",
+                "fileMimeType": "text/plain",
+                "content": message_base64
+            }
+
+            logger.info("发送文字文件请求", "Server")
+            cookie = proxy_bindings.get_cookie(token, proxy)
+            proxy_options = Utils.get_proxy_options(proxy)
+            response = curl_requests.post(
+                f"{self.config['API']['BASE_URL']}/rest/app-chat/upload-file",
                 headers={
                     **DEFAULT_HEADERS,
-                    "Cookie":CONFIG["SERVER"]['COOKIE']
+                    "Cookie":cookie
                 },
                 json=upload_data,
-                impersonate="chrome133a",
+                impersonate=self.config["API"]["IMPERSONATE"],
+                timeout=Utils.get_transfer_timeout(self.config),
+                **proxy_options
+            )
+
+            if response.status_code != 200:
+                logger.error(f"上传文件失败,状态码:{response.status_code}", "Server")
+                raise Exception(f"上传文件失败,状态码:{response.status_code}")
+
+            result = response.json()
+            logger.info(f"上传文件成功: {result}", "Server")
+            return result.get("fileMetadataId", "")
+
+        except Exception as error:
+            logger.error(str(error), "Server")
+            raise Exception(f"上传文件失败,状态码:{response.status_code}")
+    def load_image(self, base64_data):
+        """解析消息中的图片，不发起网络请求；http 图片地址等不是 base64 的输入返回 None"""
+        try:
+            image = ImageInput(base64_data)
+        except ImageInputError as error:
+            # 只有 data URL 的内容无效时返回 400；http 图片地址等不是 base64 的输入与之前一样跳过上传
+            if error.status_code != 400 or ImageInput.is_data_url(base64_data):
+                raise
+            logger.warning(f"图片不是 data URL 或 base64 数据，已跳过上传: {base64_data[:100]}", "Server")
+            return None
+        if self.config["IMAGE"]["DOWNSCALE"]:
+            image = image_downscaler.process(image)
+        return image
+    def upload_base64_image(self, image, url, token, proxy):
+        try:
+            upload_body = image.build_upload_body()
+            logger.info(f"发送图片请求: {image.mime_type}, {image.size} 字节", "Server")
+
+            cookie = proxy_bindings.get_cookie(token, proxy)
+            proxy_options = Utils.get_proxy_options(proxy)
+            response = curl_requests.post(
+                url,
+                headers={
+                    **DEFAULT_HEADERS,
+                    "Cookie":cookie
+                },
+                data=upload_body,
+                impersonate=self.config["API"]["IMPERSONATE"],
+                timeout=Utils.get_transfer_timeout(self.config),
                 **proxy_options
             )
 
@@ -1017,6 +2188,21 @@ class GrokApiClient:
         except Exception as error:
             logger.error(str(error), "Server")
             return ''
+    def upload_attachments(self, request_payload, token, proxy):
+        """用发送对话的令牌及其绑定的代理上传附件，上游文件归属于上传时的账号，换令牌后需要重新上传"""
+        if not request_payload.attachments:
+            return request_payload
+        file_attachments = []
+        for kind, content in request_payload.attachments:
+            if kind == "file":
+                file_id = self.upload_base64_file(content, token, proxy)
+            else:
+                file_id = self.upload_base64_image(content, f"{self.config['API']['BASE_URL']}/api/rpc", token, proxy)
+            if file_id:
+                file_attachments.append(file_id)
+            if len(file_attachments) == 4:
+                break
+        return {**request_payload, "fileAttachments": file_attachments}
     # def convert_system_messages(self, messages):
     #     try:
     #         system_prompt = []
@@ -1039,7 +2225,7 @@ class GrokApiClient:
     #         raise ValueError(error)
     def prepare_chat_request(self, request):
         if ((request["model"] == 'grok-2-imageGen' or request["model"] == 'grok-3-imageGen') and
-            not CONFIG["API"]["PICGO_KEY"] and not CONFIG["API"]["TUMY_KEY"] and
+            not self.config["API"]["PICGO_KEY"] and not self.config["API"]["TUMY_KEY"] and
             request.get("stream", False)):
             raise ValueError("该模型流式输出需要配置PICGO或者TUMY图床密钥!")
 
@@ -1050,7 +2236,7 @@ class GrokApiClient:
             if last_message["role"] != 'user':
                 raise ValueError('此模型最后一条消息必须是用户消息!')
             todo_messages = [last_message]
-        file_attachments = []
+        attachments = []
         messages = ''
         last_role = None
         last_content = ''
@@ -1066,10 +2252,46 @@ class GrokApiClient:
 
         # 移除<think>标签及其内容和base64图片
         def remove_think_tags(text):
-            import re
-            text = re.sub(r'<think>[\s\S]*?<\/think>', '', text).strip()
-            text = re.sub(r'!\[image\]\(data:.*?base64,.*?\)', '[图片]', text)
-            return text
+            return replace_inline_images(remove_between(text, '<think>', '</think>').strip())
+
+        def remove_between(text, start_tag, end_tag):
+            start = text.find(start_tag)
+            if start == -1:
+                return text
+            parts = []
+            position = 0
+            while start != -1:
+                end = text.find(end_tag, start + len(start_tag))
+                if end == -1:
+                    break
+                parts.append(text[position:start])
+                position = end + len(end_tag)
+                start = text.find(start_tag, position)
+            parts.append(text[position:])
+            return ''.join(parts)
+
+        # 历史消息中的 ![image](data:...base64,...) 替换为占位符，按查找定位，不对整段 base64 做正则匹配
+        def replace_inline_images(text):
+            marker = '![image](data:'
+            start = text.find(marker)
+            if start == -1:
+                return text
+            parts = []
+            position = 0
+            while start != -1:
+                data_start = text.find('base64,', start + len(marker))
+                end = text.find(')', data_start + 7) if data_start != -1 else -1
+                if end == -1:
+                    break
+                if text.find('\n', start, end) != -1:
+                    start = text.find(marker, start + 1)
+                    continue
+                parts.append(text[position:start])
+                parts.append('[图片]')
+                position = end + 1
+                start = text.find(marker, position)
+            parts.append(text[position:])
+            return ''.join(parts)
 
         def process_content(content):
             if isinstance(content, list):
@@ -1092,28 +2314,21 @@ class GrokApiClient:
 
             if is_last_message and "content" in current:
                 if isinstance(current["content"], list):
-                    for item in current["content"]:
-                        if item["type"] == 'image_url':
-                            processed_image = self.upload_base64_image(
-                                item["image_url"]["url"],
-                                f"{CONFIG['API']['BASE_URL']}/api/rpc"
-                            )
-                            if processed_image:
-                                file_attachments.append(processed_image)
+                    image_urls = [item["image_url"]["url"] for item in current["content"] if item["type"] == 'image_url']
                 elif isinstance(current["content"], dict) and current["content"].get("type") == 'image_url':
-                    processed_image = self.upload_base64_image(
-                        current["content"]["image_url"]["url"],
-                        f"{CONFIG['API']['BASE_URL']}/api/rpc"
-                    )
-                    if processed_image:
-                        file_attachments.append(processed_image)
-
+                    image_urls = [current["content"]["image_url"]["url"]]
+                else:
+                    image_urls = []
+                for url in image_urls:
+                    image = self.load_image(url)
+                    if image:
+                        attachments.append(("image", image))
 
             text_content = process_content(current.get("content", ""))
             if is_last_message and convert_to_file:
                 last_message_content = f"{role.upper()}: {text_content or '[图片]'}\n"
                 continue
-            if text_content or (is_last_message and file_attachments):
+            if text_content or (is_last_message and attachments):
                 if role == last_role and text_content:
                     last_content += '\n' + text_content
                     messages = messages[:messages.rindex(f"{role.upper()}: ")] + f"{role.upper()}: {last_content}\n"
@@ -1126,20 +2341,18 @@ class GrokApiClient:
                 convert_to_file = True
                
         if convert_to_file:
-            file_id = self.upload_base64_file(messages, request["model"])
-            if file_id:
-                file_attachments.insert(0, file_id)
+            attachments.insert(0, ("file", messages))
             messages = last_message_content.strip()
         if messages.strip() == '':
             if convert_to_file:
                 messages = '基于txt文件内容进行回复：'
             else:
                 raise ValueError('消息内容为空!')
-        return {
-            "temporary": CONFIG["API"].get("IS_TEMP_CONVERSATION", False),
+        return ChatRequestPayload({
+            "temporary": self.config["API"].get("IS_TEMP_CONVERSATION", False),
             "modelName": self.model_id,
             "message": messages.strip(),
-            "fileAttachments": file_attachments[:4],
+            "fileAttachments": [],
             "imageAttachments": [],
             "disableSearch": False,
             "enableImageGeneration": True,
@@ -1162,11 +2375,116 @@ class GrokApiClient:
             "deepsearchPreset": deepsearchPreset,
             "isReasoning": request["model"] == 'grok-3-reasoning',
             "disableTextFollowUps": True
-        }
+        }, attachments)
+
+class StopSequenceMatcher:
+    """基于 Aho–Corasick 自动机的增量停止词匹配，停止词跨分块出现时也能识别"""
+    def __init__(self, stop_sequences):
+        self.transitions = [{}]
+        self.fail = [0]
+        self.depth = [0]
+        self.match_length = [0]
+        for sequence in stop_sequences:
+            state = 0
+            for char in sequence:
+                if char not in self.transitions[state]:
+                    self.transitions.append({})
+                    self.fail.append(0)
+                    self.depth.append(self.depth[state] + 1)
+                    self.match_length.append(0)
+                    self.transitions[state][char] = len(self.transitions) - 1
+                state = self.transitions[state][char]
+            self.match_length[state] = len(sequence)
+
+        pending_states = deque([0])
+        while pending_states:
+            state = pending_states.popleft()
+            for char, next_state in self.transitions[state].items():
+                fallback = self.fail[state]
+                while fallback and char not in self.transitions[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.transitions[fallback].get(char, 0) if state else 0
+                if not self.match_length[next_state]:
+                    self.match_length[next_state] = self.match_length[self.fail[next_state]]
+                pending_states.append(next_state)
+
+        self.state = 0
+        self.pending = ''
+
+    def feed(self, text):
+        """返回 (可以安全输出的文本, 是否命中停止词)，可能构成停止词前缀的尾部文本会暂存到下一次"""
+        buffer = self.pending + text
+        for position in range(len(self.pending), len(buffer)):
+            char = buffer[position]
+            while self.state and char not in self.transitions[self.state]:
+                self.state = self.fail[self.state]
+            self.state = self.transitions[self.state].get(char, 0)
+            if self.match_length[self.state]:
+                self.pending = ''
+                return buffer[:position + 1 - self.match_length[self.state]], True
+
+        keep = self.depth[self.state]
+        self.pending = buffer[len(buffer) - keep:] if keep else ''
+        return buffer[:len(buffer) - keep], False
+
+    def flush(self):
+        text, self.pending = self.pending, ''
+        return text
+
+def estimate_tokens(text):
+    """粗略估算 token 数：中日韩字符按 1 个计算，其余字符按 4 个字符 1 个计算"""
+    wide_chars = sum(1 for char in text if char >= '\u2e80')
+    return wide_chars + (len(text) - wide_chars) / 4
+
+class GenerationLimiter:
+    """按请求中的 stop 与 max_tokens 截断输出，并记录对应的 finish_reason"""
+    def __init__(self, stop=None, max_tokens=None):
+        if isinstance(stop, str):
+            stop = [stop]
+        self.stop_sequences = [sequence for sequence in (stop or []) if sequence]
+        self.max_tokens = max_tokens if isinstance(max_tokens, int) and max_tokens > 0 else None
+        self.reset()
+
+    @staticmethod
+    def from_request(data):
+        return GenerationLimiter(data.get("stop"), data.get("max_completion_tokens") or data.get("max_tokens"))
+
+    def reset(self):
+        self.matcher = StopSequenceMatcher(self.stop_sequences) if self.stop_sequences else None
+        self.token_count = 0
+        self.finish_reason = None
+
+    def feed(self, text):
+        if self.finish_reason:
+            return ''
+        if self.matcher:
+            text, matched = self.matcher.feed(text)
+            if matched:
+                self.finish_reason = "stop"
+        return self._limit_length(text)
+
+    def flush(self):
+        if self.finish_reason or not self.matcher:
+            return ''
+        return self._limit_length(self.matcher.flush())
+
+    def _limit_length(self, text):
+        if not self.max_tokens or not text:
+            return text
+        token_count = self.token_count + estimate_tokens(text)
+        if token_count < self.max_tokens:
+            self.token_count = token_count
+            return text
+        for position, char in enumerate(text):
+            self.token_count += 1 if char >= '\u2e80' else 0.25
+            if self.token_count >= self.max_tokens:
+                self.finish_reason = "length"
+                return text[:position + 1]
+        return text
 
 class MessageProcessor:
     @staticmethod
-    def create_chat_response(message, model, is_stream=False):
+    def create_chat_response(message, model, is_stream=False, index=0, finish_reason=None, annotations=None):
         base_response = {
             "id": f"chatcmpl-{uuid.uuid4()}",
             "created": int(time.time()),
@@ -1174,97 +2492,460 @@ class MessageProcessor:
         }
 
         if is_stream:
+            choice = {
+                "index": index,
+                "delta": {"content": message} if message is not None else {}
+            }
+            if annotations:
+                choice["delta"]["annotations"] = annotations
+            if finish_reason:
+                choice["finish_reason"] = finish_reason
             return {
                 **base_response,
                 "object": "chat.completion.chunk",
-                "choices": [{
-                    "index": 0,
-                    "delta": {
-                        "content": message
-                    }
-                }]
+                "choices": [choice]
             }
 
         return {
             **base_response,
             "object": "chat.completion",
             "choices": [{
-                "index": 0,
+                "index": index,
                 "message": {
                     "role": "assistant",
                     "content": message
                 },
-                "finish_reason": "stop"
+                "finish_reason": finish_reason or "stop"
             }],
             "usage": None
         }
 
-def process_model_response(response, model):
-    result = {"token": None, "imageUrl": None}
+class ResponseCache:
+    """非流式响应的单飞合并与短期 LRU+TTL 缓存"""
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (过期时间, 响应体)
+        self._inflight = {}  # key -> 正在进行的上游请求
+        self._lock = threading.Lock()
 
-    if CONFIG["IS_IMG_GEN"]:
-        if response.get("cachedImageGenerationResponse") and not CONFIG["IS_IMG_GEN2"]:
-            result["imageUrl"] = response["cachedImageGenerationResponse"]["imageUrl"]
-        return result
+    @staticmethod
+    def make_key(model, payload):
+        canonical = json.dumps({"model": model, "payload": payload}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def get_or_compute(self, key, compute):
+        """命中缓存直接返回；相同请求并发时只有第一个请求访问上游，其余等待共享结果"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                if entry[0] > time.time():
+                    self._entries.move_to_end(key)
+                    logger.info("命中响应缓存", "ResponseCache")
+                    return entry[1]
+                del self._entries[key]
+
+            flight = self._inflight.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = {"event": threading.Event(), "value": None, "error": None}
+                self._inflight[key] = flight
+
+        if not is_leader:
+            logger.info("合并相同的进行中请求", "ResponseCache")
+            flight["event"].wait()
+            if flight["error"]:
+                raise flight["error"]
+            return flight["value"]
 
-    if model == 'grok-2':
-        result["token"] = response.get("token")
-    elif model in ['grok-2-search', 'grok-3-search']:
-        if response.get("webSearchResults") and CONFIG["ISSHOW_SEARCH_RESULTS"]:
-            result["token"] = f"\r\n<think>{Utils.organize_search_results(response['webSearchResults'])}</think>\r\n"
-        else:
-            result["token"] = response.get("token")
-    elif model == 'grok-3':
-        result["token"] = response.get("token")
-    elif model in ['grok-3-deepsearch', 'grok-3-deepersearch']:
-        if response.get("messageStepId") and not CONFIG["SHOW_THINKING"]:
-            return result
-        if response.get("messageStepId") and not CONFIG["IS_THINKING"]:
-            result["token"] = "<think>" + response.get("token", "")
-            CONFIG["IS_THINKING"] = True
-        elif not response.get("messageStepId") and CONFIG["IS_THINKING"] and response.get("messageTag") == "final":
-            result["token"] = "</think>" + response.get("token", "")
-            CONFIG["IS_THINKING"] = False
-        elif (response.get("messageStepId") and CONFIG["IS_THINKING"] and response.get("messageTag") == "assistant") or response.get("messageTag") == "final":
-            result["token"] = response.get("token","")
-        elif (CONFIG["IS_THINKING"] and response.get("token","").get("action","") == "webSearch"):
-            result["token"] = response.get("token","").get("action_input","").get("query","")            
-        elif (CONFIG["IS_THINKING"] and response.get("webSearchResults")):
-            result["token"] = Utils.organize_search_results(response['webSearchResults'])
-    elif model == 'grok-3-reasoning':
-        if response.get("isThinking") and not CONFIG["SHOW_THINKING"]:
-            return result
-
-        if response.get("isThinking") and not CONFIG["IS_THINKING"]:
-            result["token"] = "<think>" + response.get("token", "")
-            CONFIG["IS_THINKING"] = True
-        elif not response.get("isThinking") and CONFIG["IS_THINKING"]:
-            result["token"] = "</think>" + response.get("token", "")
-            CONFIG["IS_THINKING"] = False
+        try:
+            flight["value"] = compute()
+            # 写入临时文件的大回复与上游报错的回复只共享给进行中的相同请求，不进入缓存
+            if getattr(flight["value"], "cacheable", True):
+                with self._lock:
+                    self._entries[key] = (time.time() + self.ttl, flight["value"])
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_size:
+                        self._entries.popitem(last=False)
+            return flight["value"]
+        except Exception as error:
+            flight["error"] = error
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight["event"].set()
+
+    def resize(self, max_size, ttl):
+        """配置重新加载时调整容量与有效期，新有效期对之后写入的条目生效"""
+        with self._lock:
+            self.max_size = max_size
+            self.ttl = ttl
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+response_cache = ResponseCache(CONFIG["RESPONSE_CACHE"]["MAX_SIZE"], CONFIG["RESPONSE_CACHE"]["TTL"])
+
+class ConversationStore:
+    """续聊映射：消息前缀哈希 -> 上游会话 (conversationId, responseId, 所属令牌)，按 LRU+TTL 淘汰"""
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    THINK_BLOCK = re.compile(r"<think>.*?</think>", re.S)
+
+    @staticmethod
+    def normalize_assistant_content(content):
+        """客户端回传的助手消息可能去掉了思考过程或首尾空白，按相同方式归一化后参与哈希"""
+        if isinstance(content, list):
+            content = "".join(item.get("text", "") for item in content if isinstance(item, dict) and item.get("type") == "text")
+        return ConversationStore.THINK_BLOCK.sub("", content or "").strip()
+
+    @staticmethod
+    def make_key(model, messages):
+        canonical = json.dumps({
+            "model": model,
+            "messages": [
+                [
+                    message.get("role"),
+                    ConversationStore.normalize_assistant_content(message.get("content"))
+                    if message.get("role") == "assistant" else message.get("content")
+                ]
+                for message in messages
+            ]
+        }, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def find(self, model, messages):
+        """最后一条为用户消息且之前的历史对应已登记的会话时，返回该会话"""
+        if len(messages) < 3 or messages[-1].get("role") != "user" or messages[-2].get("role") != "assistant":
+            return None
+        key = self.make_key(model, messages[:-1])
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            if entry["expiresAt"] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return {**entry, "key": key}
+
+    def save(self, model, messages, reply, conversation_id, response_id, token):
+        """reply 为返回给客户端的回复内容，客户端下一轮回传相同的助手消息时才会命中"""
+        key = self.make_key(model, [*messages, {"role": "assistant", "content": reply}])
+        with self._lock:
+            self._entries[key] = {
+                "conversationId": conversation_id,
+                "responseId": response_id,
+                "token": token,
+                "expiresAt": time.time() + self.ttl
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def resize(self, max_size, ttl):
+        """配置重新加载时调整容量与有效期，新有效期对之后写入的条目生效"""
+        with self._lock:
+            self.max_size = max_size
+            self.ttl = ttl
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+conversation_store = ConversationStore(CONFIG["CONVERSATION"]["MAX_SIZE"], CONFIG["CONVERSATION"]["TTL"])
+
+class ResponseBuffer:
+    """非流式回复内容缓冲区：按块追加，超过 RESPONSE_SPILL_SIZE 后写入临时文件，可重复读取"""
+    def __init__(self, spill_size=None):
+        self.spill_size = CONFIG["RESPONSE_SPILL_SIZE"] if spill_size is None else spill_size
+        self.parts = []
+        self.size = 0
+        self.path = None
+        self._file = None
+        self.errored = False  # 上游返回错误行，回复不完整
+
+    @property
+    def spilled(self):
+        return self.path is not None
+
+    def write(self, text):
+        if not text:
+            return
+        self.size += len(text)
+        if not self.spilled and self.spill_size and self.size > self.spill_size:
+            self._spill()
+        if self._file:
+            self._file.write(text)
         else:
-            result["token"] = response.get("token")
-    elif model == 'grok-4':
-        result["token"] = response.get("token")
-    elif model == 'grok-4-free':
-        result["token"] = response.get("token")
+            self.parts.append(text)
 
-    return result
+    def _spill(self):
+        fd, self.path = tempfile.mkstemp(prefix="grok2api-response-", suffix=".txt")
+        self._file = os.fdopen(fd, "w", encoding="utf-8")
+        self._file.writelines(self.parts)
+        self.parts = []
+        weakref.finalize(self, ResponseBuffer._remove_file, self._file, self.path)
+
+    @staticmethod
+    def _remove_file(file, path):
+        file.close()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def finish(self):
+        """写入结束，刷新临时文件"""
+        if self._file:
+            self._file.flush()
+
+    def iter_chunks(self, chunk_size=64 * 1024):
+        if not self.spilled:
+            yield from self.parts
+            return
+        self._file.flush()
+        with open(self.path, encoding="utf-8") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def getvalue(self):
+        return "".join(self.iter_chunks())
+
+class ChatCompletionBody:
+    """逐块输出的非流式 chat.completion JSON 响应体，回复内容从 ResponseBuffer 中按块转义写出"""
+    def __init__(self, response, contents):
+        self.response = response
+        self.contents = contents
+
+    @property
+    def cacheable(self):
+        """写入临时文件的大回复与上游报错的回复不进入缓存"""
+        return not any(content.spilled or content.errored for content in self.contents)
+
+    def __iter__(self):
+        placeholders = [f"\u0000content-{index}\u0000" for index in range(len(self.contents))]
+        response = {
+            **self.response,
+            "choices": [
+                {**choice, "message": {**choice["message"], "content": placeholder}}
+                for choice, placeholder in zip(self.response["choices"], placeholders)
+            ]
+        }
+        rest = json.dumps(response, ensure_ascii=False)
+        for placeholder, content in zip(placeholders, self.contents):
+            before, rest = rest.split(json.dumps(placeholder, ensure_ascii=False), 1)
+            yield before + '"'
+            for chunk in content.iter_chunks():
+                yield json.dumps(chunk, ensure_ascii=False)[1:-1]
+            yield '"'
+        yield rest
+
+class ResponseEvent:
+    """上游响应行解析出的事件类型"""
+    TEXT = "text"
+    THINK_START = "think_start"
+    THINK_END = "think_end"
+    SEARCH_RESULT = "search_result"
+    IMAGE = "image"
+
+class ResponseParser:
+    """按模型家族将上游响应行转换为事件的解析器，每个请求一个实例，保存该请求的思考与生图状态"""
+    NO_EVENTS = ()
+
+    def __init__(self):
+        self.is_thinking = False
+        self.is_img_gen = False
+        self.image_done = False
+        self.search_result_urls = set()
+        self.search_result_count = 0
+        self.conversation_id = None
+        self.response_id = None
+        self.on_complete = None
+
+    def parse_result(self, result):
+        """解析一行 result，记录会话与回复 ID；续聊接口的行没有 response 包装"""
+        conversation = result.get("conversation")
+        if conversation:
+            self.conversation_id = conversation.get("conversationId")
+            return self.NO_EVENTS
+        response = result.get("response", result)
+        model_response = response.get("modelResponse")
+        if model_response:
+            self.response_id = model_response.get("responseId")
+        return self.parse(response)
+
+    def complete(self, reply=""):
+        """回复完整结束时调用，reply 为返回给客户端的回复内容，用于登记续聊会话"""
+        if self.on_complete and self.response_id:
+            self.on_complete(self, reply)
+
+    def parse(self, response):
+        """解析一行 result.response，返回 (事件类型, 内容) 列表"""
+        if self.is_img_gen or response.get("doImgGen") or response.get("imageAttachmentInfo"):
+            self.is_img_gen = True
+            image = response.get("cachedImageGenerationResponse")
+            if image and not self.image_done:
+                self.image_done = True
+                return [(ResponseEvent.IMAGE, image["imageUrl"])]
+            return self.NO_EVENTS
+        return self.parse_response(response)
+
+    def parse_response(self, response):
+        token = response.get("token")
+        return [(ResponseEvent.TEXT, token)] if token else self.NO_EVENTS
+
+    def think_transition(self, thinking):
+        if thinking == self.is_thinking:
+            return self.NO_EVENTS
+        self.is_thinking = thinking
+        return [(ResponseEvent.THINK_START if thinking else ResponseEvent.THINK_END, None)]
+
+    def search_result_events(self, search_results):
+        """每条搜索结果一个事件，同一请求内按 URL 去重，编号跨步骤连续"""
+        events = []
+        for result in search_results.get("results") or ():
+            url = result.get("url")
+            if url:
+                if url in self.search_result_urls:
+                    continue
+                self.search_result_urls.add(url)
+            events.append((ResponseEvent.SEARCH_RESULT, Utils.normalize_search_result(self.search_result_count, result)))
+            self.search_result_count += 1
+        return events
 
-def handle_image_response(image_url):
+    @staticmethod
+    def render_event(kind, value):
+        if kind == ResponseEvent.TEXT:
+            return value
+        if kind == ResponseEvent.THINK_START:
+            return "<think>"
+        if kind == ResponseEvent.THINK_END:
+            return "</think>"
+        if kind == ResponseEvent.SEARCH_RESULT:
+            return Utils.format_search_result(value) + "\n\n"
+        return ""
+
+    @staticmethod
+    def render(events):
+        """将事件渲染为 OpenAI 兼容的文本内容，返回 (文本, 图片地址)"""
+        if len(events) == 1 and events[0][0] == ResponseEvent.TEXT:
+            return events[0][1], None
+        image_url = None
+        for kind, value in events:
+            if kind == ResponseEvent.IMAGE:
+                image_url = value
+        return "".join(ResponseParser.render_event(kind, value) for kind, value in events), image_url
+
+    @staticmethod
+    def render_chunks(events):
+        """流式渲染：每条搜索结果单独成块，返回 [(文本, 图片地址, 搜索结果)]"""
+        if len(events) == 1 and events[0][0] == ResponseEvent.TEXT:
+            return [(events[0][1], None, None)]
+        chunks = []
+        text = []
+        for kind, value in events:
+            if kind == ResponseEvent.IMAGE:
+                chunks.append(("", value, None))
+                continue
+            text.append(ResponseParser.render_event(kind, value))
+            if kind == ResponseEvent.SEARCH_RESULT:
+                chunks.append(("".join(text), None, value))
+                text = []
+        if text:
+            chunks.append(("".join(text), None, None))
+        return chunks
+
+class SearchResponseParser(ResponseParser):
+    def parse_response(self, response):
+        search_results = response.get("webSearchResults")
+        if search_results and CONFIG["ISSHOW_SEARCH_RESULTS"]:
+            events = self.search_result_events(search_results)
+            if not events:
+                return self.NO_EVENTS
+            return [
+                (ResponseEvent.TEXT, "\r\n"),
+                (ResponseEvent.THINK_START, None),
+                *events,
+                (ResponseEvent.THINK_END, None),
+                (ResponseEvent.TEXT, "\r\n")
+            ]
+        return super().parse_response(response)
+
+class ReasoningResponseParser(ResponseParser):
+    def parse_response(self, response):
+        is_thinking = bool(response.get("isThinking"))
+        if is_thinking and not CONFIG["SHOW_THINKING"]:
+            return self.NO_EVENTS
+        token = response.get("token")
+        if is_thinking == self.is_thinking:
+            return [(ResponseEvent.TEXT, token)] if token else self.NO_EVENTS
+        events = self.think_transition(is_thinking)
+        return [*events, (ResponseEvent.TEXT, token)] if token else events
+
+class DeepSearchResponseParser(ResponseParser):
+    """深度搜索：带 messageStepId 的行为思考步骤，messageTag 为 final 的行为最终回复"""
+    def parse_response(self, response):
+        step_id = response.get("messageStepId")
+        tag = response.get("messageTag")
+        token = response.get("token")
+
+        if tag == "final":
+            events = self.think_transition(False)
+            return [*events, (ResponseEvent.TEXT, token)] if isinstance(token, str) and token else events
+        if step_id and not CONFIG["SHOW_THINKING"]:
+            return self.NO_EVENTS
+        if step_id and not self.is_thinking:
+            events = self.think_transition(True)
+            return [*events, (ResponseEvent.TEXT, token)] if isinstance(token, str) and token else events
+        if not self.is_thinking:
+            return self.NO_EVENTS
+
+        if step_id and tag == "assistant":
+            return [(ResponseEvent.TEXT, token)] if isinstance(token, str) and token else self.NO_EVENTS
+        if isinstance(token, dict) and token.get("action") == "webSearch":
+            query = (token.get("action_input") or {}).get("query")
+            return [(ResponseEvent.TEXT, query)] if query else self.NO_EVENTS
+        search_results = response.get("webSearchResults")
+        if search_results:
+            return self.search_result_events(search_results)
+        return self.NO_EVENTS
+
+# 模型 -> 解析器，未列出的模型按普通文本解析
+RESPONSE_PARSERS = {
+    'grok-2-search': SearchResponseParser,
+    'grok-3-search': SearchResponseParser,
+    'grok-3-deepsearch': DeepSearchResponseParser,
+    'grok-3-deepersearch': DeepSearchResponseParser,
+    'grok-3-reasoning': ReasoningResponseParser
+}
+
+def handle_image_response(image_url, cookie, proxy=None):
     max_retries = 2
     retry_count = 0
     image_base64_response = None
 
     while retry_count < max_retries:
         try:
-            proxy_options = Utils.get_proxy_options()
+            # 图片与对话使用同一令牌及其绑定的代理下载
+            proxy_options = Utils.get_proxy_options(proxy)
             image_base64_response = curl_requests.get(
-                f"https://assets.grok.com/{image_url}",
+                f"{CONFIG['API']['ASSETS_URL']}/{image_url}",
                 headers={
                     **DEFAULT_HEADERS,
-                    "Cookie":CONFIG["SERVER"]['COOKIE']
+                    "Cookie":cookie
                 },
-                impersonate="chrome133a",
+                impersonate=CONFIG["API"]["IMPERSONATE"],
+                timeout=Utils.get_transfer_timeout(),
                 **proxy_options
             )
 
@@ -1305,6 +2986,7 @@ def handle_image_response(image_url):
             "https://www.picgo.net/api/1/upload",
             files=files,
             headers=headers,
+            timeout=Utils.get_transfer_timeout(),
             **proxy_options
         )
 
@@ -1328,6 +3010,7 @@ def handle_image_response(image_url):
             "https://tu.my/api/v1/upload",
             files=files,
             headers=headers,
+            timeout=Utils.get_transfer_timeout(),
             **proxy_options
         )
 
@@ -1342,16 +3025,96 @@ def handle_image_response(image_url):
                 logger.error(str(error), "Server")
                 return "生图失败，请查看TUMY图床密钥是否设置正确"
 
-def handle_non_stream_response(response, model):
+class UpstreamTimeoutError(TimeoutError):
+    """上游流某一阶段超过期限"""
+    error_class = "timeout"
+
+class UpstreamLineReader:
+    """按阶段期限逐行读取上游流：首行、相邻两行间隔与总耗时任一超限即放弃该连接。
+
+    curl_cffi 的 iter_content 在内部队列上无限期阻塞，这里直接带超时读取该队列；
+    响应对象没有队列时退回普通的 iter_lines，只依赖 libcurl 层面的超时。
+    """
+    def __init__(self, response, timeouts, started_at=None):
+        self.response = response
+        self.timeouts = timeouts
+        self.started_at = started_at or time.monotonic()
+        self.first_line_at = None
+        self._pending = deque()
+        self._buffer = b""
+        self._lines = None
+        self._finished = False
+
+    def _next_chunk(self, chunk_queue):
+        now = time.monotonic()
+        total_deadline = self.started_at + self.timeouts["TOTAL"]
+        if self.first_line_at is None:
+            phase, deadline = "FIRST_LINE", self.started_at + self.timeouts["FIRST_LINE"]
+        else:
+            phase, deadline = "IDLE", now + self.timeouts["IDLE"]
+        if total_deadline < deadline:
+            phase, deadline = "TOTAL", total_deadline
+        try:
+            return chunk_queue.get(timeout=max(deadline - now, 0))
+        except queue.Empty:
+            # close 会等待 libcurl 结束传输，放到后台执行，避免阻塞重试
+            threading.Thread(target=self.response.close, daemon=True).start()
+            raise UpstreamTimeoutError(f"上游响应超时: {phase} {self.timeouts[phase]}s")
+
+    def _fill(self):
+        chunk_queue = getattr(self.response, "queue", None)
+        if chunk_queue is None:
+            self._lines = self._lines or iter(self.response.iter_lines())
+            line = next(self._lines, None)
+            if line is None:
+                self._finished = True
+            else:
+                self._pending.append(line)
+            return
+        while not self._pending and not self._finished:
+            chunk = self._next_chunk(chunk_queue)
+            if isinstance(chunk, Exception):
+                self.response.close()
+                raise chunk
+            if not isinstance(chunk, bytes):
+                # 流结束标记
+                self.response.close()
+                self._finished = True
+                if self._buffer:
+                    self._pending.append(self._buffer)
+                    self._buffer = b""
+                break
+            lines = (self._buffer + chunk).split(b"\n")
+            self._buffer = lines.pop()
+            self._pending.extend(line for line in lines if line)
+
+    def prime(self):
+        """等待首行到达，超时在发出请求的重试循环内抛出"""
+        if not self._pending and not self._finished:
+            self._fill()
+        if self._pending and self.first_line_at is None:
+            self.first_line_at = time.monotonic()
+        return self
+
+    def __iter__(self):
+        while True:
+            if not self._pending:
+                if self._finished:
+                    return
+                self._fill()
+                continue
+            self.first_line_at = self.first_line_at or time.monotonic()
+            yield self._pending.popleft()
+
+def handle_non_stream_response(response, model, parser, limiter=None, lines=None, cookie=None, proxy=None):
     try:
         logger.info("开始处理非流式响应", "Server")
 
-        stream = response.iter_lines()
-        full_response = ""
-
-        CONFIG["IS_THINKING"] = False
-        CONFIG["IS_IMG_GEN"] = False
-        CONFIG["IS_IMG_GEN2"] = False
+        stream = lines if lines is not None else response.iter_lines()
+        full_response = ResponseBuffer()
+        is_complete = True
+        if limiter:
+            limiter.reset()
 
         for chunk in stream:
             if not chunk:
@@ -1360,23 +3123,23 @@ def handle_non_stream_response(response, model):
                 line_json = json.loads(chunk.decode("utf-8").strip())
                 if line_json.get("error"):
                     logger.error(json.dumps(line_json, indent=2), "Server")
-                    return json.dumps({"error": "RateLimitError"}) + "\n\n"
-
-                response_data = line_json.get("result", {}).get("response")
-                if not response_data:
-                    continue
+                    full_response.write(json.dumps({"error": "RateLimitError"}) + "\n\n")
+                    full_response.errored = True
+                    is_complete = False
+                    break
 
-                if response_data.get("doImgGen") or response_data.get("imageAttachmentInfo"):
-                    CONFIG["IS_IMG_GEN"] = True
+                token, image_url = parser.render(parser.parse_result(line_json.get("result") or {}))
 
-                result = process_model_response(response_data, model)
+                if token:
+                    full_response.write(limiter.feed(token) if limiter else token)
+                    # 命中停止词或达到 max_tokens 时立即关闭上游连接
+                    if limiter and limiter.finish_reason:
+                        response.close()
+                        break
 
-                if result["token"]:
-                    full_response += result["token"]
-
-                if result["imageUrl"]:
-                    CONFIG["IS_IMG_GEN2"] = True
-                    return handle_image_response(result["imageUrl"])
+                if image_url:
+                    full_response.write(handle_image_response(image_url, cookie, proxy))
+                    break
 
             except json.JSONDecodeError:
                 continue
@@ -1384,18 +3147,26 @@ def handle_non_stream_response(response, model):
                 logger.error(f"处理流式响应行时出错: {str(e)}", "Server")
                 continue
 
+        if limiter:
+            full_response.write(limiter.flush())
+        full_response.finish()
+        # 被 stop/max_tokens 截断的回复与上游会话内容不一致，不登记续聊
+        if is_complete and not (limiter and limiter.finish_reason) and parser.on_complete:
+            parser.complete(full_response.getvalue())
         return full_response
     except Exception as error:
         logger.error(str(error), "Server")
         raise
-def handle_stream_response(response, model):
+def handle_stream_response(response, model, parser, choice_index=0, limiter=None, lines=None, cookie=None, proxy=None):
     def generate():
         logger.info("开始处理流式响应", "Server")
+        if limiter:
+            limiter.reset()
 
-        stream = response.iter_lines()
-        CONFIG["IS_THINKING"] = False
-        CONFIG["IS_IMG_GEN"] = False
-        CONFIG["IS_IMG_GEN2"] = False
+        stream = lines if lines is not None else response.iter_lines()
+        # 需要登记续聊时记录返回给客户端的回复内容
+        reply = [] if parser.on_complete else None
+        completed = False
 
         try:
             for chunk in stream:
@@ -1403,28 +3174,37 @@ def handle_stream_response(response, model):
                     continue
                 try:
                     line_json = json.loads(chunk.decode("utf-8").strip())
-                    print(line_json)
                     if line_json.get("error"):
                         logger.error(json.dumps(line_json, indent=2), "Server")
                         yield json.dumps({"error": "RateLimitError"}) + "\n\n"
                         return
 
-                    response_data = line_json.get("result", {}).get("response")
-                    if not response_data:
-                        continue
-
-                    if response_data.get("doImgGen") or response_data.get("imageAttachmentInfo"):
-                        CONFIG["IS_IMG_GEN"] = True
-
-                    result = process_model_response(response_data, model)
-
-                    if result["token"]:
-                        yield f"data: {json.dumps(MessageProcessor.create_chat_response(result['token'], model, True))}\n\n"
-
-                    if result["imageUrl"]:
-                        CONFIG["IS_IMG_GEN2"] = True
-                        image_data = handle_image_response(result["imageUrl"])
-                        yield f"data: {json.dumps(MessageProcessor.create_chat_response(image_data, model, True))}\n\n"
+                    for token, image_url, search_result in parser.render_chunks(parser.parse_result(line_json.get("result") or {})):
+                        if token:
+                            token = limiter.feed(token) if limiter else token
+                            annotations = None
+                            if search_result and CONFIG["SEARCH_RESULTS"]["ANNOTATIONS"]:
+                                annotations = [{
+                                    "type": "url_citation",
+                                    "url_citation": {"url": search_result["url"], "title": search_result["title"]}
+                                }]
+                            if reply is not None and token:
+                                reply.append(token)
+                            if token or annotations:
+                                yield f"data: {json.dumps(MessageProcessor.create_chat_response(token, model, True, choice_index, annotations=annotations))}\n\n"
+                            # 命中停止词或达到 max_tokens 时立即关闭上游连接
+                            if limiter and limiter.finish_reason:
+                                break
+
+                        if image_url:
+                            image_data = handle_image_response(image_url, cookie, proxy)
+                            if reply is not None:
+                                reply.append(image_data)
+                            yield f"data: {json.dumps(MessageProcessor.create_chat_response(image_data, model, True, choice_index))}\n\n"
+
+                    if limiter and limiter.finish_reason:
+                        response.close()
+                        break
 
                 except json.JSONDecodeError:
                     continue
@@ -1432,13 +3212,787 @@ def handle_stream_response(response, model):
                     logger.error(f"处理流式响应行时出错: {str(e)}", "Server")
                     continue
 
+            completed = True
         except Exception as stream_error:
             logger.error(f"流式响应读取失败: {str(stream_error)}", "Server")
-            yield f"data: {json.dumps(MessageProcessor.create_chat_response('网络连接中断，请重试', model, True))}\n\n"
-
+            yield f"data: {json.dumps(MessageProcessor.create_chat_response('网络连接中断，请重试', model, True, choice_index))}\n\n"
+
+        remaining = limiter.flush() if limiter else ''
+        if remaining:
+            yield f"data: {json.dumps(MessageProcessor.create_chat_response(remaining, model, True, choice_index))}\n\n"
+        # 被 stop/max_tokens 截断的回复与上游会话内容不一致，不登记续聊
+        if completed and reply is not None and not (limiter and limiter.finish_reason):
+            parser.complete("".join(reply) + remaining)
+        finish_reason = limiter.finish_reason if limiter and limiter.finish_reason else "stop"
+        yield f"data: {json.dumps(MessageProcessor.create_chat_response(None, model, True, choice_index, finish_reason))}\n\n"
         yield "data: [DONE]\n\n"
     return generate()
 
+class UpstreamRequestError(ValueError):
+    """上游请求最终失败，携带需要返回给客户端的状态码"""
+    def __init__(self, message, status_code=500):
+        super().__init__(message)
+        self.status_code = status_code
+
+def prepare_continuation_request(grok_client, data, model, conversation):
+    """续聊请求体：只包含最新的用户消息，并指定上一条回复作为父节点"""
+    request_payload = grok_client.prepare_chat_request({**data, "model": model, "messages": data["messages"][-1:]})
+    request_payload.pop("temporary", None)
+    request_payload["parentResponseId"] = conversation["responseId"]
+    return request_payload
+
+def send_chat_request(data, model, stream, request_payload=None, choice_index=0, exclude_tokens=None, limiter=None, conversation=None, config=None):
+    """带令牌轮换、网络错误重试与模型回退的上游请求。
+
+    返回 (实际使用的模型, 结果)，流式请求的结果为 SSE 生成器，非流式请求的结果为完整回复内容。
+    并发扇出时 exclude_tokens 为各个请求共享的已占用令牌集合。
+    conversation 为续聊模式下命中的上游会话，此时使用会话所属令牌只发送最新消息，失败时退回完整历史。
+    config 为请求开始时的配置快照。
+    """
+    config = config or CONFIG
+    response_status_code = 500
+    try:
+        retry_count = 0
+        is_network_error_retry = False
+        signature_cookie = None
+        uploaded_payload = uploaded_token = None
+        grok_client = GrokApiClient(model, config)
+        if conversation:
+            request_payload = prepare_continuation_request(grok_client, data, model, conversation)
+        elif request_payload is None:
+            request_payload = grok_client.prepare_chat_request({**data, "model": model})
+            logger.info(json.dumps(request_payload,indent=2))
+
+        while retry_count < config["RETRY"]["MAX_ATTEMPTS"]:
+            retry_count += 1
+
+            # 全局熔断期间不再消耗令牌次数，直接快速失败
+            if shield_breakers.global_open():
+                raise ShieldOpenError("上游连续返回403盾，已暂停请求，请稍后重试或者更换ip")
+
+            # 当前模型在重试过程中耗尽时，沿回退链切换到仍有容量的模型
+            if not token_manager.has_available_capacity(model):
+                fallback_model = Utils.resolve_available_model(model)
+                if not fallback_model:
+                    raise ValueError(f"{model} 次数已达上限，请切换其他模型或者重新对话")
+                logger.info(f"模型 {model} 次数已耗尽，回退至 {fallback_model}", "Server")
+                model = fallback_model
+                is_network_error_retry = False
+                conversation = None
+                grok_client = GrokApiClient(model, config)
+                request_payload = grok_client.prepare_chat_request({**data, "model": model})
+
+            # 续聊时固定使用会话所属的令牌，令牌已不可用则改为发送完整历史
+            if conversation and not is_network_error_retry:
+                signature_cookie = Utils.create_auth_headers(model, exclude_tokens=exclude_tokens, prefer_token=conversation["token"])
+                if signature_cookie != conversation["token"]:
+                    logger.info("续聊会话所属令牌不可用，改为发送完整历史", "Server")
+                    conversation_store.discard(conversation["key"])
+                    conversation = None
+                    request_payload = grok_client.prepare_chat_request({**data, "model": model})
+                    signature_cookie = signature_cookie or Utils.create_auth_headers(model, exclude_tokens=exclude_tokens)
+            # 如果是网络错误重试，沿用刚刚退还过次数的令牌，不再增加计数
+            elif is_network_error_retry and signature_cookie:
+                # 重置标记
+                is_network_error_retry = False
+            else:
+                # 正常获取下一个令牌并增加计数
+                is_network_error_retry = False
+                signature_cookie = Utils.create_auth_headers(model, exclude_tokens=exclude_tokens)
+
+            if not signature_cookie:
+                raise ValueError('该模型无可用令牌')
+
+            logger.info(
+                f"当前令牌: {json.dumps(signature_cookie, indent=2)}","Server")
+            logger.info(
+                f"当前可用模型的全部可用数量: {json.dumps(token_manager.get_remaining_token_request_capacity(), indent=2)}","Server")
+            
+            # 令牌固定走绑定的代理，并使用该代理 IP 对应的 cf_clearance；代理熔断时换用其他代理
+            proxy = proxy_bindings.get_proxy(signature_cookie)
+            if not shield_breakers.allow(proxy):
+                proxy = proxy_bindings.get_proxy(signature_cookie)
+                if not shield_breakers.allow(proxy):
+                    token_manager.reduce_token_request_count(model, 1, signature_cookie)
+                    raise ShieldOpenError("上游连续返回403盾，所有代理均已熔断，请稍后重试或者更换ip")
+            cookie = proxy_bindings.get_cookie(signature_cookie, proxy)
+            logger.info(json.dumps(request_payload,indent=2),"Server")
+            try:
+                # 附件上传到本次使用的令牌所属账号；请求体或令牌变化后重新上传
+                if request_payload is not uploaded_payload or signature_cookie != uploaded_token:
+                    request_body = grok_client.upload_attachments(request_payload, signature_cookie, proxy)
+                    uploaded_payload, uploaded_token = request_payload, signature_cookie
+
+                # 添加请求间延迟，避免被检测
+                time.sleep(config["API"]["REQUEST_INTERVAL"])
+                
+                # 生成必要的请求头
+                xai_request_id = Utils.generate_xai_request_id()
+                statsig_id = statsig_pool.get()
+                
+                # 构建请求头
+                request_headers = {
+                    **DEFAULT_HEADERS, 
+                    "Cookie": cookie,
+                    "x-xai-request-id": xai_request_id
+                }
+                
+                # 如果成功获取到 statsig_id 则添加到请求头
+                if statsig_id:
+                    request_headers["x-statsig-id"] = statsig_id
+                    logger.info(f"添加 x-statsig-id 到请求头", "Server")
+                else:
+                    logger.warning("无法获取 x-statsig-id，尝试不带签名发送请求", "Server")
+                
+                if conversation:
+                    url = f"{config['API']['BASE_URL']}/rest/app-chat/conversations/{conversation['conversationId']}/responses"
+                else:
+                    url = f"{config['API']['BASE_URL']}/rest/app-chat/conversations/new"
+                proxy_options = Utils.get_proxy_options(proxy)
+                timeouts = Utils.get_upstream_timeouts(model, config)
+                started_at = time.monotonic()
+                response = curl_requests.post(
+                    url,
+                    headers=request_headers,
+                    data=json.dumps(request_body),
+                    impersonate=config["API"]["IMPERSONATE"],
+                    stream=True,
+                    curl_options=Utils.get_stream_curl_options(timeouts),
+                    verify=True,
+                    **proxy_options)
+                logger.info(cookie,"Server")
+                if response.status_code != 403:
+                    shield_breakers.release(proxy)
+                if response.status_code != 200:
+                    response_status_code = response.status_code
+                    body = response.text[:2000]
+                    response.close()
+                    error_class = upstream_errors.classify_response(response.status_code, response.headers.get("content-type", ""), body)
+                    if conversation and error_class == "bad_request":
+                        # 上游会话失效（已删除、过期等），退还次数后改为发送完整历史；盾、限流等错误与完整历史请求一样处理
+                        upstream_errors.record(error_class)
+                        logger.warning(f"续聊请求失败，改为发送完整历史: status {response.status_code}", "Server")
+                        token_manager.reduce_token_request_count(model, 1, signature_cookie)
+                        conversation_store.discard(conversation["key"])
+                        conversation = None
+                        request_payload = grok_client.prepare_chat_request({**data, "model": model})
+                        retry_count -= 1
+                        continue
+                    raise UpstreamResponseError(f"status {response.status_code}: {body[:200]}", response.status_code, error_class)
+
+                # 首行超时在这里抛出，交给下面的重试逻辑换连接重发
+                lines = UpstreamLineReader(response, timeouts, started_at).prime()
+                response_status_code = 200
+                proxy_bindings.report_success(proxy)
+                shield_breakers.record_success(proxy)
+                logger.info("请求成功", "Server")
+                logger.info(f"当前{model}剩余可用令牌数: {token_manager.get_token_count_for_model(model)}","Server")
+
+                parser = grok_client.create_response_parser()
+                if config["CONVERSATION"]["ENABLED"] and choice_index == 0 and not config["API"]["IS_CUSTOM_SSO"]:
+                    parser.conversation_id = conversation["conversationId"] if conversation else None
+
+                    def save_conversation(parser, reply, model=model, token=signature_cookie):
+                        if parser.conversation_id:
+                            conversation_store.save(model, data["messages"], reply, parser.conversation_id, parser.response_id, token)
+                    parser.on_complete = save_conversation
+
+                # 记录已扣费的对话，停机时未完成的对话退还次数
+                charge_id = drain_controller.charge(model, signature_cookie)
+                if stream:
+                    return model, drain_controller.guard_stream(handle_stream_response(response, model, parser, choice_index, limiter, lines, cookie, proxy), charge_id, response)
+                try:
+                    return model, handle_non_stream_response(response, model, parser, limiter, lines, cookie, proxy)
+                finally:
+                    drain_controller.settle(charge_id)
+
+            except Exception as e:
+                error_class = upstream_errors.classify_exception(e, proxy)
+                action, refund = upstream_errors.record(error_class)
+                logger.error(f"请求处理异常[{error_class}]: {str(e)}", "Server")
+
+                if error_class == "shield":
+                    # 盾与 IP 绑定，令牌本身无问题
+                    shield_breakers.record_shield(proxy)
+                else:
+                    shield_breakers.release(proxy)
+                if refund:
+                    #重置去除当前因为错误未成功请求的次数，确保不会因为错误未成功请求的次数导致次数上限
+                    token_manager.reduce_token_request_count(model, 1, signature_cookie)
+                if config["API"]["IS_CUSTOM_SSO"] and action == upstream_errors.ROTATE_TOKEN:
+                    raise ValueError(f"自定义SSO令牌当前模型{model}的请求次数已失效")
+                if action == upstream_errors.FAIL_FAST or config["API"]["IS_CUSTOM_SSO"]:
+                    raise
+
+                if action == upstream_errors.ROTATE_TOKEN:
+                    logger.info(f"移除令牌: {error_class}", "Server")
+                    token_manager.remove_token_for_model(model, signature_cookie)
+                else:
+                    # 保留已退还次数的令牌重试；代理类错误同时让该令牌换用其他代理
+                    proxy_bindings.report_failure(signature_cookie, proxy, rebind=action == upstream_errors.ROTATE_PROXY)
+                    is_network_error_retry = True
+
+                # 检查是否还有可用令牌，回退链上仍有容量时交给下一轮切换模型
+                if token_manager.get_token_count_for_model(model) == 0 and not Utils.resolve_available_model(model):
+                    raise ValueError(f"{model} 次数已达上限，请切换其他模型或者重新对话")
+
+                continue
+        if response_status_code == 403:
+            raise ValueError('IP暂时被封无法破盾，请稍后重试或者更换ip')
+        elif response_status_code == 500:
+            raise ValueError('当前模型所有令牌暂无可用，请稍后重试')
+        else:
+            raise ValueError('请求失败，请检查网络连接或稍后重试')
+    except (UpstreamRequestError, ShieldOpenError):
+        raise
+    except Exception as error:
+        raise UpstreamRequestError(str(error), getattr(error, "status_code", response_status_code)) from error
+
+def fan_out_chat_requests(data, model, stream, request_payload, n, conversation=None, config=None):
+    """并发发起 n 个上游对话，每个对话使用不同的令牌与代理并各自上传附件，返回 (模型, 结果, 截断器) 列表；任一对话失败时整体失败"""
+    limiters = [GenerationLimiter.from_request(data) for _ in range(n)]
+    if n == 1:
+        return [(*send_chat_request(data, model, stream, request_payload, limiter=limiters[0], conversation=conversation, config=config), limiters[0])]
+
+    exclude_tokens = set()
+    with ThreadPoolExecutor(max_workers=n) as executor:
+        futures = [
+            executor.submit(send_chat_request, data, model, stream, request_payload, index, exclude_tokens, limiters[index], config=config)
+            for index in range(n)
+        ]
+    results = []
+    errors = []
+    for index, future in enumerate(futures):
+        try:
+            results.append((*future.result(), limiters[index]))
+        except Exception as error:
+            errors.append(error)
+    if errors:
+        # 候选回复不足 n 个时整体失败，不返回被截短的 choices；已建立的流式回复关闭上游连接
+        for _, result, _ in results:
+            if stream:
+                result.discard()
+        logger.warning(f"{len(errors)}/{n} 个候选回复请求失败: {str(errors[0])}", "Server")
+        if not results:
+            raise errors[0]
+        raise UpstreamRequestError(f"{len(errors)}/{n} 个候选回复请求失败: {str(errors[0])}", getattr(errors[0], "status_code", 500))
+    return results
+
+def multiplex_stream_responses(generators):
+    """将多个候选回复的 SSE 流按到达顺序合并为一个流，最后只发送一次 [DONE]"""
+    if len(generators) == 1:
+        yield from generators[0]
+        return
+
+    chunk_queue = queue.Queue()
+    finished = object()
+
+    def pump(generator):
+        try:
+            for chunk in generator:
+                if chunk != "data: [DONE]\n\n":
+                    chunk_queue.put(chunk)
+        finally:
+            chunk_queue.put(finished)
+
+    for generator in generators:
+        threading.Thread(target=pump, args=(generator,), daemon=True).start()
+
+    remaining = len(generators)
+    while remaining:
+        chunk = chunk_queue.get()
+        if chunk is finished:
+            remaining -= 1
+            continue
+        yield chunk
+    yield "data: [DONE]\n\n"
+
+class TokenHealthProber:
+    """后台令牌健康探测：周期性地用 /rest/rate-limits 查询每个令牌在各模型上的真实限额并校准本地状态，
+    各次探测在周期内均匀分布并加入随机抖动，避免集中请求上游"""
+    def __init__(self):
+        self._thread = None
+        self.stats = {"rounds": 0, "probes": 0, "valid": 0, "invalid": 0, "unknown": 0, "reconciled": 0, "lastRoundAt": None}
+
+    def start(self):
+        if CONFIG["TOKEN_PROBE"]["HEALTH_INTERVAL"] <= 0 or CONFIG["API"]["IS_CUSTOM_SSO"] or self._thread:
+            return
+        self._thread = threading.Thread(target=self.run, name="token-health", daemon=True)
+        self._thread.start()
+        logger.info(f"令牌健康探测已启动，周期 {CONFIG['TOKEN_PROBE']['HEALTH_INTERVAL']} 秒", "TokenProbe")
+
+    def collect_targets(self):
+        """轮询中的令牌与已移出等待恢复的令牌都需要探测"""
+        targets = []
+        with token_manager.token_lock:
+            for model in token_manager.model_config:
+                tokens = [entry["token"] for entry in token_manager.get_token_array_for_model(model)]
+                tokens += [token for token, expired_model, _ in token_manager.expired_tokens if expired_model == model]
+                targets += [(model, token) for token in dict.fromkeys(tokens)]
+        return targets
+
+    def probe(self, model, token, statsig_id):
+        state, limits = Utils.probe_token(token, model, statsig_id)
+        self.stats["probes"] += 1
+        self.stats[state] += 1
+        if state == "valid" and token_manager.apply_rate_limits(model, token, limits):
+            self.stats["reconciled"] += 1
+        elif state == "invalid":
+            logger.warning(f"令牌探测被上游拒绝，移出{model}轮询", "TokenProbe")
+            token_manager.revoke_token_for_model(model, token)
+
+    def run(self):
+        time.sleep(random.uniform(0, min(CONFIG["TOKEN_PROBE"]["HEALTH_INTERVAL"], 60)))
+        while True:
+            interval = CONFIG["TOKEN_PROBE"]["HEALTH_INTERVAL"]
+            started_at = time.time()
+            try:
+                targets = self.collect_targets()
+                pace = interval / len(targets) if targets else 0
+                for model, token in targets:
+                    # 每次探测单独取一个 x-statsig-id，与对话请求一致
+                    self.probe(model, token, statsig_pool.get())
+                    time.sleep(pace * random.uniform(0.5, 1.5))
+                if targets:
+                    token_manager.save_token_status()
+                self.stats["rounds"] += 1
+                self.stats["lastRoundAt"] = int(time.time() * 1000)
+            except Exception as error:
+                logger.error(f"令牌健康探测异常: {str(error)}", "TokenProbe")
+            time.sleep(max(0, interval - (time.time() - started_at)) + random.uniform(0, interval * 0.1))
+
+    def get_status(self):
+        return {"enabled": self._thread is not None, "interval": CONFIG["TOKEN_PROBE"]["HEALTH_INTERVAL"], **self.stats}
+
+class BatchManager:
+    """离线批量对话任务：输入输出以 JSONL 保存在 /data 下，由后台线程池按令牌容量执行，重启后可继续"""
+    def __init__(self):
+        self.batch_dir = Path(CONFIG["BATCH"]["DIR"])
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(CONFIG["BATCH"]["WORKERS"])
+        self._executor = ThreadPoolExecutor(max_workers=CONFIG["BATCH"]["WORKERS"], thread_name_prefix="batch")
+        # 停机时不再提交新请求，已提交的请求写完结果后才算结束
+        self._idle = threading.Condition()
+        self.inflight = 0
+        self.stopping = False
+
+    def job_path(self, batch_id, name):
+        return self.batch_dir / batch_id / name
+
+    def _save_job(self, job):
+        with open(self.job_path(job["id"], "meta.json"), 'w', encoding='utf-8') as f:
+            json.dump(job, f, indent=2, ensure_ascii=False)
+
+    def create_job(self, input_text):
+        items = []
+        for line_number, line in enumerate(input_text.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError:
+                raise ValueError(f"第 {line_number} 行不是有效的 JSON")
+            if not item.get("custom_id") or not isinstance(item.get("body"), dict):
+                raise ValueError(f"第 {line_number} 行缺少 custom_id 或 body")
+            items.append(item)
+        if not items:
+            raise ValueError("批量任务没有任何请求")
+        if len({item["custom_id"] for item in items}) != len(items):
+            raise ValueError("custom_id 不能重复")
+
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        self.job_path(batch_id, "").mkdir(parents=True, exist_ok=True)
+        with open(self.job_path(batch_id, "input.jsonl"), 'w', encoding='utf-8') as f:
+            for item in items:
+                f.write(json.dumps(item, ensure_ascii=False) + "\n")
+
+        job = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": "/v1/chat/completions",
+            "status": "in_progress",
+            "created_at": int(time.time()),
+            "completed_at": None,
+            "request_counts": {"total": len(items), "completed": 0, "failed": 0}
+        }
+        with self._lock:
+            self.jobs[batch_id] = job
+            self._save_job(job)
+        self._start_job(batch_id)
+        logger.info(f"已创建批量任务 {batch_id}，共 {len(items)} 个请求", "Batch")
+        return job
+
+    def resume_jobs(self):
+        """启动时恢复 /data 下未完成的批量任务"""
+        if not self.batch_dir.exists():
+            return
+        for meta_file in self.batch_dir.glob("*/meta.json"):
+            try:
+                with open(meta_file, 'r', encoding='utf-8') as f:
+                    job = json.load(f)
+                self.jobs[job["id"]] = job
+                if job["status"] in ("in_progress", "cancelling"):
+                    logger.info(f"恢复批量任务 {job['id']}", "Batch")
+                    self._start_job(job["id"])
+            except Exception as error:
+                logger.error(f"加载批量任务失败 {meta_file}: {str(error)}", "Batch")
+
+    def cancel_job(self, batch_id):
+        with self._lock:
+            job = self.jobs[batch_id]
+            if job["status"] == "in_progress":
+                job["status"] = "cancelling"
+                self._save_job(job)
+        return job
+
+    def _start_job(self, batch_id):
+        thread = threading.Thread(target=self._run_job, args=(batch_id,), daemon=True)
+        thread.start()
+
+    def _run_job(self, batch_id):
+        job = self.jobs[batch_id]
+        output_file = self.job_path(batch_id, "output.jsonl")
+        done_ids = set()
+        if output_file.exists():
+            with open(output_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        done_ids.add(json.loads(line)["custom_id"])
+                    except (json.JSONDecodeError, KeyError):
+                        continue
+
+        pending = []
+        stopped = False
+        with open(self.job_path(batch_id, "input.jsonl"), 'r', encoding='utf-8') as f:
+            for line in f:
+                item = json.loads(line)
+                if item["custom_id"] in done_ids:
+                    continue
+                if job["status"] != "in_progress":
+                    break
+                self._wait_for_capacity(job, item["body"].get("model"))
+                self._slots.acquire()
+                with self._idle:
+                    stopped = self.stopping
+                    if not stopped:
+                        self.inflight += 1
+                if stopped:
+                    self._slots.release()
+                    break
+                pending.append(self._executor.submit(self._run_request, job, item))
+
+        for future in pending:
+            future.result()
+        if stopped:
+            # 保持进行中状态，重启后由 resume_jobs 继续
+            return
+        with self._lock:
+            job["status"] = "cancelled" if job["status"] == "cancelling" else "completed"
+            job["completed_at"] = int(time.time())
+            self._save_job(job)
+        logger.info(f"批量任务 {batch_id} 已结束: {job['status']}", "Batch")
+
+    def _wait_for_capacity(self, job, model):
+        """令牌池耗尽时按最近的恢复时间等待，避免请求在重试循环中失败"""
+        while model in CONFIG["MODELS"] and job["status"] == "in_progress" and not self.stopping and not Utils.resolve_available_model(model):
+            delay = token_manager.get_next_recovery_delay(model)
+            logger.info(f"{model} 暂无可用令牌，批量任务 {job['id']} 等待 {int(delay)} 秒", "Batch")
+            time.sleep(min(max(delay, 5), 300))
+
+    def _run_request(self, job, item):
+        body = {**item["body"], "stream": False}
+        record = {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": item["custom_id"], "response": None, "error": None}
+        try:
+            model = Utils.resolve_available_model(body.get("model")) or body.get("model")
+            limiter = GenerationLimiter.from_request(body)
+            used_model, content = send_chat_request(body, model, False, limiter=limiter)
+            record["response"] = {
+                "status_code": 200,
+                "body": MessageProcessor.create_chat_response(content.getvalue(), used_model, finish_reason=limiter.finish_reason)
+            }
+        except Exception as error:
+            logger.error(f"批量请求 {item['custom_id']} 失败: {str(error)}", "Batch")
+            record["error"] = {"message": str(error), "status_code": getattr(error, "status_code", 500)}
+        finally:
+            self._slots.release()
+
+        try:
+            with self._lock:
+                with open(self.job_path(job["id"], "output.jsonl"), 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                job["request_counts"]["failed" if record["error"] else "completed"] += 1
+                self._save_job(job)
+        finally:
+            with self._idle:
+                self.inflight -= 1
+                self._idle.notify_all()
+
+    def stop(self):
+        """停机：不再提交新的批量请求"""
+        with self._idle:
+            self.stopping = True
+
+    def wait_idle(self, timeout):
+        """等待已提交的批量请求写入结果，返回超时后仍未完成的数量"""
+        deadline = time.monotonic() + timeout
+        with self._idle:
+            while self.inflight and deadline > time.monotonic():
+                self._idle.wait(deadline - time.monotonic())
+            return self.inflight
+
+batch_manager = BatchManager()
+token_health_prober = TokenHealthProber()
+
+class ConfigWatcher:
+    """热加载配置文件：JSON 顶层键与 CONFIG 相同，另支持 MODEL_LIMITS（各模型限额）与 HEADERS（请求头）。
+
+    每次加载都以启动时的环境变量配置为基础合并出一份新的 CONFIG 并整体替换，
+    文件中删除的项恢复为环境变量的值；文件无效时保留当前配置。
+    """
+    # 运行时由接口维护的项，重新加载时沿用当前值
+    RUNTIME_KEYS = (("API", "SIGNATURE_COOKIE"), ("SERVER", "COOKIE"), ("SERVER", "CF_CLEARANCE"))
+    # 只在启动时读取的项，修改后需要重启
+    RESTART_KEYS = ("SERVER", "CONFIG_FILE", "TOKEN_STATUS_FILE", "BATCH")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self.base_config = None
+        self.base_headers = None
+        self.mtime = None
+        self.version = 0
+        self.loaded_at = None
+        self.error = None
+
+    def merge(self, base, overrides, path=""):
+        merged = copy.deepcopy(base)
+        for key, value in overrides.items():
+            name = f"{path}{key}"
+            if key not in base:
+                raise ValueError(f"未知配置项: {name}")
+            if isinstance(base[key], dict):
+                if not isinstance(value, dict):
+                    raise ValueError(f"配置项 {name} 应为对象")
+                merged[key] = self.merge(base[key], value, f"{name}.")
+            elif base[key] is not None and value is not None and not isinstance(value, type(base[key])) \
+                    and not (isinstance(base[key], float) and isinstance(value, int)):
+                raise ValueError(f"配置项 {name} 类型应为 {type(base[key]).__name__}")
+            else:
+                merged[key] = value
+        return merged
+
+    def build(self, overrides):
+        """返回 (新 CONFIG, 新请求头, 模型限额)，校验失败时抛出 ValueError"""
+        if not isinstance(overrides, dict):
+            raise ValueError("配置文件顶层应为对象")
+        overrides = dict(overrides)
+        model_limits = overrides.pop("MODEL_LIMITS", {}) or {}
+        headers = overrides.pop("HEADERS", {}) or {}
+        if not isinstance(model_limits, dict) or not all(isinstance(value, dict) for value in model_limits.values()):
+            raise ValueError("MODEL_LIMITS 应为 {模型: {RequestFrequency, ExpirationTime}}")
+        if not isinstance(headers, dict) or not all(isinstance(value, str) for value in headers.values()):
+            raise ValueError("HEADERS 应为 {请求头: 字符串}")
+        for section, key in self.RUNTIME_KEYS:
+            if key in overrides.get(section, {}):
+                raise ValueError(f"配置项 {section}.{key} 由运行时维护，不能在配置文件中设置")
+        config = self.merge(self.base_config, overrides)
+        for key in self.RESTART_KEYS:
+            if key in overrides and config[key] != CONFIG[key]:
+                logger.warning(f"配置项 {key} 需要重启后生效", "Config")
+        for section, key in self.RUNTIME_KEYS:
+            config[section][key] = CONFIG[section][key]
+        for key in self.RESTART_KEYS:
+            config[key] = CONFIG[key]
+        return config, {**self.base_headers, **headers}, model_limits
+
+    def load(self, force=False):
+        """配置文件有变化时重新加载，返回是否应用了新配置"""
+        global CONFIG, DEFAULT_HEADERS
+        with self._lock:
+            if self.base_config is None:
+                self.base_config = copy.deepcopy(CONFIG)
+                self.base_headers = dict(DEFAULT_HEADERS)
+            path = Path(CONFIG["CONFIG_FILE"]["PATH"])
+            mtime = path.stat().st_mtime_ns if path.exists() else None
+            if mtime == self.mtime and not force:
+                return False
+            # 无论成功与否都记录修改时间，同一份无效文件只报错一次
+            self.mtime = mtime
+            try:
+                overrides = json.loads(path.read_text(encoding='utf-8')) if mtime is not None else {}
+                config, headers, model_limits = self.build(overrides)
+                proxy_changed = config["API"]["PROXY"] != CONFIG["API"]["PROXY"]
+                token_manager.apply_model_limits(model_limits)
+            except (OSError, ValueError) as error:
+                self.error = str(error)
+                logger.error(f"配置文件加载失败，继续使用当前配置: {error}", "Config")
+                return False
+
+            # 整体替换快照，已在处理中的请求继续使用各自已读取的值
+            CONFIG = config
+            DEFAULT_HEADERS = headers
+            if proxy_changed:
+                Utils.init_proxy_pool()
+            response_cache.resize(config["RESPONSE_CACHE"]["MAX_SIZE"], config["RESPONSE_CACHE"]["TTL"])
+            conversation_store.resize(config["CONVERSATION"]["MAX_SIZE"], config["CONVERSATION"]["TTL"])
+            self.version += 1
+            self.loaded_at = int(time.time() * 1000)
+            self.error = None
+            logger.info(f"配置已加载，版本 {self.version}: {path}", "Config")
+            return True
+
+    def start(self):
+        if CONFIG["CONFIG_FILE"]["RELOAD_INTERVAL"] <= 0 or self._thread:
+            return
+        self._thread = threading.Thread(target=self.run, name="config-watcher", daemon=True)
+        self._thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(CONFIG["CONFIG_FILE"]["RELOAD_INTERVAL"])
+            try:
+                self.load()
+            except Exception as error:
+                logger.error(f"配置文件检查失败: {str(error)}", "Config")
+
+    def get_status(self):
+        return {
+            "path": CONFIG["CONFIG_FILE"]["PATH"],
+            "version": self.version,
+            "loadedAt": self.loaded_at,
+            "error": self.error,
+            "modelLimits": token_manager.model_config
+        }
+
+config_watcher = ConfigWatcher()
+
+class ChargedStream:
+    """已扣费的流式回复：输出结束或中途关闭时结算扣费记录。
+    生成器尚未开始迭代时关闭不会执行其 finally，放弃这类回复需调用 discard 关闭上游连接并结算"""
+    def __init__(self, controller, generator, charge_id, response=None):
+        self.controller = controller
+        self.generator = generator
+        self.charge_id = charge_id
+        self.response = response
+
+    def __iter__(self):
+        try:
+            yield from self.generator
+        finally:
+            self.controller.settle(self.charge_id)
+
+    def discard(self):
+        self.generator.close()
+        if self.response is not None:
+            # close 会等待 libcurl 结束传输，放到后台执行
+            threading.Thread(target=self.response.close, daemon=True).start()
+        self.controller.settle(self.charge_id)
+
+class DrainController:
+    """优雅停机：收到 SIGTERM 后拒绝新请求，等待进行中的请求完成，
+    超时仍未完成的对话退还令牌次数，最后将令牌状态落盘"""
+    # 排空期间仍然响应、也不计入进行中请求的探测路径
+    PROBE_PATHS = ("/healthz", "/readyz")
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._charge_ids = itertools.count(1)
+        self._thread = None
+        self.draining = False
+        self.active = 0
+        # 已向上游扣费、回复尚未结束的对话: id -> (模型, 令牌)
+        self.charges = {}
+        self.server = None
+
+    def wrap(self, wsgi_app):
+        def middleware(environ, start_response):
+            if environ.get("PATH_INFO") in self.PROBE_PATHS:
+                return wsgi_app(environ, start_response)
+            if self.draining:
+                start_response("503 SERVICE UNAVAILABLE", [
+                    ("Content-Type", "application/json"),
+                    ("Retry-After", "1"),
+                    ("Connection", "close")
+                ])
+                return [json.dumps({"error": "服务正在停止，请稍后重试"}, ensure_ascii=False).encode('utf-8')]
+            with self._condition:
+                self.active += 1
+            try:
+                # 流式响应在迭代结束、连接关闭时才算完成
+                return ClosingIterator(wsgi_app(environ, start_response), self._finish)
+            except BaseException:
+                self._finish()
+                raise
+        return middleware
+
+    def _finish(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    def charge(self, model, token):
+        charge_id = next(self._charge_ids)
+        with self._condition:
+            self.charges[charge_id] = (model, token)
+        return charge_id
+
+    def settle(self, charge_id):
+        with self._condition:
+            self.charges.pop(charge_id, None)
+
+    def guard_stream(self, generator, charge_id, response=None):
+        return ChargedStream(self, generator, charge_id, response)
+
+    def handle_signal(self, signum, frame):
+        if self._thread:
+            # 再次收到信号时不再等待
+            raise KeyboardInterrupt
+        self._thread = threading.Thread(target=self.drain, name="drain", daemon=True)
+        self._thread.start()
+
+    def drain(self):
+        logger.info("收到停止信号，开始排空请求", "Server")
+        self.draining = True
+        batch_manager.stop()
+        token_manager.events.interrupt()
+        time.sleep(CONFIG["SHUTDOWN"]["GRACE"])
+        if self.server:
+            # 关闭监听套接字，新连接交给接管端口的新进程；已建立的连接由各自的线程继续处理
+            self.server.shutdown()
+            self.server.server_close()
+
+        deadline = time.monotonic() + CONFIG["SHUTDOWN"]["TIMEOUT"]
+        with self._condition:
+            while self.active and deadline > time.monotonic():
+                self._condition.wait(deadline - time.monotonic())
+        # 批量任务的对话也记录了扣费但不经过 WSGI，需等它们结束后再结算，剩下的扣费才确实被中断
+        active = batch_manager.wait_idle(max(0, deadline - time.monotonic()))
+        with self._condition:
+            aborted = list(self.charges.values())
+            self.charges.clear()
+            active += self.active
+
+        for model, token in aborted:
+            token_manager.reduce_token_request_count(model, 1, token)
+        with token_manager.token_lock:
+            token_manager.save_token_status()
+            token_manager.save_daily_usage()
+        logger.info(f"排空完成，中断 {active} 个请求，退还 {len(aborted)} 次对话", "Server")
+        if active:
+            # 超时未完成的请求已退还次数，直接退出，不再等待上游传输结束
+            os._exit(0)
+
+    def wait(self):
+        if self._thread:
+            self._thread.join()
+
+    def get_status(self):
+        with self._condition:
+            return {"draining": self.draining, "active": self.active, "charges": len(self.charges)}
+
+drain_controller = DrainController()
+
 def initialization():
     # 初始化代理池
     Utils.init_proxy_pool()
@@ -1447,15 +4001,11 @@ def initialization():
     sso_pro_array = os.environ.get("SSO_PRO", "").split(',')
     logger.info("开始加载令牌", "Server")
     token_manager.load_token_status()
-    for sso in sso_array:
-        if sso:
-            token_manager.add_token(f"sso-rw={sso};sso={sso}",True)
+    token_manager.add_tokens([f"sso-rw={sso};sso={sso}" for sso in sso_array if sso], isinitialization=True)
     
     # 加载SSO_PRO令牌（仅用于grok-4）
     logger.info("开始加载SSO_PRO令牌", "Server")
-    for sso_pro in sso_pro_array:
-        if sso_pro:
-            token_manager.add_pro_token(f"sso-rw={sso_pro};sso={sso_pro}",True)
+    token_manager.add_tokens([f"sso-rw={sso_pro};sso={sso_pro}" for sso_pro in sso_pro_array if sso_pro], pro=True, isinitialization=True)
     token_manager.save_token_status()
 
     logger.info(f"成功加载令牌: {json.dumps(token_manager.get_all_tokens(), indent=2)}", "Server")
@@ -1465,7 +4015,7 @@ logger.info("初始化完成", "Server")
 
 
 app = Flask(__name__)
-app.wsgi_app = ProxyFix(app.wsgi_app)
+app.wsgi_app = drain_controller.wrap(ProxyFix(app.wsgi_app))
 app.secret_key = os.environ.get('FLASK_SECRET_KEY') or secrets.token_hex(16)
 app.json.sort_keys = False
 
@@ -1496,32 +4046,75 @@ def get_manager_tokens():
     if not check_auth():
         return jsonify({"error": "Unauthorized"}), 401
     
-    # 获取基本令牌状态
-    token_status = token_manager.get_token_status_map()
-    
-    # 添加每日使用情况信息
-    today = token_manager.get_today_key()
-    daily_usage = token_manager.free_grok4_usage.get(today, {})
-    today_usage = sum(daily_usage.values())
-    
-    # 计算每日限制：令牌数量 × 每个令牌10次
-    grok4_free_token_count = len(token_manager.token_model_map.get("grok-4-free", []))
-    daily_limit = grok4_free_token_count * 10
-    
-    result = {
-        "tokens": token_status,
-        "dailyUsage": {
-            "today": today,
-            "grok4Free": {
-                "used": today_usage,
-                "limit": daily_limit,
-                "remaining": max(0, daily_limit - today_usage),
-                "tokenCount": grok4_free_token_count
-            }
-        }
-    }
-    
-    return jsonify(result)
+    # 状态版本与查询参数未变化时返回 304；按恢复时间筛选的结果随时间变化，按分钟刷新
+    daily_usage = token_manager.get_daily_usage_info()
+    query = sorted(request.args.items())
+    recover_within = request.args.get('recover_within', type=int)
+    etag_source = f"{token_manager.status_version}|{daily_usage['today']}|{query}"
+    if recover_within is not None:
+        etag_source += f"|{int(time.time() // 60)}"
+    etag = hashlib.sha1(etag_source.encode('utf-8')).hexdigest()[:16]
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+
+    # 先记录事件游标再读取状态，订阅 /manager/api/events 时从该游标续传不会遗漏变化
+    event_cursor = token_manager.events.last_id
+    # 不带 page 参数时保持原有格式，返回全部令牌状态
+    if 'page' not in request.args:
+        result = {"tokens": token_manager.get_token_status_map(), "dailyUsage": daily_usage}
+    else:
+        result = token_manager.query_token_status(
+            page=request.args.get('page', 1, type=int),
+            page_size=min(max(request.args.get('page_size', 30, type=int), 1), 200),
+            search=request.args.get('search', ''),
+            status=request.args.get('status', 'all'),
+            model=request.args.get('model') or None,
+            recover_within=recover_within,
+            sort=request.args.get('sort', 'added')
+        )
+        result["dailyUsage"] = daily_usage
+        result["eventCursor"] = event_cursor
+
+    response = jsonify(result)
+    response.headers["ETag"] = f'"{etag}"'
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+@app.route('/manager/api/events')
+def stream_manager_events():
+    """以 SSE 推送令牌状态变化，cursor 参数或 Last-Event-ID 为续传位置；
+    有变化时最多每秒附带一次汇总，游标失效时发送 reset 通知客户端重新获取"""
+    if not check_auth():
+        return jsonify({"error": "Unauthorized"}), 401
+    cursor = request.headers.get('Last-Event-ID', type=int)
+    if cursor is None:
+        cursor = request.args.get('cursor', token_manager.events.last_id, type=int)
+    event_bus = token_manager.events
+
+    def generate():
+        nonlocal cursor
+        last_summary_at = 0
+        summary_pending = False
+        yield "retry: 3000\n\n"
+        while not drain_controller.draining:
+            events = event_bus.read_since(cursor, 1 if summary_pending else 15)
+            if events is None:
+                cursor = event_bus.last_id
+                yield f"id: {cursor}\nevent: reset\ndata: {{}}\n\n"
+                continue
+            for event in events:
+                cursor = event["id"]
+                yield f"id: {cursor}\nevent: token\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+            summary_pending = summary_pending or bool(events)
+            if summary_pending and time.time() - last_summary_at >= 1:
+                summary = {"summary": token_manager.get_status_index()["summary"], "dailyUsage": token_manager.get_daily_usage_info()}
+                yield f"event: summary\ndata: {json.dumps(summary)}\n\n"
+                last_summary_at = time.time()
+                summary_pending = False
+            elif not events:
+                yield ": ping\n\n"
+
+    return Response(stream_with_context(generate()), content_type='text/event-stream', headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.route('/manager/api/add', methods=['POST'])
 def add_manager_token():
@@ -1536,6 +4129,15 @@ def add_manager_token():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/manager/api/import', methods=['POST'])
+def import_manager_tokens():
+    if not check_auth():
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        return jsonify(import_tokens(request.json or {}))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/manager/api/delete', methods=['POST'])
 def delete_manager_token():
     if not check_auth():
@@ -1557,11 +4159,56 @@ def setCf_Manager_clearance():
         cf_clearance = request.json.get('cf_clearance')
         if not cf_clearance:
             return jsonify({"error": "cf_clearance is required"}), 400
+        # 指定 proxy（地址或从 1 开始的序号）时只设置该代理 IP 对应的 cf_clearance
+        if request.json.get('proxy'):
+            proxy = proxy_bindings.resolve_proxy(request.json.get('proxy'))
+            if not proxy:
+                return jsonify({"error": "proxy not found"}), 404
+            proxy_bindings.set_clearance(proxy, cf_clearance)
+            return jsonify({"success": True})
         CONFIG["SERVER"]['CF_CLEARANCE'] = cf_clearance
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/manager/api/proxies', methods=['GET'])
+def get_manager_proxies():
+    if not check_auth():
+        return jsonify({"error": "Unauthorized"}), 401
+    return jsonify(proxy_bindings.get_status())
+
+@app.route('/manager/api/token_health', methods=['GET'])
+def get_manager_token_health():
+    if not check_auth():
+        return jsonify({"error": "Unauthorized"}), 401
+    return jsonify(token_health_prober.get_status())
+
+@app.route('/manager/api/config', methods=['GET'])
+def get_manager_config():
+    if not check_auth():
+        return jsonify({"error": "Unauthorized"}), 401
+    return jsonify(config_watcher.get_status())
+
+@app.route('/manager/api/config/reload', methods=['POST'])
+def reload_manager_config():
+    if not check_auth():
+        return jsonify({"error": "Unauthorized"}), 401
+    config_watcher.load(force=True)
+    status = config_watcher.get_status()
+    return jsonify(status), 400 if status["error"] else 200
+
+@app.route('/manager/api/breakers', methods=['GET'])
+def get_manager_breakers():
+    if not check_auth():
+        return jsonify({"error": "Unauthorized"}), 401
+    return jsonify(shield_breakers.get_status())
+
+@app.route('/manager/api/errors', methods=['GET'])
+def get_manager_upstream_errors():
+    if not check_auth():
+        return jsonify({"error": "Unauthorized"}), 401
+    return jsonify(upstream_errors.get_status())
+
 
 @app.route('/get/tokens', methods=['GET'])
 def get_tokens():
@@ -1588,6 +4235,65 @@ def add_token():
         logger.error(str(error), "Server")
         return jsonify({"error": '添加sso令牌失败'}), 500
     
+def import_tokens(data):
+    """批量导入令牌：sso 为数组或以逗号、换行分隔的字符串，去重并跳过已有令牌后，
+    validate 为 true（默认）时并发探测，只导入探测有效的令牌；strict 为 true 时无法判断的令牌也不导入"""
+    raw = data.get('sso') or []
+    if isinstance(raw, str):
+        raw = raw.replace('\n', ',').split(',')
+    received = [sso.strip() for sso in raw if isinstance(sso, str) and sso.strip()]
+    ssos = list(dict.fromkeys(received))
+    pro = bool(data.get('pro'))
+    model = "grok-4" if pro else "grok-3"
+
+    with token_manager.token_lock:
+        existing = {entry["token"] for entry in token_manager.get_token_array_for_model(model)}
+        existing.update(token for token, expired_model, _ in token_manager.get_expired_tokens() if expired_model == model)
+    candidates = [sso for sso in ssos if f"sso-rw={sso};sso={sso}" not in existing]
+
+    result = {
+        "received": len(received),
+        "duplicates": len(received) - len(ssos),
+        "existing": len(ssos) - len(candidates),
+        "invalid": [],
+        "unverified": []
+    }
+    accepted = candidates
+    if candidates and data.get('validate', True):
+        with ThreadPoolExecutor(max_workers=max(1, CONFIG["TOKEN_PROBE"]["WORKERS"])) as executor:
+            # 每次探测单独取一个 x-statsig-id，不在并发探测之间共用
+            states = list(executor.map(
+                lambda sso: Utils.probe_token(f"sso-rw={sso};sso={sso}", model, statsig_pool.get())[0],
+                candidates
+            ))
+        accepted = []
+        for sso, state in zip(candidates, states):
+            if state == "invalid":
+                result["invalid"].append(sso)
+                continue
+            if state == "unknown":
+                result["unverified"].append(sso)
+                if data.get('strict'):
+                    continue
+            accepted.append(sso)
+
+    result["added"] = len(token_manager.add_tokens([f"sso-rw={sso};sso={sso}" for sso in accepted], pro=pro))
+    logger.info(f"批量导入令牌: 新增 {result['added']}，无效 {len(result['invalid'])}，未验证 {len(result['unverified'])}", "TokenManager")
+    return result
+
+@app.route('/import/tokens', methods=['POST'])
+def import_tokens_api():
+    auth_token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    if CONFIG["API"]["IS_CUSTOM_SSO"]:
+        return jsonify({"error": '自定义的SSO令牌模式无法添加sso令牌'}), 403
+    elif auth_token != CONFIG["API"]["API_KEY"]:
+        return jsonify({"error": 'Unauthorized'}), 401
+    try:
+        return jsonify(import_tokens(request.json or {})), 200
+    except Exception as error:
+        logger.error(str(error), "Server")
+        return jsonify({"error": '批量导入sso令牌失败'}), 500
+
 @app.route('/set/cf_clearance', methods=['POST'])
 def setCf_clearance():
     auth_token = request.headers.get('Authorization', '').replace('Bearer ', '')
@@ -1595,6 +4301,12 @@ def setCf_clearance():
         return jsonify({"error": 'Unauthorized'}), 401
     try:
         cf_clearance = request.json.get('cf_clearance')
+        if request.json.get('proxy'):
+            proxy = proxy_bindings.resolve_proxy(request.json.get('proxy'))
+            if not proxy:
+                return jsonify({"error": '代理不存在'}), 404
+            proxy_bindings.set_clearance(proxy, cf_clearance)
+            return jsonify({"message": '设置代理cf_clearance成功'}), 200
         CONFIG["SERVER"]['CF_CLEARANCE'] = cf_clearance
         return jsonify({"message": '设置cf_clearance成功'}), 200
     except Exception as error:
@@ -1617,6 +4329,60 @@ def delete_token():
         logger.error(str(error), "Server")
         return jsonify({"error": '删除sso令牌失败'}), 500
 
+def check_api_auth():
+    auth_token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    return auth_token == CONFIG["API"]["API_KEY"]
+
+@app.route('/v1/batches', methods=['POST'])
+def create_batch():
+    if CONFIG["API"]["IS_CUSTOM_SSO"]:
+        return jsonify({"error": '自定义的SSO令牌模式无法使用批量任务'}), 403
+    elif not check_api_auth():
+        return jsonify({"error": 'Unauthorized'}), 401
+    try:
+        upload = request.files.get('file')
+        input_text = upload.read().decode('utf-8') if upload else request.get_data(as_text=True)
+        return jsonify(batch_manager.create_job(input_text)), 200
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    except Exception as error:
+        logger.error(str(error), "Batch")
+        return jsonify({"error": '创建批量任务失败'}), 500
+
+@app.route('/v1/batches', methods=['GET'])
+def list_batches():
+    if not check_api_auth():
+        return jsonify({"error": 'Unauthorized'}), 401
+    jobs = sorted(batch_manager.jobs.values(), key=lambda job: job["created_at"], reverse=True)
+    return jsonify({"object": "list", "data": jobs})
+
+@app.route('/v1/batches/<batch_id>', methods=['GET'])
+def get_batch(batch_id):
+    if not check_api_auth():
+        return jsonify({"error": 'Unauthorized'}), 401
+    if batch_id not in batch_manager.jobs:
+        return jsonify({"error": '批量任务不存在'}), 404
+    return jsonify(batch_manager.jobs[batch_id])
+
+@app.route('/v1/batches/<batch_id>/cancel', methods=['POST'])
+def cancel_batch(batch_id):
+    if not check_api_auth():
+        return jsonify({"error": 'Unauthorized'}), 401
+    if batch_id not in batch_manager.jobs:
+        return jsonify({"error": '批量任务不存在'}), 404
+    return jsonify(batch_manager.cancel_job(batch_id))
+
+@app.route('/v1/batches/<batch_id>/output', methods=['GET'])
+def get_batch_output(batch_id):
+    if not check_api_auth():
+        return jsonify({"error": 'Unauthorized'}), 401
+    if batch_id not in batch_manager.jobs:
+        return jsonify({"error": '批量任务不存在'}), 404
+    output_file = batch_manager.job_path(batch_id, "output.jsonl")
+    if not output_file.exists():
+        return Response('', content_type='application/jsonl')
+    return send_file(output_file, mimetype='application/jsonl')
+
 @app.route('/v1/models', methods=['GET'])
 def get_models():
     return jsonify({
@@ -1635,14 +4401,16 @@ def get_models():
 @app.route('/v1/chat/completions', methods=['POST'])
 def chat_completions():
     response_status_code = 500
+    # 配置热加载会整体替换 CONFIG，请求开始时取一次快照，整个请求使用同一份配置
+    config = CONFIG
     try:
         auth_token = request.headers.get('Authorization',
                                          '').replace('Bearer ', '')
         if auth_token:
-            if CONFIG["API"]["IS_CUSTOM_SSO"]:
+            if config["API"]["IS_CUSTOM_SSO"]:
                 result = f"sso={auth_token};sso-rw={auth_token}"
                 token_manager.set_token(result)
-            elif auth_token != CONFIG["API"]["API_KEY"]:
+            elif auth_token != config["API"]["API_KEY"]:
                 return jsonify({"error": 'Unauthorized'}), 401
         else:
             return jsonify({"error": 'API_KEY缺失'}), 401
@@ -1651,198 +4419,154 @@ def chat_completions():
         model = data.get("model")
         stream = data.get("stream", False)
         
-        # 如果用户请求 grok-4，自动选择合适的实现
-        if model == "grok-4":
-            # 优先使用 SSO_PRO 令牌的 grok-4
-            if token_manager.get_token_count_for_model("grok-4") > 0:
-                model = "grok-4"
-            # 如果没有 SSO_PRO 令牌，使用普通令牌的 grok-4-free  
-            elif token_manager.get_token_count_for_model("grok-4-free") > 0:
-                model = "grok-4-free"
-                logger.info("使用普通账号的grok-4-free服务", "Server")
-            else:
+        # 按回退链选择仍有容量的模型，例如 grok-4 无 SSO_PRO 令牌时使用 grok-4-free
+        if model in config["MODELS"]:
+            requested_model = model
+            model = Utils.resolve_available_model(requested_model)
+            if not model:
                 return jsonify({
                     "error": {
-                        "message": "grok-4 模型暂无可用令牌，请稍后重试",
+                        "message": f"{requested_model} 模型暂无可用令牌，请稍后重试",
                         "type": "server_error"
                     }
                 }), 429
-
-        retry_count = 0
-        is_network_error_retry = False
-        grok_client = GrokApiClient(model)
-        request_payload = grok_client.prepare_chat_request(data)
-        logger.info(json.dumps(request_payload,indent=2))
-
-        while retry_count < CONFIG["RETRY"]["MAX_ATTEMPTS"]:
-            retry_count += 1
-            
-            # 如果是网络错误重试，先恢复之前减少的计数，然后获取当前令牌
-            if is_network_error_retry:
-                # 重置标记
-                is_network_error_retry = False
-                # 获取当前令牌而不增加计数
-                CONFIG["API"]["SIGNATURE_COOKIE"] = Utils.create_auth_headers(model, True)
-            else:
-                # 正常获取下一个令牌并增加计数
-                CONFIG["API"]["SIGNATURE_COOKIE"] = Utils.create_auth_headers(model)
-
-            if not CONFIG["API"]["SIGNATURE_COOKIE"]:
-                raise ValueError('该模型无可用令牌')
-
-            logger.info(
-                f"当前令牌: {json.dumps(CONFIG['API']['SIGNATURE_COOKIE'], indent=2)}","Server")
-            logger.info(
-                f"当前可用模型的全部可用数量: {json.dumps(token_manager.get_remaining_token_request_capacity(), indent=2)}","Server")
-            
-            if CONFIG['SERVER']['CF_CLEARANCE']:
-                CONFIG["SERVER"]['COOKIE'] = f"{CONFIG['API']['SIGNATURE_COOKIE']};{CONFIG['SERVER']['CF_CLEARANCE']}" 
+            if model != requested_model:
+                logger.info(f"模型 {requested_model} 暂无可用令牌，回退至 {model}", "Server")
+
+        n = 1 if data.get("n") is None else data["n"]
+        if isinstance(n, bool) or not isinstance(n, int) or n < 1 or n > config["MAX_CHOICES"]:
+            response_status_code = 400
+            raise ValueError(f"n 应为 1-{config['MAX_CHOICES']} 之间的整数")
+
+        # 续聊模式下命中已有上游会话时，只发送最新消息，无需构建完整历史
+        conversation = None
+        if config["CONVERSATION"]["ENABLED"] and n == 1 and not config["API"]["IS_CUSTOM_SSO"]:
+            conversation = conversation_store.find(model, data.get("messages") or [])
+
+        def prepare():
+            # 解析图片与长历史，附件在选定令牌后上传；续聊时不需要
+            if conversation:
+                return None
+            request_payload = GrokApiClient(model, config).prepare_chat_request({**data, "model": model})
+            logger.info(json.dumps(request_payload,indent=2))
+            return request_payload
+
+        if stream:
+            results = fan_out_chat_requests(data, model, True, prepare(), n, conversation, config)
+            return Response(stream_with_context(
+                multiplex_stream_responses([generator for _, generator, _ in results])), content_type='text/event-stream')
+
+        def complete():
+            results = fan_out_chat_requests(data, model, False, prepare(), n, conversation, config)
+            response = MessageProcessor.create_chat_response(None, results[0][0])
+            response["choices"] = [
+                MessageProcessor.create_chat_response(None, used_model, index=index, finish_reason=limiter.finish_reason)["choices"][0]
+                for index, (used_model, _, limiter) in enumerate(results)
+            ]
+            return ChatCompletionBody(response, [content for _, content, _ in results])
+
+        # 自定义SSO模式下每个请求的令牌不同，不参与合并与缓存
+        if config["RESPONSE_CACHE"]["ENABLED"] and not config["API"]["IS_CUSTOM_SSO"]:
+            idempotency_key = request.headers.get('Idempotency-Key')
+            request_options = {
+                "n": n,
+                "stop": data.get("stop"),
+                "maxTokens": data.get("max_completion_tokens") or data.get("max_tokens")
+            }
+            if idempotency_key:
+                cache_key = ResponseCache.make_key(model, {**request_options, "idempotencyKey": idempotency_key})
             else:
-                CONFIG["SERVER"]['COOKIE'] = CONFIG['API']['SIGNATURE_COOKIE']
-            logger.info(json.dumps(request_payload,indent=2),"Server")
-            try:
-                # 添加请求间延迟，避免被检测
-                time.sleep(1)
-                
-                # 生成必要的请求头
-                xai_request_id = Utils.generate_xai_request_id()
-                statsig_id = Utils.get_statsig_id()
-                
-                # 构建请求头
-                request_headers = {
-                    **DEFAULT_HEADERS, 
-                    "Cookie": CONFIG["SERVER"]['COOKIE'],
-                    "x-xai-request-id": xai_request_id
-                }
-                
-                # 如果成功获取到 statsig_id 则添加到请求头
-                if statsig_id:
-                    request_headers["x-statsig-id"] = statsig_id
-                    logger.info(f"添加 x-statsig-id 到请求头", "Server")
-                else:
-                    logger.warning("无法获取 x-statsig-id，尝试不带签名发送请求", "Server")
-                
-                proxy_options = Utils.get_proxy_options()
-                response = curl_requests.post(
-                    f"{CONFIG['API']['BASE_URL']}/rest/app-chat/conversations/new",
-                    headers=request_headers,
-                    data=json.dumps(request_payload),
-                    impersonate="chrome133a",
-                    stream=True,
-                    timeout=30,
-                    verify=True,
-                    **proxy_options)
-                logger.info(CONFIG["SERVER"]['COOKIE'],"Server")
-                if response.status_code == 200:
-                    response_status_code = 200
-                    logger.info("请求成功", "Server")
-                    logger.info(f"当前{model}剩余可用令牌数: {token_manager.get_token_count_for_model(model)}","Server")
-
-                    try:
-                        if stream:
-                            return Response(stream_with_context(
-                                handle_stream_response(response, model)),content_type='text/event-stream')
-                        else:
-                            content = handle_non_stream_response(response, model)
-                            return jsonify(
-                                MessageProcessor.create_chat_response(content, model))
-
-                    except Exception as error:
-                        logger.error(str(error), "Server")
-                        if CONFIG["API"]["IS_CUSTOM_SSO"]:
-                            raise ValueError(f"自定义SSO令牌当前模型{model}的请求次数已失效")
-                        
-                        # 如果是网络连接错误，减少请求计数但不移除令牌
-                        if Utils.is_network_error(error):
-                            logger.info(f"响应处理时检测到网络连接错误，减少请求计数但保留令牌: {str(error)}", "Server")
-                            token_manager.reduce_token_request_count(model, 1)
-                            is_network_error_retry = True  # 标记为网络错误重试
-                            # 网络错误时继续重试，不抛出异常
-                            if token_manager.get_token_count_for_model(model) == 0:
-                                raise ValueError(f"{model} 次数已达上限，请切换其他模型或者重新对话")
-                            continue  # 继续重试循环
-                        else:
-                            # 其他错误则移除令牌
-                            logger.info(f"响应处理时检测到非网络错误，移除令牌: {str(error)}", "Server")
-                            token_manager.remove_token_for_model(model, CONFIG["API"]["SIGNATURE_COOKIE"])
-                            if token_manager.get_token_count_for_model(model) == 0:
-                                raise ValueError(f"{model} 次数已达上限，请切换其他模型或者重新对话")
-                elif response.status_code == 403:
-                    response_status_code = 403
-                    token_manager.reduce_token_request_count(model,1)#重置去除当前因为错误未成功请求的次数，确保不会因为错误未成功请求的次数导致次数上限
-                    if token_manager.get_token_count_for_model(model) == 0:
-                        raise ValueError(f"{model} 次数已达上限，请切换其他模型或者重新对话")
-                    print("状态码:", response.status_code)
-                    print("响应头:", response.headers)
-                    print("响应内容:", response.text)
-                    raise ValueError(f"IP暂时被封无法破盾，请稍后重试或者更换ip")
-                elif response.status_code == 429:
-                    response_status_code = 429
-                    token_manager.reduce_token_request_count(model,1)
-                    if CONFIG["API"]["IS_CUSTOM_SSO"]:
-                        raise ValueError(f"自定义SSO令牌当前模型{model}的请求次数已失效")
-
-                    token_manager.remove_token_for_model(
-                        model, CONFIG["API"]["SIGNATURE_COOKIE"])
-                    if token_manager.get_token_count_for_model(model) == 0:
-                        raise ValueError(f"{model} 次数已达上限，请切换其他模型或者重新对话")
-
-                else:
-                    if CONFIG["API"]["IS_CUSTOM_SSO"]:
-                        raise ValueError(f"自定义SSO令牌当前模型{model}的请求次数已失效")
-
-                    logger.error(f"令牌异常错误状态!status: {response.status_code}","Server")
-                    token_manager.remove_token_for_model(model, CONFIG["API"]["SIGNATURE_COOKIE"])
-                    logger.info(
-                        f"当前{model}剩余可用令牌数: {token_manager.get_token_count_for_model(model)}",
-                        "Server")
-
-            except Exception as e:
-                logger.error(f"请求处理异常: {str(e)}", "Server")
-                if CONFIG["API"]["IS_CUSTOM_SSO"]:
-                    raise
-                
-                # 如果是网络连接错误，减少请求计数但不移除令牌
-                if Utils.is_network_error(e):
-                    logger.info(f"检测到网络连接错误，减少请求计数但保留令牌: {str(e)}", "Server")
-                    token_manager.reduce_token_request_count(model, 1)
-                    is_network_error_retry = True  # 标记为网络错误重试
-                else:
-                    # 其他错误则移除令牌
-                    logger.info(f"检测到非网络错误，移除令牌: {str(e)}", "Server")
-                    token_manager.remove_token_for_model(model, CONFIG["API"]["SIGNATURE_COOKIE"])
-                
-                # 检查是否还有可用令牌
-                if token_manager.get_token_count_for_model(model) == 0:
-                    raise ValueError(f"{model} 次数已达上限，请切换其他模型或者重新对话")
-                
-                continue
-        if response_status_code == 403:
-            raise ValueError('IP暂时被封无法破盾，请稍后重试或者更换ip')
-        elif response_status_code == 500:
-            raise ValueError('当前模型所有令牌暂无可用，请稍后重试')
+                # 用原始消息生成键，命中缓存或合并时不再上传图片与文件
+                cache_key = ResponseCache.make_key(model, {**request_options, "messages": data.get("messages")})
+            body = response_cache.get_or_compute(cache_key, complete)
         else:
-            raise ValueError('请求失败，请检查网络连接或稍后重试')
+            body = complete()
+        return Response(body, content_type='application/json')
 
     except Exception as error:
         logger.error(str(error), "ChatAPI")
+        response_status_code = getattr(error, "status_code", response_status_code)
         return jsonify(
             {"error": {
                 "message": str(error),
                 "type": "server_error"
             }}), response_status_code
 
+def build_health_report():
+    """汇总节点状态，只读取增量维护的计数与熔断器状态，不遍历令牌；reasons 非空时节点不应接收新请求"""
+    capacity = token_manager.get_capacity_summary()
+    blocking_proxies = shield_breakers.count_blocking_proxies()
+    reasons = []
+    if drain_controller.draining:
+        reasons.append("draining")
+    if not CONFIG["API"]["IS_CUSTOM_SSO"] and not any(item["remaining"] for item in capacity.values()):
+        reasons.append("no_capacity")
+    if shield_breakers.global_open():
+        reasons.append("shield_open")
+    if Utils._proxy_pool and blocking_proxies == len(Utils._proxy_pool):
+        reasons.append("proxies_open")
+    return {
+        "status": "draining" if drain_controller.draining else ("unavailable" if reasons else "ready"),
+        "reasons": reasons,
+        "models": capacity,
+        "shield": {
+            "global": shield_breakers.global_breaker.state,
+            "proxies": len(Utils._proxy_pool),
+            "openProxies": blocking_proxies
+        },
+        "statsigPool": statsig_pool.depth(),
+        **drain_controller.get_status()
+    }
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """存活检查：进程能处理请求即返回 200，附带容量汇总"""
+    return jsonify(build_health_report())
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """就绪检查：排空中、所有模型都没有剩余次数或 403 盾熔断时返回 503，负载均衡据此摘除节点"""
+    report = build_health_report()
+    return jsonify(report), 503 if report["reasons"] else 200
+
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 def catch_all(path):
     return 'api运行正常', 200
 
-if __name__ == '__main__':
+def create_listen_socket(host, port):
+    """返回用于监听的文件描述符：优先使用 systemd 传入的套接字，开启 REUSE_PORT 时自行创建，否则返回 None 由 werkzeug 绑定"""
+    if os.environ.get("LISTEN_FDS") and int(os.environ.get("LISTEN_PID", os.getpid())) == os.getpid():
+        return 3
+    if not CONFIG["SHUTDOWN"]["REUSE_PORT"]:
+        return None
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(socket.SOMAXCONN)
+    sock.set_inheritable(True)
+    return sock.detach()
+
+def main():
+    global token_manager
     token_manager = AuthTokenManager()
+    config_watcher.load()
+    image_downscaler.start()
     initialization()
+    token_manager.start_daily_rollover()
+    batch_manager.resume_jobs()
+    token_health_prober.start()
+    statsig_pool.start()
+    config_watcher.start()
+
+    host, port = '0.0.0.0', CONFIG["SERVER"]["PORT"]
+    drain_controller.server = make_server(host, port, app, threaded=True, fd=create_listen_socket(host, port))
+    signal.signal(signal.SIGTERM, drain_controller.handle_signal)
+    signal.signal(signal.SIGINT, drain_controller.handle_signal)
+    logger.info(f"服务已启动: http://{host}:{port}", "Server")
+    drain_controller.server.serve_forever()
+    drain_controller.wait()
 
-    app.run(
-        host='0.0.0.0',
-        port=CONFIG["SERVER"]["PORT"],
-        debug=False
-    )
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""解析热路径微基准
+
+对每个模型家族的 NDJSON 响应流（录制文件优先，否则使用合成数据），分别测量上游每行都会经过的几个环节：
+
+- loads: `json.loads(chunk.decode("utf-8").strip())`
+- process: 模型家族对应的 `ResponseParser.parse_result` 解析与 `render_chunks` 渲染
+- search: `Utils.organize_search_results`
+- format: `MessageProcessor.create_chat_response` 与 SSE 序列化
+- pipeline: 以上环节串联，与 handle_stream_response 的单行处理一致
+
+每个环节按轮次计时，输出每行耗时的最小值/中位数/均值（纳秒）与每秒处理行数，
+并用 tracemalloc 统计每 1000 行的峰值内存与分配块数。
+
+    python benchmarks/bench_parsing.py
+    python benchmarks/bench_parsing.py --family grok-3-deepsearch --rounds 50 --save baseline.json
+    python benchmarks/bench_parsing.py --compare baseline.json
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).parent
+sys.path.insert(0, str(BENCH_DIR.parent))
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="grok2api-bench-"))
+
+import app  # noqa: E402
+from fixtures import FAMILIES, load_stream  # noqa: E402
+
+app.logger.logger.remove()
+app.CONFIG["SHOW_THINKING"] = True
+app.CONFIG["ISSHOW_SEARCH_RESULTS"] = True
+
+
+def parse_lines(lines):
+    return [json.loads(line.decode("utf-8").strip()) for line in lines]
+
+
+def response_results(lines):
+    return [line_json.get("result") or {} for line_json in parse_lines(lines)]
+
+
+def process_stream(results, model):
+    """按 handle_stream_response 的方式逐行解析并渲染"""
+    parser = app.GrokApiClient(model).create_response_parser()
+    tokens = []
+    for result in results:
+        for token, image_url, search_result in parser.render_chunks(parser.parse_result(result)):
+            if token:
+                tokens.append(token)
+    return tokens
+
+
+def format_tokens(tokens, model):
+    for token in tokens:
+        f"data: {json.dumps(app.MessageProcessor.create_chat_response(token, model, True))}\n\n"
+
+
+def search_results(results):
+    return [
+        result["response"]["webSearchResults"]
+        for result in results
+        if (result.get("response") or {}).get("webSearchResults")
+    ]
+
+
+def organize_search(searches):
+    for web_search_results in searches:
+        app.Utils.organize_search_results(web_search_results)
+
+
+def pipeline(lines, model):
+    format_tokens(process_stream(response_results(lines), model), model)
+
+
+def build_cases(family, lines):
+    results = response_results(lines)
+    tokens = process_stream(results, family)
+    cases = {
+        "loads": lambda: parse_lines(lines),
+        "process": lambda: process_stream(results, family),
+        "format": lambda: format_tokens(tokens, family),
+        "pipeline": lambda: pipeline(lines, family),
+    }
+    searches = search_results(results)
+    if searches:
+        cases["search"] = lambda: organize_search(searches)
+    return cases
+
+
+def time_case(func, chunks, rounds):
+    func()
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter_ns()
+        func()
+        samples.append((time.perf_counter_ns() - start) / chunks)
+    return {
+        "min_ns": min(samples),
+        "median_ns": statistics.median(samples),
+        "mean_ns": statistics.fmean(samples),
+        "ops": 1e9 / statistics.fmean(samples) if statistics.fmean(samples) else 0
+    }
+
+
+def measure_allocations(func, chunks):
+    """返回每 1000 行的峰值内存（字节）与分配块数"""
+    repeat = max(1, -(-1000 // chunks))
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    for _ in range(repeat):
+        func()
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(max(stat.count_diff, 0) for stat in after.compare_to(before, "filename"))
+    return {"peak_bytes_per_1k": peak * 1000 / chunks, "blocks_per_1k": blocks * 1000 / (chunks * repeat)}
+
+
+def run(options):
+    results = {}
+    for family in options.family or FAMILIES:
+        lines = load_stream(family, options.tokens, options.search_results, 0, options.fixtures)
+        for name, func in build_cases(family, lines).items():
+            results[f"{family}:{name}"] = {
+                **time_case(func, len(lines), options.rounds),
+                **measure_allocations(func, len(lines))
+            }
+    return results
+
+
+def print_report(results, baseline=None):
+    header = f"{'case':<32}{'min ns':>10}{'median ns':>12}{'mean ns':>10}{'lines/s':>12}{'peak KiB/1k':>13}{'blocks/1k':>11}"
+    if baseline:
+        header += f"{'vs base':>10}"
+    print(header)
+    for case, stats in results.items():
+        row = (
+            f"{case:<32}{stats['min_ns']:>10.0f}{stats['median_ns']:>12.0f}{stats['mean_ns']:>10.0f}"
+            f"{stats['ops']:>12.0f}{stats['peak_bytes_per_1k'] / 1024:>13.1f}{stats['blocks_per_1k']:>11.0f}"
+        )
+        if baseline and case in baseline:
+            row += f"{stats['median_ns'] / baseline[case]['median_ns'] - 1:>+10.1%}"
+        print(row)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="解析热路径微基准")
+    parser.add_argument("--family", action="append", choices=FAMILIES, help="只测量指定的模型家族，可重复")
+    parser.add_argument("--rounds", type=int, default=30)
+    parser.add_argument("--tokens", type=int, default=1000, help="合成数据每个响应的 token 行数")
+    parser.add_argument("--search-results", type=int, default=10)
+    parser.add_argument("--fixtures", default=None, help="录制的 <家族>.ndjson 所在目录")
+    parser.add_argument("--save", default=None, help="将结果保存为 JSON，作为后续对比的基线")
+    parser.add_argument("--compare", default=None, help="与保存的基线对比中位数")
+    return parser
+
+
+if __name__ == "__main__":
+    options = build_parser().parse_args()
+    results = run(options)
+    baseline = json.loads(Path(options.compare).read_text()) if options.compare else None
+    print_report(results, baseline)
+    if options.save:
+        Path(options.save).write_text(json.dumps(results, indent=2))
@@ -0,0 +1,118 @@
+"""本地 grok.com 替身服务
+
+回放 fixtures 中的 NDJSON 响应流，模拟 `/rest/app-chat/conversations/new`、续聊接口、`upload-file`、
+`/rest/rate-limits`、`/api/rpc`、图片资源以及 x-statsig-id 接口，可配置首包延迟、token 速率和错误注入
+（403 盾、429 限流、连接中途断开）。
+
+    python benchmarks/fake_upstream.py --port 5300 --latency 200 --token-rate 50 --error-403 0.05
+"""
+import argparse
+import json
+import random
+import time
+import uuid
+
+from flask import Flask, Response, jsonify, request
+
+from fixtures import family_for_payload, load_stream
+
+# 1x1 PNG
+PNG_BYTES = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000100e221bc330000000049454e44ae426082"
+)
+
+
+def create_app(options):
+    app = Flask(__name__)
+    rng = random.Random(options.seed)
+    streams = {}
+
+    def get_stream(family):
+        if family not in streams:
+            streams[family] = load_stream(family, options.tokens, options.search_results, options.seed, options.fixtures)
+        return streams[family]
+
+    @app.route('/rest/app-chat/conversations/new', methods=['POST'])
+    def new_conversation():
+        roll = rng.random()
+        if roll < options.error_403:
+            return Response("<html><title>Just a moment...</title></html>", status=403, content_type='text/html')
+        if roll < options.error_403 + options.error_429:
+            return jsonify({"error": {"code": 8, "message": "Too many requests"}}), 429
+        reset = rng.random() < options.reset
+
+        payload = json.loads(request.get_data() or b"{}")
+        lines = get_stream(family_for_payload(payload))
+        interval = 1 / options.token_rate if options.token_rate > 0 else 0
+
+        def generate():
+            if options.latency:
+                time.sleep(options.latency / 1000)
+            for index, line in enumerate(lines):
+                if reset and index == len(lines) // 2:
+                    raise ConnectionResetError("注入的连接中断")
+                if interval:
+                    time.sleep(interval)
+                yield line + b"\n"
+
+        return Response(generate(), content_type='application/json')
+
+    @app.route('/rest/app-chat/conversations/<conversation_id>/responses', methods=['POST'])
+    def continue_conversation(conversation_id):
+        payload = json.loads(request.get_data() or b"{}")
+        lines = [
+            json.dumps(json.loads(line)["result"]["response"], ensure_ascii=False).join(('{"result": ', '}')).encode("utf-8")
+            for line in get_stream(family_for_payload(payload))
+            if b'"response"' in line
+        ]
+        return Response((line + b"\n" for line in lines), content_type='application/json')
+
+    @app.route('/rest/app-chat/upload-file', methods=['POST'])
+    def upload_file():
+        return jsonify({"fileMetadataId": str(uuid.uuid4())})
+
+    @app.route('/rest/rate-limits', methods=['POST'])
+    def rate_limits():
+        # Cookie 中包含 dead 的令牌视为已失效，包含 empty 的令牌额度已用完
+        cookie = request.headers.get("Cookie", "")
+        if "dead" in cookie:
+            return jsonify({"error": {"code": 16, "message": "Unauthenticated"}}), 401
+        if "empty" in cookie:
+            return jsonify({"windowSizeSeconds": 7200, "remainingQueries": 0, "totalQueries": 20, "waitTimeSeconds": 600})
+        return jsonify({"windowSizeSeconds": 7200, "remainingQueries": 17, "totalQueries": 20})
+
+    @app.route('/api/rpc', methods=['POST'])
+    def rpc():
+        return jsonify({"fileMetadataId": str(uuid.uuid4())})
+
+    @app.route('/x.php')
+    def statsig():
+        return jsonify({"x_statsig_id": uuid.uuid4().hex})
+
+    @app.route('/users/<path:path>')
+    def assets(path):
+        return Response(PNG_BYTES, content_type='image/png')
+
+    return app
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="本地 grok.com 替身服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5300)
+    parser.add_argument("--latency", type=float, default=0, help="首行返回前的延迟（毫秒）")
+    parser.add_argument("--token-rate", type=float, default=0, help="每秒返回的行数，0 表示不限速")
+    parser.add_argument("--tokens", type=int, default=200, help="每个响应的 token 行数")
+    parser.add_argument("--search-results", type=int, default=10, help="每次搜索返回的结果数")
+    parser.add_argument("--error-403", type=float, default=0, help="返回 403 盾的概率")
+    parser.add_argument("--error-429", type=float, default=0, help="返回 429 的概率")
+    parser.add_argument("--reset", type=float, default=0, help="响应中途断开连接的概率")
+    parser.add_argument("--fixtures", default=None, help="录制的 <家族>.ndjson 所在目录")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+
+if __name__ == "__main__":
+    options = build_parser().parse_args()
+    create_app(options).run(host=options.host, port=options.port, threaded=True)
@@ -0,0 +1,128 @@
+"""grok.com NDJSON 响应流样本
+
+按模型家族生成与 grok.com `/rest/app-chat/conversations/new` 返回格式一致的响应流，
+供本地假上游回放以及解析热路径的微基准使用。fixtures 目录下存在 `<家族>.ndjson`
+录制文件时优先使用录制内容。
+"""
+import json
+import random
+from pathlib import Path
+
+FAMILIES = ("grok-3", "grok-3-reasoning", "grok-3-search", "grok-3-deepsearch", "grok-3-imageGen")
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures"
+
+WORDS = (
+    "the", "model", "response", "stream", "token", "proxy", "latency", "search", "result",
+    "你好", "世界", "推理", "搜索", "结果", "令牌", "性能", "测试", "数据", "，", "。", "\n"
+)
+
+
+def _text_tokens(rng, count):
+    return [rng.choice(WORDS) + ("" if rng.random() < 0.3 else " ") for _ in range(count)]
+
+
+def _line(response):
+    return {"result": {"response": response}}
+
+
+def _search_results(rng, count, step=0):
+    return {
+        "results": [
+            {
+                "url": f"https://example.com/{step}/{index}",
+                "title": f"搜索结果 {step}-{index}",
+                "preview": " ".join(rng.choice(WORDS) for _ in range(40))
+            }
+            for index in range(count)
+        ]
+    }
+
+
+def build_stream(family, tokens=200, search_results=10, seed=0):
+    """生成指定模型家族的响应流，返回逐行的 JSON 对象列表"""
+    rng = random.Random(seed)
+    response_id = f"resp-{seed}"
+    lines = [{"result": {"conversation": {"conversationId": f"conv-{seed}"}}}]
+    lines.append(_line({"userResponse": {"responseId": f"user-{seed}", "sender": "human"}}))
+
+    if family == "grok-3-reasoning":
+        thinking = tokens // 2
+        for token in _text_tokens(rng, thinking):
+            lines.append(_line({"token": token, "isThinking": True, "responseId": response_id}))
+        for token in _text_tokens(rng, tokens - thinking):
+            lines.append(_line({"token": token, "isThinking": False, "responseId": response_id}))
+    elif family == "grok-3-search":
+        lines.append(_line({"webSearchResults": _search_results(rng, search_results), "responseId": response_id}))
+        for token in _text_tokens(rng, tokens):
+            lines.append(_line({"token": token, "responseId": response_id}))
+    elif family == "grok-3-deepsearch":
+        steps = 4
+        per_step = tokens // (steps * 2)
+        for step in range(1, steps + 1):
+            lines.append(_line({"token": f"步骤 {step}", "messageTag": "header", "messageStepId": step}))
+            lines.append(_line({
+                "token": {"action": "webSearch", "action_input": {"query": f"query {step}"}},
+                "messageTag": "tool_usage_card",
+                "messageStepId": step
+            }))
+            lines.append(_line({
+                "webSearchResults": _search_results(rng, search_results, step // 2),
+                "messageTag": "raw_function_result",
+                "messageStepId": step
+            }))
+            for token in _text_tokens(rng, per_step):
+                lines.append(_line({"token": token, "messageTag": "assistant", "messageStepId": step}))
+        for token in _text_tokens(rng, tokens - steps * per_step):
+            lines.append(_line({"token": token, "messageTag": "final", "responseId": response_id}))
+    elif family == "grok-3-imageGen":
+        lines.append(_line({"doImgGen": True, "responseId": response_id}))
+        for progress in (25, 50, 75, 100):
+            lines.append(_line({"streamingImageGenerationResponse": {"progress": progress}, "responseId": response_id}))
+        lines.append(_line({
+            "cachedImageGenerationResponse": {"imageUrl": f"users/bench/generated/{seed}/image.jpg"},
+            "responseId": response_id
+        }))
+    else:
+        for token in _text_tokens(rng, tokens):
+            lines.append(_line({"token": token, "isThinking": False, "responseId": response_id}))
+
+    lines.append(_line({
+        "modelResponse": {"responseId": response_id, "message": "", "sender": "assistant"},
+        "isSoftStop": True
+    }))
+    return lines
+
+
+def load_stream(family, tokens=200, search_results=10, seed=0, fixtures_dir=None):
+    """返回响应流的原始字节行，优先读取录制文件"""
+    recorded = Path(fixtures_dir or FIXTURES_DIR) / f"{family}.ndjson"
+    if recorded.exists():
+        return [line for line in recorded.read_bytes().splitlines() if line.strip()]
+    return [
+        json.dumps(line, ensure_ascii=False).encode("utf-8")
+        for line in build_stream(family, tokens, search_results, seed)
+    ]
+
+
+def family_for_payload(payload):
+    """根据代理发出的请求体判断应回放的模型家族"""
+    if payload.get("toolOverrides", {}).get("imageGen"):
+        return "grok-3-imageGen"
+    if payload.get("deepsearchPreset"):
+        return "grok-3-deepsearch"
+    if payload.get("isReasoning"):
+        return "grok-3-reasoning"
+    if payload.get("toolOverrides", {}).get("webSearch"):
+        return "grok-3-search"
+    return "grok-3"
+
+
+if __name__ == "__main__":
+    FIXTURES_DIR.mkdir(exist_ok=True)
+    for name in FAMILIES:
+        path = FIXTURES_DIR / f"{name}.ndjson"
+        with open(path, "w", encoding="utf-8") as f:
+            for line in build_stream(name):
+                f.write(json.dumps(line, ensure_ascii=False) + "\n")
+        print(f"已写入 {path}")
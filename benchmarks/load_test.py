@@ -0,0 +1,218 @@
+"""端到端压测
+
+启动本地 grok.com 替身服务与代理服务（app.py），以指定并发发送流式与非流式对话请求，
+统计 RPS、首字延迟（TTFT）与总耗时的 p50/p99，以及代理进程每个流式 token 消耗的 CPU 时间。
+
+    python benchmarks/load_test.py --requests 500 --concurrency 32 --mode both
+    python benchmarks/load_test.py --model grok-3-reasoning --token-rate 100 --error-429 0.05
+
+CPU 统计读取 /proc/<pid>/stat，仅支持 Linux。
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+BENCH_DIR = Path(__file__).parent
+ROOT_DIR = BENCH_DIR.parent
+API_KEY = "sk-bench"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"服务未能在 {timeout} 秒内启动: {url}")
+
+
+def process_cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    # utime 与 stime 分别是第 14、15 个字段
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def start_services(options, work_dir):
+    upstream_port = free_port()
+    proxy_port = free_port()
+    upstream_url = f"http://127.0.0.1:{upstream_port}"
+
+    upstream_args = [
+        sys.executable, str(BENCH_DIR / "fake_upstream.py"),
+        "--port", str(upstream_port),
+        "--latency", str(options.latency),
+        "--token-rate", str(options.token_rate),
+        "--tokens", str(options.tokens),
+        "--error-403", str(options.error_403),
+        "--error-429", str(options.error_429),
+        "--reset", str(options.reset),
+    ]
+    if options.fixtures:
+        upstream_args += ["--fixtures", options.fixtures]
+
+    # 每个令牌每个模型至少有 3 次请求额度，按请求总数准备足够的令牌
+    token_count = options.requests * (2 if options.mode == "both" else 1) // 3 + 10
+    env = {
+        **os.environ,
+        "PORT": str(proxy_port),
+        "API_KEY": API_KEY,
+        "BASE_URL": upstream_url,
+        "ASSETS_URL": upstream_url,
+        "STATSIG_URL": f"{upstream_url}/x.php",
+        "REQUEST_INTERVAL": "0",
+        "DATA_DIR": str(work_dir),
+        "SSO": ",".join(f"bench-token-{index}" for index in range(token_count)),
+        "SSO_PRO": ",".join(f"bench-pro-token-{index}" for index in range(token_count)),
+        "PROXY": "",
+        "CF_CLEARANCE": "",
+        "IS_CUSTOM_SSO": "false",
+    }
+    log = open(work_dir / "services.log", "w")
+    upstream = subprocess.Popen(upstream_args, cwd=BENCH_DIR, stdout=log, stderr=subprocess.STDOUT)
+    proxy = subprocess.Popen([sys.executable, str(ROOT_DIR / "app.py")], cwd=work_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    wait_for(f"{upstream_url}/x.php")
+    wait_for(f"http://127.0.0.1:{proxy_port}/v1/models")
+    return upstream, proxy, f"http://127.0.0.1:{proxy_port}"
+
+
+def run_request(base_url, model, stream, index):
+    body = {
+        "model": model,
+        "stream": stream,
+        "messages": [{"role": "user", "content": f"benchmark request {index}"}]
+    }
+    start = time.perf_counter()
+    first_token_at = None
+    tokens = 0
+    try:
+        response = requests.post(
+            f"{base_url}/v1/chat/completions",
+            json=body,
+            headers={"Authorization": f"Bearer {API_KEY}"},
+            stream=stream,
+            timeout=300
+        )
+        if stream:
+            for line in response.iter_lines():
+                if not line.startswith(b"data: {"):
+                    continue
+                chunk = json.loads(line[6:])
+                if chunk["choices"][0].get("delta", {}).get("content"):
+                    tokens += 1
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+        else:
+            response.content
+            first_token_at = time.perf_counter()
+        ok = response.status_code == 200
+    except requests.RequestException:
+        ok = False
+    end = time.perf_counter()
+    return {
+        "ok": ok,
+        "ttft": (first_token_at or end) - start,
+        "latency": end - start,
+        "tokens": tokens
+    }
+
+
+def run_mode(base_url, proxy_pid, options, stream):
+    cpu_before = process_cpu_seconds(proxy_pid)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=options.concurrency) as executor:
+        results = list(executor.map(
+            lambda index: run_request(base_url, options.model, stream, index),
+            range(options.requests)
+        ))
+    elapsed = time.perf_counter() - start
+    cpu_used = process_cpu_seconds(proxy_pid) - cpu_before
+
+    succeeded = [result for result in results if result["ok"]]
+    tokens = sum(result["tokens"] for result in succeeded)
+    return {
+        "mode": "stream" if stream else "non-stream",
+        "requests": len(results),
+        "errors": len(results) - len(succeeded),
+        "rps": len(succeeded) / elapsed if elapsed else 0,
+        "ttft_p50_ms": percentile([r["ttft"] for r in succeeded], 0.5) * 1000,
+        "ttft_p99_ms": percentile([r["ttft"] for r in succeeded], 0.99) * 1000,
+        "latency_p50_ms": percentile([r["latency"] for r in succeeded], 0.5) * 1000,
+        "latency_p99_ms": percentile([r["latency"] for r in succeeded], 0.99) * 1000,
+        "cpu_seconds": cpu_used,
+        "cpu_us_per_token": cpu_used / tokens * 1e6 if tokens else None
+    }
+
+
+def print_report(reports):
+    columns = ("mode", "requests", "errors", "rps", "ttft_p50_ms", "ttft_p99_ms",
+               "latency_p50_ms", "latency_p99_ms", "cpu_seconds", "cpu_us_per_token")
+    print(" | ".join(columns))
+    for report in reports:
+        print(" | ".join(
+            f"{report[column]:.2f}" if isinstance(report[column], float) else str(report[column])
+            for column in columns
+        ))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="grok2api 端到端压测")
+    parser.add_argument("--requests", type=int, default=200, help="每种模式的请求数")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--model", default="grok-3")
+    parser.add_argument("--mode", choices=("stream", "non-stream", "both"), default="both")
+    parser.add_argument("--latency", type=float, default=0, help="假上游首行延迟（毫秒）")
+    parser.add_argument("--token-rate", type=float, default=0, help="假上游每秒返回的行数")
+    parser.add_argument("--tokens", type=int, default=200, help="每个响应的 token 行数")
+    parser.add_argument("--error-403", type=float, default=0)
+    parser.add_argument("--error-429", type=float, default=0)
+    parser.add_argument("--reset", type=float, default=0)
+    parser.add_argument("--fixtures", default=None, help="录制的 <家族>.ndjson 所在目录")
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    return parser
+
+
+def main():
+    options = build_parser().parse_args()
+    with tempfile.TemporaryDirectory() as work_dir:
+        upstream, proxy, base_url = start_services(options, Path(work_dir))
+        try:
+            modes = {"stream": [True], "non-stream": [False], "both": [True, False]}[options.mode]
+            reports = [run_mode(base_url, proxy.pid, options, stream) for stream in modes]
+        finally:
+            proxy.terminate()
+            upstream.terminate()
+            proxy.wait()
+            upstream.wait()
+    if options.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        print_report(reports)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+"""图片缩小的进程池工作函数
+
+单独成模块，工作进程只需导入本模块，不会重复执行 app.py 中创建数据目录、单例等模块级初始化。
+"""
+import base64
+import io
+
+
+def downscale_image(payload, max_dimension, jpeg_quality):
+    """在子进程中解码、缩小并重新压缩图片，返回 (base64 数据, MIME 类型)，无需处理时返回 None"""
+    from PIL import Image
+
+    image_bytes = base64.b64decode(payload)
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        if max(image.size) <= max_dimension or getattr(image, "n_frames", 1) > 1:
+            return None
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        output = io.BytesIO()
+        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+            image.save(output, format="PNG", optimize=True)
+            mime_type = "image/png"
+        else:
+            image.convert("RGB").save(output, format="JPEG", quality=jpeg_quality, optimize=True)
+            mime_type = "image/jpeg"
+    if output.tell() >= len(image_bytes):
+        return None
+    return base64.b64encode(output.getvalue()), mime_type
@@ -0,0 +1,93 @@
+import json
+import os
+import tempfile
+
+# app 在导入时读取 DATA_DIR 并创建目录，测试使用临时目录，不读写 /data
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="grok2api-test-")
+
+import pytest
+
+import app
+
+TOKENS = ["tokA", "tokB"]
+
+
+def token_lines(*tokens):
+    """按上游格式生成逐字输出的响应行"""
+    return [{"result": {"response": {"token": token}}} for token in tokens]
+
+
+class FakeResponse:
+    def __init__(self, lines=(), status_code=200, headers=None, text="", json_body=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = text
+        self.lines = list(lines)
+        self.json_body = json_body
+        self.closed = False
+
+    def iter_lines(self):
+        for line in self.lines:
+            yield line if isinstance(line, bytes) else json.dumps(line).encode()
+
+    def json(self):
+        return self.json_body if self.json_body is not None else {}
+
+    def close(self):
+        self.closed = True
+
+
+class FakeUpstream:
+    """替身上游：记录每次请求，按 handler 返回响应，默认回复 "Hello" """
+    def __init__(self):
+        self.calls = []
+        self.handler = lambda url, kwargs: FakeResponse(token_lines("Hel", "lo"))
+
+    def post(self, url, **kwargs):
+        self.calls.append((url, kwargs))
+        return self.handler(url, kwargs)
+
+    def chat_calls(self):
+        return [(url, kwargs) for url, kwargs in self.calls if "/conversations/" in url]
+
+
+@pytest.fixture
+def token_manager(monkeypatch, tmp_path):
+    # 令牌状态与每日用量写入每个用例自己的目录，互不影响
+    monkeypatch.setattr(app, "DATA_DIR", tmp_path)
+    monkeypatch.setitem(app.CONFIG, "TOKEN_STATUS_FILE", str(tmp_path / "token_status.json"))
+    # token_manager 在 main() 中创建，导入 app 时尚不存在
+    manager = app.AuthTokenManager()
+    monkeypatch.setattr(app, "token_manager", manager, raising=False)
+    return manager
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    fake = FakeUpstream()
+    monkeypatch.setattr(app.curl_requests, "post", fake.post)
+    monkeypatch.setattr(app.Utils, "get_statsig_id", staticmethod(lambda: "statsig"))
+    return fake
+
+
+@pytest.fixture
+def client(monkeypatch, token_manager, upstream):
+    """使用替身上游与两个普通令牌的测试客户端，各全局组件每个用例重新创建"""
+    monkeypatch.setenv("SSO", ",".join(TOKENS))
+    monkeypatch.setenv("SSO_PRO", "")
+    monkeypatch.setattr(app, "CONFIG", app.copy.deepcopy(app.CONFIG))
+    app.CONFIG["API"]["REQUEST_INTERVAL"] = 0
+    app.CONFIG["API"]["RETRY_TIME"] = 0
+    for name, factory in (
+        ("response_cache", lambda: app.ResponseCache(app.CONFIG["RESPONSE_CACHE"]["MAX_SIZE"], app.CONFIG["RESPONSE_CACHE"]["TTL"])),
+        ("conversation_store", lambda: app.ConversationStore(app.CONFIG["CONVERSATION"]["MAX_SIZE"], app.CONFIG["CONVERSATION"]["TTL"])),
+        ("proxy_bindings", app.ProxyBindingTable),
+        ("shield_breakers", app.ShieldBreakerRegistry),
+        ("upstream_errors", app.UpstreamErrorClassifier),
+        ("drain_controller", app.DrainController),
+    ):
+        monkeypatch.setattr(app, name, factory())
+    app.initialization()
+    test_client = app.app.test_client()
+    test_client.environ_base["HTTP_AUTHORIZATION"] = f"Bearer {app.CONFIG['API']['API_KEY']}"
+    return test_client
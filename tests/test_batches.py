@@ -0,0 +1,91 @@
+import json
+import threading
+import time
+
+import pytest
+
+import app
+from tests.conftest import FakeResponse, token_lines
+
+
+def batch_input(*contents, model="grok-3"):
+    return "\n".join(
+        json.dumps({"custom_id": f"req-{index}", "body": {"model": model, "messages": [{"role": "user", "content": content}]}})
+        for index, content in enumerate(contents)
+    )
+
+
+def wait_for_status(manager, batch_id, statuses=("completed", "cancelled")):
+    deadline = time.monotonic() + 5
+    while manager.jobs[batch_id]["status"] not in statuses and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return manager.jobs[batch_id]
+
+
+def read_output(manager, batch_id):
+    path = manager.job_path(batch_id, "output.jsonl")
+    return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()] if path.exists() else []
+
+
+@pytest.fixture
+def batches(client, monkeypatch, tmp_path):
+    app.CONFIG["BATCH"]["DIR"] = str(tmp_path / "batches")
+    app.CONFIG["BATCH"]["WORKERS"] = 1
+    manager = app.BatchManager()
+    monkeypatch.setattr(app, "batch_manager", manager)
+    return manager
+
+
+def test_batch_runs_to_completion(client, batches, upstream):
+    response = client.post("/v1/batches", data=batch_input("one", "two") + "\n" + json.dumps({"custom_id": "bad", "body": {"model": "grok-9", "messages": []}}))
+    assert response.status_code == 200
+    job = wait_for_status(batches, response.json["id"])
+    assert job["status"] == "completed"
+    assert job["request_counts"] == {"total": 3, "completed": 2, "failed": 1}
+    records = {record["custom_id"]: record for record in read_output(batches, job["id"])}
+    assert records["req-0"]["response"]["body"]["choices"][0]["message"]["content"] == "Hello"
+    assert records["bad"]["error"]["message"]
+    assert json.loads((batches.batch_dir / job["id"] / "meta.json").read_text(encoding="utf-8"))["status"] == "completed"
+    assert client.get(f"/v1/batches/{job['id']}/output").get_data(as_text=True).count("\n") == 3
+
+
+@pytest.mark.parametrize("body", ["", "not json", json.dumps({"custom_id": "a"}), batch_input("x") + "\n" + batch_input("y")])
+def test_invalid_input_is_rejected(client, batches, body):
+    assert client.post("/v1/batches", data=body).status_code == 400
+    assert batches.jobs == {}
+
+
+def test_cancel_stops_remaining_requests(client, batches, upstream):
+    release = threading.Event()
+
+    def handler(url, kwargs):
+        release.wait(5)
+        return FakeResponse(token_lines("Hel", "lo"))
+    upstream.handler = handler
+    batch_id = client.post("/v1/batches", data=batch_input("one", "two", "three")).json["id"]
+    while not upstream.chat_calls():
+        time.sleep(0.01)
+    assert client.post(f"/v1/batches/{batch_id}/cancel").json["status"] == "cancelling"
+    release.set()
+    job = wait_for_status(batches, batch_id)
+    assert job["status"] == "cancelled"
+    assert job["request_counts"]["completed"] < 3
+
+
+def test_unfinished_job_resumes_after_restart(client, batches, upstream, monkeypatch):
+    batches.stop()
+    batch_id = batches.create_job(batch_input("one", "two"))["id"]
+    # 停机后不再提交请求，任务保持进行中
+    time.sleep(0.05)
+    assert batches.jobs[batch_id]["status"] == "in_progress"
+    assert upstream.chat_calls() == []
+    with open(batches.job_path(batch_id, "output.jsonl"), "w", encoding="utf-8") as f:
+        f.write(json.dumps({"custom_id": "req-0", "response": {"status_code": 200}, "error": None}) + "\n")
+
+    restarted = app.BatchManager()
+    monkeypatch.setattr(app, "batch_manager", restarted)
+    restarted.resume_jobs()
+    job = wait_for_status(restarted, batch_id)
+    assert job["status"] == "completed"
+    assert len(upstream.chat_calls()) == 1
+    assert [record["custom_id"] for record in read_output(restarted, batch_id)] == ["req-0", "req-1"]
@@ -0,0 +1,56 @@
+import json
+
+from app import ChatCompletionBody, MessageProcessor, ResponseBuffer
+
+
+def build_body(*texts, spill_size=0):
+    contents = []
+    for text in texts:
+        buffer = ResponseBuffer(spill_size)
+        for chunk in text:
+            buffer.write(chunk)
+        buffer.finish()
+        contents.append(buffer)
+    response = MessageProcessor.create_chat_response(None, "grok-3")
+    response["choices"] = [
+        MessageProcessor.create_chat_response(None, "grok-3", index=index, finish_reason="stop")["choices"][0]
+        for index in range(len(contents))
+    ]
+    return ChatCompletionBody(response, contents)
+
+
+def test_content_is_escaped_as_json():
+    chunks = ['say "hi"', "\\path\\", "\n\t", "\u0001", "中文 😀", "</script>"]
+    body = build_body(chunks)
+    result = json.loads("".join(body))
+    assert result["choices"][0]["message"]["content"] == "".join(chunks)
+    assert result["object"] == "chat.completion"
+
+
+def test_each_choice_keeps_its_own_content():
+    body = build_body(["first"], ['"second"'], [])
+    choices = json.loads("".join(body))["choices"]
+    assert [choice["message"]["content"] for choice in choices] == ["first", '"second"', ""]
+    assert [choice["index"] for choice in choices] == [0, 1, 2]
+
+
+def test_placeholder_like_content_is_not_substituted():
+    body = build_body(["\u0000content-1\u0000"], ["b"])
+    choices = json.loads("".join(body))["choices"]
+    assert choices[0]["message"]["content"] == "\u0000content-1\u0000"
+    assert choices[1]["message"]["content"] == "b"
+
+
+def test_spilled_content_is_streamed_from_file():
+    chunks = ['"quoted"\n' * 10] * 5
+    body = build_body(chunks, spill_size=16)
+    assert body.contents[0].spilled
+    assert not body.cacheable
+    assert json.loads("".join(body))["choices"][0]["message"]["content"] == "".join(chunks)
+
+
+def test_errored_content_is_not_cacheable():
+    body = build_body(["partial"])
+    assert body.cacheable
+    body.contents[0].errored = True
+    assert not body.cacheable
@@ -0,0 +1,43 @@
+import json
+
+import app
+from tests.conftest import FakeResponse, token_lines
+
+
+def reload_config(monkeypatch, tmp_path, overrides):
+    """用独立的 ConfigWatcher 加载 overrides，测试结束后恢复 CONFIG 与请求头"""
+    path = tmp_path / "config.json"
+    path.write_text(json.dumps(overrides), encoding="utf-8")
+    app.CONFIG["CONFIG_FILE"]["PATH"] = str(path)
+    monkeypatch.setattr(app, "DEFAULT_HEADERS", dict(app.DEFAULT_HEADERS))
+    watcher = app.ConfigWatcher()
+    assert watcher.load(force=True), watcher.error
+    return watcher
+
+
+def test_reload_resizes_caches(client, monkeypatch, tmp_path):
+    for index in range(3):
+        app.conversation_store.save("grok-3", [{"role": "user", "content": str(index)}], "hello", "conv", "resp", "token")
+    reload_config(monkeypatch, tmp_path, {
+        "RESPONSE_CACHE": {"MAX_SIZE": 5, "TTL": 7},
+        "CONVERSATION": {"MAX_SIZE": 1, "TTL": 9}
+    })
+    assert (app.response_cache.max_size, app.response_cache.ttl) == (5, 7)
+    assert (app.conversation_store.max_size, app.conversation_store.ttl) == (1, 9)
+    assert len(app.conversation_store._entries) == 1
+
+
+def test_request_keeps_config_snapshot_across_reload(client, upstream, monkeypatch, tmp_path):
+    base_url = app.CONFIG["API"]["BASE_URL"]
+
+    def handler(url, kwargs):
+        if len(upstream.chat_calls()) == 1:
+            # 第一次请求进行中时配置被重新加载，本请求的重试仍使用原来的地址
+            reload_config(monkeypatch, tmp_path, {"API": {"BASE_URL": "https://changed.example"}})
+            return FakeResponse(status_code=503, text="busy")
+        return FakeResponse(token_lines("Hel", "lo"))
+    upstream.handler = handler
+    response = client.post("/v1/chat/completions", json={"model": "grok-3", "messages": [{"role": "user", "content": "hi"}]})
+    assert response.status_code == 200
+    assert app.CONFIG["API"]["BASE_URL"] == "https://changed.example"
+    assert [url for url, _ in upstream.chat_calls()] == [f"{base_url}/rest/app-chat/conversations/new"] * 2
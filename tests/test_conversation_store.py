@@ -0,0 +1,97 @@
+import app
+from app import ConversationStore
+from tests.conftest import FakeResponse, token_lines
+
+
+def history(reply="hello there"):
+    return [
+        {"role": "user", "content": "hi"},
+        {"role": "assistant", "content": reply},
+        {"role": "user", "content": "next"}
+    ]
+
+
+def test_key_depends_on_model_and_messages():
+    messages = history()
+    assert ConversationStore.make_key("grok-3", messages) == ConversationStore.make_key("grok-3", history())
+    assert ConversationStore.make_key("grok-3", messages) != ConversationStore.make_key("grok-4", messages)
+    assert ConversationStore.make_key("grok-3", messages) != ConversationStore.make_key("grok-3", history("other"))
+
+
+def test_assistant_content_is_normalised():
+    key = ConversationStore.make_key("grok-3", history("hello there"))
+    assert ConversationStore.make_key("grok-3", history("<think>plan\n</think>\n hello there \n")) == key
+    assert ConversationStore.make_key("grok-3", history([{"type": "text", "text": "hello "}, {"type": "text", "text": "there"}])) == key
+
+
+def test_user_content_is_not_normalised():
+    messages = history()
+    changed = [*messages[:2], {"role": "user", "content": " next"}]
+    assert ConversationStore.make_key("grok-3", messages) != ConversationStore.make_key("grok-3", changed)
+
+
+def test_find_returns_saved_conversation_for_same_reply():
+    store = ConversationStore(10, 60)
+    store.save("grok-3", [{"role": "user", "content": "hi"}], "<think>x</think>hello there", "conv", "resp", "token")
+    entry = store.find("grok-3", history())
+    assert entry["conversationId"] == "conv"
+    assert entry["responseId"] == "resp"
+    assert entry["token"] == "token"
+    assert store.find("grok-3", history("hello there, edited")) is None
+
+
+def test_find_requires_user_after_assistant():
+    store = ConversationStore(10, 60)
+    store.save("grok-3", [{"role": "user", "content": "hi"}], "hello there", "conv", "resp", "token")
+    assert store.find("grok-3", history()[:2]) is None
+    assert store.find("grok-3", [history()[0], history()[2]]) is None
+
+
+def test_expired_and_evicted_entries_are_dropped():
+    store = ConversationStore(10, 0)
+    store.save("grok-3", [{"role": "user", "content": "hi"}], "hello there", "conv", "resp", "token")
+    assert store.find("grok-3", history()) is None
+
+    store = ConversationStore(1, 60)
+    store.save("grok-3", [{"role": "user", "content": "hi"}], "hello there", "conv1", "resp", "token")
+    store.save("grok-3", [{"role": "user", "content": "hi"}], "other", "conv2", "resp", "token")
+    assert store.find("grok-3", history()) is None
+    assert store.find("grok-3", history("other"))["conversationId"] == "conv2"
+
+
+def continuation_setup(upstream, status_code, content_type="application/json", text="{}"):
+    """登记一个属于 tokA 的上游会话，续聊请求返回 status_code，完整历史请求正常回复"""
+    app.CONFIG["CONVERSATION"]["ENABLED"] = True
+    app.conversation_store.save("grok-3", [{"role": "user", "content": "hi"}], "hello there", "conv", "resp", "sso-rw=tokA;sso=tokA")
+    responses = []
+
+    def handler(url, kwargs):
+        if url.endswith("/conversations/conv/responses"):
+            responses.append(FakeResponse(status_code=status_code, headers={"content-type": content_type}, text=text))
+        else:
+            responses.append(FakeResponse(token_lines("Hel", "lo")))
+        return responses[-1]
+    upstream.handler = handler
+    return responses
+
+
+def test_expired_continuation_falls_back_to_full_history(client, upstream):
+    responses = continuation_setup(upstream, 404)
+    response = client.post("/v1/chat/completions", json={"model": "grok-3", "messages": history()})
+    assert response.status_code == 200
+    assert [url.rsplit("/", 1)[-1] for url, _ in upstream.chat_calls()] == ["responses", "new"]
+    assert responses[0].closed
+    assert app.conversation_store.find("grok-3", history()) is None
+    assert app.upstream_errors.counters["bad_request"] == 1
+
+
+def test_continuation_shield_trips_breaker(client, upstream, monkeypatch):
+    recorded = []
+    monkeypatch.setattr(app.shield_breakers, "record_shield", recorded.append)
+    responses = continuation_setup(upstream, 403, "text/html", "<title>Just a moment...</title>")
+    client.post("/v1/chat/completions", json={"model": "grok-3", "messages": history()})
+    assert recorded
+    assert responses[0].closed
+    assert app.upstream_errors.counters["shield"] >= 1
+    # 盾与会话无关，不改为发送完整历史
+    assert all(url.endswith("/conversations/conv/responses") for url, _ in upstream.chat_calls())
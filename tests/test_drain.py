@@ -0,0 +1,70 @@
+import pytest
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+import app
+from app import DrainController
+
+HI = [{"role": "user", "content": "hi"}]
+
+
+def streaming_app(environ, start_response):
+    return Response(iter(["one", "two"]))(environ, start_response)
+
+
+def test_draining_rejects_new_requests_but_not_probes():
+    controller = DrainController()
+    client = Client(controller.wrap(streaming_app))
+    controller.draining = True
+    response = client.get("/v1/chat/completions")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert client.get("/readyz").status_code == 200
+    assert controller.active == 0
+
+
+def test_stream_counts_as_active_until_closed():
+    controller = DrainController()
+    response = Client(controller.wrap(streaming_app)).get("/", buffered=False)
+    # 响应体尚未读完时请求仍在进行中
+    assert controller.active == 1
+    assert b"".join(response.response) == b"onetwo"
+    response.close()
+    assert controller.active == 0
+
+
+@pytest.fixture
+def drain(client, monkeypatch):
+    app.CONFIG["SHUTDOWN"]["GRACE"] = 0
+    app.CONFIG["SHUTDOWN"]["TIMEOUT"] = 0
+    exits = []
+    monkeypatch.setattr(app.os, "_exit", exits.append)
+    return exits
+
+
+def test_stream_charge_is_settled_after_consumption(client, upstream):
+    response = client.post("/v1/chat/completions", json={"model": "grok-3", "messages": HI, "stream": True}, buffered=False)
+    assert len(app.drain_controller.charges) == 1
+    body = b"".join(response.response)
+    response.close()
+    assert b"[DONE]" in body
+    assert app.drain_controller.charges == {}
+
+
+def test_unfinished_charges_are_refunded_on_drain(client, upstream, drain):
+    # 保留响应对象，流式回复尚未读取，对话仍在进行中
+    response = client.post("/v1/chat/completions", json={"model": "grok-3", "messages": HI, "stream": True}, buffered=False)
+    assert app.token_manager.model_usage["grok-3"]["used"] == 1
+    app.drain_controller.drain()
+    assert app.drain_controller.charges == {}
+    assert app.token_manager.model_usage["grok-3"]["used"] == 0
+    assert app.drain_controller.get_status()["draining"]
+    assert drain == []
+    response.close()
+
+
+def test_completed_requests_are_not_refunded(client, upstream, drain):
+    response = client.post("/v1/chat/completions", json={"model": "grok-3", "messages": HI})
+    assert response.status_code == 200
+    app.drain_controller.drain()
+    assert app.token_manager.model_usage["grok-3"]["used"] == 1
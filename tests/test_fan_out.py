@@ -0,0 +1,86 @@
+import base64
+import json
+import time
+
+import pytest
+
+import app
+from tests.conftest import FakeResponse, token_lines
+
+TOKENS = [f"sso-rw=tok{index};sso=tok{index}" for index in range(3)]
+
+
+def test_refund_for_removed_token_leaves_others_untouched(token_manager):
+    token_manager.add_tokens(TOKENS)
+    exclude = set()
+    first = token_manager.get_next_token_for_model("grok-3", exclude_tokens=exclude)
+    second = token_manager.get_next_token_for_model("grok-3", exclude_tokens=exclude)
+    token_manager.remove_token_for_model("grok-3", first)
+    assert token_manager.reduce_token_request_count("grok-3", 1, first) is False
+    entry = next(entry for entry in token_manager.token_model_map["grok-3"] if entry["token"] == second)
+    assert entry["RequestCount"] == 1
+    assert token_manager.model_usage["grok-3"] == {"live": 2, "used": 1}
+
+
+def test_refund_without_token_uses_head_of_rotation(token_manager):
+    token_manager.add_tokens(TOKENS)
+    token = token_manager.get_next_token_for_model("grok-3")
+    assert token_manager.reduce_token_request_count("grok-3", 1)
+    assert token_manager.token_model_map["grok-3"][0]["token"] == token
+    assert token_manager.model_usage["grok-3"]["used"] == 0
+
+
+def test_sibling_selection_never_shares_a_token(token_manager):
+    token_manager.add_tokens(TOKENS[:2])
+    exclude = set()
+    picked = [token_manager.get_next_token_for_model("grok-3", exclude_tokens=exclude) for _ in range(3)]
+    assert picked[0] != picked[1]
+    assert picked[2] is None
+    assert token_manager.model_usage["grok-3"]["used"] == 2
+
+
+def cookie_upstream(upstream):
+    """上传按请求所用账号返回不同的文件 id，对话返回 "Hello" """
+    def handler(url, kwargs):
+        if url.endswith("/api/rpc"):
+            account = kwargs["headers"]["Cookie"].split(";")[0]
+            return FakeResponse(json_body={"fileMetadataId": f"file-{account}"})
+        return FakeResponse(token_lines("Hel", "lo"))
+    upstream.handler = handler
+
+
+def test_siblings_upload_attachments_with_their_own_tokens(client, upstream):
+    cookie_upstream(upstream)
+    image = "data:image/png;base64," + base64.b64encode(b"\x89PNG\r\n\x1a\n" + b"\x00" * 32).decode()
+    messages = [{"role": "user", "content": [{"type": "text", "text": "look"}, {"type": "image_url", "image_url": {"url": image}}]}]
+    response = client.post("/v1/chat/completions", json={"model": "grok-3", "messages": messages, "n": 2})
+    assert response.status_code == 200
+    assert len(response.json["choices"]) == 2
+    chats = upstream.chat_calls()
+    assert len(chats) == 2
+    accounts = set()
+    for _, kwargs in chats:
+        account = kwargs["headers"]["Cookie"].split(";")[0]
+        accounts.add(account)
+        assert json.loads(kwargs["data"])["fileAttachments"] == [f"file-{account}"]
+    assert len(accounts) == 2
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_fewer_than_n_choices_is_an_error(client, upstream, stream):
+    responses = []
+
+    def handler(url, kwargs):
+        responses.append(FakeResponse(token_lines("Hel", "lo")))
+        return responses[-1]
+    upstream.handler = handler
+    response = client.post("/v1/chat/completions", json={"model": "grok-3", "messages": [{"role": "user", "content": "hi"}], "n": 3, "stream": stream})
+    assert response.status_code != 200
+    assert "choices" not in response.json
+    assert len(responses) == 2
+    assert app.drain_controller.charges == {}
+    if stream:
+        deadline = time.monotonic() + 2
+        while not all(item.closed for item in responses) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert all(item.closed for item in responses)
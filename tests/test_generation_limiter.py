@@ -0,0 +1,68 @@
+from app import GenerationLimiter, StopSequenceMatcher
+
+
+def feed_all(limiter, chunks):
+    return "".join(limiter.feed(chunk) for chunk in chunks)
+
+
+def test_stop_sequence_split_across_chunks():
+    limiter = GenerationLimiter(stop=["END"])
+    assert limiter.feed("hello E") == "hello "
+    assert limiter.feed("N") == ""
+    assert limiter.feed("D and more") == ""
+    assert limiter.finish_reason == "stop"
+    assert limiter.feed("ignored") == ""
+
+
+def test_partial_prefix_is_released_when_it_does_not_match():
+    limiter = GenerationLimiter(stop="END")
+    assert limiter.feed("ab E") == "ab "
+    assert limiter.feed("Nx") == "ENx"
+    assert limiter.finish_reason is None
+
+
+def test_pending_prefix_is_flushed_at_end_of_stream():
+    limiter = GenerationLimiter(stop=["END"])
+    assert feed_all(limiter, ["done E", "N"]) == "done "
+    assert limiter.flush() == "EN"
+    assert limiter.finish_reason is None
+
+
+def test_earliest_of_overlapping_stop_sequences_wins():
+    matcher = StopSequenceMatcher(["abcd", "bc"])
+    assert matcher.feed("a") == ("", False)
+    assert matcher.feed("b") == ("", False)
+    assert matcher.feed("c") == ("a", True)
+
+
+def test_stop_sequence_split_into_single_characters():
+    limiter = GenerationLimiter(stop=["</answer>"])
+    text = "result</answer>tail"
+    assert feed_all(limiter, list(text)) == "result"
+    assert limiter.finish_reason == "stop"
+
+
+def test_max_tokens_truncates_output():
+    limiter = GenerationLimiter(max_tokens=2)
+    assert feed_all(limiter, ["abcd", "efghijkl"]) == "abcdefgh"
+    assert limiter.finish_reason == "length"
+    assert limiter.feed("more") == ""
+
+
+def test_max_tokens_counts_wide_characters_individually():
+    limiter = GenerationLimiter(max_tokens=2)
+    assert limiter.feed("你好世界") == "你好"
+    assert limiter.finish_reason == "length"
+
+
+def test_from_request_prefers_max_completion_tokens():
+    limiter = GenerationLimiter.from_request({"stop": "x", "max_tokens": 100, "max_completion_tokens": 3})
+    assert limiter.stop_sequences == ["x"]
+    assert limiter.max_tokens == 3
+
+
+def test_invalid_limits_are_ignored():
+    limiter = GenerationLimiter(stop=[""], max_tokens=0)
+    assert limiter.matcher is None and limiter.max_tokens is None
+    assert limiter.feed("anything") == "anything"
+    assert limiter.flush() == ""
@@ -0,0 +1,120 @@
+import base64
+import json
+
+import pytest
+
+import app
+from app import GrokApiClient, ImageInput, ImageInputError
+from tests.conftest import FakeResponse, token_lines
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 32
+
+
+def data_url(data=PNG, mime_type="image/png"):
+    return f"data:{mime_type};base64,{base64.b64encode(data).decode()}"
+
+
+def test_data_url_is_parsed_by_offset():
+    image = ImageInput(data_url())
+    assert image.mime_type == "image/png"
+    assert image.size == len(PNG)
+    assert base64.b64decode(bytes(image.payload)) == PNG
+
+
+def test_mime_type_is_sniffed_from_content():
+    image = ImageInput(data_url(b"GIF89a" + b"\x00" * 10, "image/png"))
+    assert image.mime_type == "image/gif"
+
+
+def test_whitespace_in_payload_is_removed():
+    encoded = base64.b64encode(PNG).decode()
+    image = ImageInput("data:image/png;base64," + "\n".join(encoded[i:i + 8] for i in range(0, len(encoded), 8)))
+    assert base64.b64decode(bytes(image.payload)) == PNG
+
+
+def test_upload_body_is_valid_json():
+    body = json.loads(ImageInput(data_url()).build_upload_body())
+    assert body["rpc"] == "uploadFile"
+    assert body["req"]["fileName"] == "image.png"
+    assert base64.b64decode(body["req"]["content"]) == PNG
+
+
+@pytest.mark.parametrize("url", ['data:image/png;base64,abc"}', "data:image/png;base64,abécd"])
+def test_invalid_data_url_payload_is_rejected(url):
+    with pytest.raises(ImageInputError) as error:
+        ImageInput(url)
+    assert error.value.status_code == 400
+
+
+def test_oversized_image_is_rejected(monkeypatch):
+    monkeypatch.setitem(app.CONFIG["IMAGE"], "MAX_SIZE", 16)
+    with pytest.raises(ImageInputError) as error:
+        ImageInput(data_url())
+    assert error.value.status_code == 413
+
+
+def test_remote_image_url_is_skipped(upstream):
+    assert GrokApiClient("grok-3").load_image("https://example.com/cat.png") is None
+    assert upstream.calls == []
+
+
+def test_data_url_is_uploaded_with_given_token(upstream):
+    upstream.handler = lambda url, kwargs: FakeResponse(json_body={"fileMetadataId": "file-1"})
+    image = GrokApiClient("grok-3").load_image(data_url())
+    assert GrokApiClient("grok-3").upload_base64_image(image, "https://upload", "sso-rw=tokA;sso=tokA", None) == "file-1"
+    assert json.loads(upstream.calls[0][1]["data"])["req"]["fileMimeType"] == "image/png"
+    assert upstream.calls[0][1]["headers"]["Cookie"].startswith("sso-rw=tokA;sso=tokA")
+
+
+def image_message(url):
+    return [{"role": "user", "content": [{"type": "text", "text": "look"}, {"type": "image_url", "image_url": {"url": url}}]}]
+
+
+def test_chat_with_remote_image_url_succeeds(client, upstream):
+    response = client.post("/v1/chat/completions", json={"model": "grok-3", "messages": image_message("https://example.com/cat.png")})
+    assert response.status_code == 200
+    assert response.json["choices"][0]["message"]["content"] == "Hello"
+
+
+def test_chat_with_invalid_data_url_returns_400(client, upstream):
+    response = client.post("/v1/chat/completions", json={"model": "grok-3", "messages": image_message('data:image/png;base64,"}')})
+    assert response.status_code == 400
+    assert upstream.chat_calls() == []
+
+
+def image_upstream(upstream, fail_first_chat=False):
+    """上传返回 file-1，对话请求可选第一次返回 401"""
+    chat_failures = [fail_first_chat]
+
+    def handler(url, kwargs):
+        if url.endswith("/api/rpc"):
+            return FakeResponse(json_body={"fileMetadataId": "file-1"})
+        if chat_failures.pop() if chat_failures else False:
+            return FakeResponse(status_code=401, text="unauthorized")
+        return FakeResponse(token_lines("Hel", "lo"))
+    upstream.handler = handler
+
+
+def upload_and_chat_cookies(upstream):
+    return [(url.rsplit("/", 1)[-1], kwargs["headers"]["Cookie"]) for url, kwargs in upstream.calls]
+
+
+def test_image_is_uploaded_with_chat_token(client, upstream):
+    image_upstream(upstream)
+    for _ in range(2):
+        response = client.post("/v1/chat/completions", json={"model": "grok-3", "messages": image_message(data_url())})
+        assert response.status_code == 200
+    calls = upload_and_chat_cookies(upstream)
+    assert [name for name, _ in calls] == ["rpc", "new", "rpc", "new"]
+    assert calls[0][1] == calls[1][1] and calls[2][1] == calls[3][1]
+    assert json.loads(upstream.chat_calls()[0][1]["data"])["fileAttachments"] == ["file-1"]
+
+
+def test_image_is_uploaded_again_after_token_rotation(client, upstream):
+    image_upstream(upstream, fail_first_chat=True)
+    response = client.post("/v1/chat/completions", json={"model": "grok-3", "messages": image_message(data_url())})
+    assert response.status_code == 200
+    calls = upload_and_chat_cookies(upstream)
+    assert [name for name, _ in calls] == ["rpc", "new", "rpc", "new"]
+    assert calls[0][1] != calls[2][1]
+    assert calls[2][1] == calls[3][1]
@@ -0,0 +1,40 @@
+import json
+
+import app
+from tests.conftest import FakeResponse, token_lines
+
+HI = [{"role": "user", "content": "hi"}]
+
+
+def test_fallback_chain_skips_unknown_models(client):
+    app.CONFIG["MODEL_FALLBACK"] = "grok-3-deepersearch>grok-9>grok-3-deepsearch>grok-3-search, grok-4 > grok-4-free"
+    assert app.Utils.get_model_fallback_chain("grok-3-deepersearch") == ["grok-3-deepsearch", "grok-3-search"]
+    assert app.Utils.get_model_fallback_chain("grok-3-deepsearch") == ["grok-3-search"]
+    assert app.Utils.get_model_fallback_chain("grok-4") == ["grok-4-free"]
+    assert app.Utils.get_model_fallback_chain("grok-3") == []
+
+
+def test_model_without_tokens_falls_back_before_request(client, upstream):
+    response = client.post("/v1/chat/completions", json={"model": "grok-4", "messages": HI})
+    assert response.status_code == 200
+    assert response.json["model"] == "grok-4-free"
+    assert json.loads(upstream.chat_calls()[0][1]["data"])["modelName"] == app.CONFIG["MODELS"]["grok-4-free"]
+
+
+def test_model_exhausted_during_retries_falls_back(client, upstream):
+    def handler(url, kwargs):
+        if json.loads(kwargs["data"])["deepsearchPreset"] == "deeper":
+            return FakeResponse(status_code=429, text="rate limited")
+        return FakeResponse(token_lines("Hel", "lo"))
+    upstream.handler = handler
+    response = client.post("/v1/chat/completions", json={"model": "grok-3-deepersearch", "messages": HI})
+    assert response.status_code == 200
+    assert response.json["model"] == "grok-3-deepsearch"
+    assert [json.loads(kwargs["data"])["deepsearchPreset"] for _, kwargs in upstream.chat_calls()] == ["deeper", "deeper", "default"]
+
+
+def test_exhausted_chain_returns_429(client, upstream):
+    app.CONFIG["MODEL_FALLBACK"] = ""
+    response = client.post("/v1/chat/completions", json={"model": "grok-4", "messages": HI})
+    assert response.status_code == 429
+    assert upstream.calls == []
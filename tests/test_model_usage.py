@@ -0,0 +1,118 @@
+import copy
+import threading
+
+TOKENS = [f"sso-rw=tok{index};sso=tok{index}" for index in range(3)]
+PRO_TOKEN = "sso-rw=pro;sso=pro"
+
+
+def assert_consistent(manager):
+    """增量维护的计数应与按令牌映射重新统计的结果一致"""
+    tracked = copy.deepcopy(manager.model_usage)
+    manager.rebuild_model_usage()
+    assert tracked == manager.model_usage
+
+
+def setup_tokens(manager):
+    manager.add_tokens(TOKENS)
+    manager.add_tokens([PRO_TOKEN], pro=True)
+    assert_consistent(manager)
+
+
+def test_requests_are_counted(token_manager):
+    setup_tokens(token_manager)
+    for _ in range(3):
+        token_manager.get_next_token_for_model("grok-3")
+    token_manager.get_next_token_for_model("grok-4")
+    assert token_manager.model_usage["grok-3"] == {"live": 3, "used": 3}
+    assert token_manager.model_usage["grok-4"] == {"live": 1, "used": 1}
+    assert token_manager.get_model_remaining("grok-3") == 3 * 20 - 3
+    assert_consistent(token_manager)
+
+
+def test_remove_and_restore(token_manager):
+    setup_tokens(token_manager)
+    token = token_manager.get_next_token_for_model("grok-3")
+    token_manager.remove_token_for_model("grok-3", token)
+    assert token_manager.model_usage["grok-3"] == {"live": 2, "used": 0}
+    assert_consistent(token_manager)
+
+    token_manager.apply_rate_limits("grok-3", token, {"remainingQueries": 15})
+    assert token_manager.model_usage["grok-3"] == {"live": 3, "used": 5}
+    assert not token_manager.expired_tokens
+    assert_consistent(token_manager)
+
+
+def test_rate_limit_exhaustion_removes_token(token_manager):
+    setup_tokens(token_manager)
+    token_manager.apply_rate_limits("grok-3", TOKENS[1], {"remainingQueries": 0, "waitTimeSeconds": 60})
+    assert token_manager.model_usage["grok-3"]["live"] == 2
+    assert (TOKENS[1], "grok-3") in {item[:2] for item in token_manager.expired_tokens}
+    assert_consistent(token_manager)
+
+
+def test_refund(token_manager):
+    setup_tokens(token_manager)
+    token = token_manager.get_next_token_for_model("grok-3")
+    token_manager.get_next_token_for_model("grok-3")
+    token_manager.reduce_token_request_count("grok-3", 1, token)
+    assert token_manager.model_usage["grok-3"]["used"] == 1
+    # 次数不会退成负数
+    token_manager.reduce_token_request_count("grok-3", 5, token)
+    assert token_manager.model_usage["grok-3"]["used"] == 0
+    assert_consistent(token_manager)
+
+
+def test_pro_token_remove_and_refund(token_manager):
+    setup_tokens(token_manager)
+    token_manager.get_next_token_for_model("grok-4")
+    token_manager.get_next_token_for_model("grok-4")
+    token_manager.reduce_token_request_count("grok-4", 1, PRO_TOKEN)
+    assert token_manager.model_usage["grok-4"] == {"live": 1, "used": 1}
+    token_manager.remove_token_for_model("grok-4", PRO_TOKEN)
+    assert token_manager.model_usage["grok-4"] == {"live": 0, "used": 0}
+    assert_consistent(token_manager)
+
+
+def test_revoked_token_is_not_restorable(token_manager):
+    setup_tokens(token_manager)
+    token_manager.get_next_token_for_model("grok-3")
+    token_manager.revoke_token_for_model("grok-3", TOKENS[0])
+    assert token_manager.model_usage["grok-3"] == {"live": 2, "used": 0}
+    assert not token_manager.expired_tokens
+    status = token_manager.token_status_map["tok0"]["grok-3"]
+    assert status["isValid"] is False and status["invalidatedTime"] is None
+    assert_consistent(token_manager)
+
+
+def test_delete_token(token_manager):
+    setup_tokens(token_manager)
+    token_manager.get_next_token_for_model("grok-3")
+    token_manager.delete_token(TOKENS[0])
+    assert token_manager.model_usage["grok-3"] == {"live": 2, "used": 0}
+    assert_consistent(token_manager)
+
+
+def test_concurrent_charges_and_refunds(token_manager):
+    setup_tokens(token_manager)
+    token_manager.model_config["grok-3"]["RequestFrequency"] = 10 ** 6
+    barrier = threading.Barrier(8)
+
+    def worker():
+        barrier.wait()
+        for _ in range(300):
+            token = token_manager.get_next_token_for_model("grok-3")
+            token_manager.reduce_token_request_count("grok-3", 1, token)
+
+    def churn():
+        barrier.wait()
+        for _ in range(100):
+            token_manager.remove_token_for_model("grok-3", TOKENS[2])
+            token_manager.apply_rate_limits("grok-3", TOKENS[2], {"remainingQueries": 10 ** 6})
+
+    threads = [threading.Thread(target=worker) for _ in range(7)] + [threading.Thread(target=churn)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert token_manager.model_usage["grok-3"] == {"live": 3, "used": 0}
+    assert_consistent(token_manager)
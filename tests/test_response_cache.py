@@ -0,0 +1,95 @@
+import threading
+import time
+
+import pytest
+
+import app
+from app import ResponseCache
+
+HI = [{"role": "user", "content": "hi"}]
+
+
+class Body:
+    def __init__(self, value, cacheable=True):
+        self.value = value
+        self.cacheable = cacheable
+
+
+def test_concurrent_requests_share_one_computation():
+    cache = ResponseCache(10, 60)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return Body("reply")
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(cache.get_or_compute("key", compute)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(cache.get_or_compute("key", compute))) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join(5)
+    assert len(calls) == 1
+    assert [body.value for body in results] == ["reply"] * 4
+    assert cache.get_or_compute("key", lambda: Body("other")).value == "reply"
+
+
+def test_errors_are_shared_but_not_cached():
+    cache = ResponseCache(10, 60)
+
+    def fail():
+        raise ValueError("upstream failed")
+    with pytest.raises(ValueError):
+        cache.get_or_compute("key", fail)
+    assert cache.get_or_compute("key", lambda: Body("reply")).value == "reply"
+
+
+def test_uncacheable_bodies_expired_and_evicted_entries_are_recomputed():
+    cache = ResponseCache(10, 60)
+    cache.get_or_compute("spilled", lambda: Body("first", cacheable=False))
+    assert cache.get_or_compute("spilled", lambda: Body("second")).value == "second"
+
+    cache = ResponseCache(10, 0)
+    cache.get_or_compute("key", lambda: Body("first"))
+    assert cache.get_or_compute("key", lambda: Body("second")).value == "second"
+
+    cache = ResponseCache(1, 60)
+    cache.get_or_compute("a", lambda: Body("a"))
+    cache.get_or_compute("b", lambda: Body("b"))
+    assert cache.get_or_compute("a", lambda: Body("a2")).value == "a2"
+
+
+def test_key_depends_on_model_and_payload():
+    assert ResponseCache.make_key("grok-3", {"messages": HI}) == ResponseCache.make_key("grok-3", {"messages": HI})
+    assert ResponseCache.make_key("grok-3", {"messages": HI}) != ResponseCache.make_key("grok-4", {"messages": HI})
+    assert ResponseCache.make_key("grok-3", {"messages": HI, "n": 1}) != ResponseCache.make_key("grok-3", {"messages": HI, "n": 2})
+
+
+def test_identical_chat_requests_hit_cache(client, upstream):
+    app.CONFIG["RESPONSE_CACHE"]["ENABLED"] = True
+    for _ in range(2):
+        response = client.post("/v1/chat/completions", json={"model": "grok-3", "messages": HI})
+        assert response.json["choices"][0]["message"]["content"] == "Hello"
+    assert len(upstream.chat_calls()) == 1
+
+    # 相同 Idempotency-Key 的请求即使消息不同也返回同一回复
+    for content in ("one", "two"):
+        client.post("/v1/chat/completions", json={"model": "grok-3", "messages": [{"role": "user", "content": content}]},
+                    headers={"Idempotency-Key": "retry-1"})
+    assert len(upstream.chat_calls()) == 2
+
+
+def test_streaming_requests_bypass_cache(client, upstream):
+    app.CONFIG["RESPONSE_CACHE"]["ENABLED"] = True
+    for _ in range(2):
+        client.post("/v1/chat/completions", json={"model": "grok-3", "messages": HI, "stream": True}).get_data()
+    assert len(upstream.chat_calls()) == 2
@@ -0,0 +1,69 @@
+import app
+from app import CircuitBreaker
+from tests.conftest import FakeResponse
+
+HI = [{"role": "user", "content": "hi"}]
+
+
+def breaker(monkeypatch, threshold=2, window=60, open_seconds=30):
+    monkeypatch.setitem(app.CONFIG, "SHIELD_BREAKER", {
+        "ENABLED": True, "THRESHOLD": threshold, "GLOBAL_THRESHOLD": threshold, "WINDOW": window, "OPEN_SECONDS": open_seconds
+    })
+    return CircuitBreaker("test", "THRESHOLD")
+
+
+def test_trips_after_threshold_within_window(monkeypatch):
+    circuit = breaker(monkeypatch)
+    circuit.record_failure(1000)
+    circuit.record_failure(1100)
+    # 第一次失败已超出窗口
+    assert circuit.state == CircuitBreaker.CLOSED
+    circuit.record_failure(1110)
+    assert circuit.state == CircuitBreaker.OPEN
+    assert not circuit.allow(1120)
+    assert circuit.open_count == 1
+
+
+def test_half_open_allows_a_single_probe(monkeypatch):
+    circuit = breaker(monkeypatch)
+    circuit.trip(1000)
+    assert circuit.allow(1030)
+    assert circuit.state == CircuitBreaker.HALF_OPEN
+    assert not circuit.allow(1031)
+    circuit.release()
+    assert circuit.allow(1032)
+    circuit.record_success()
+    assert circuit.state == CircuitBreaker.CLOSED
+    assert circuit.allow(1033)
+
+
+def test_failed_probe_trips_again(monkeypatch):
+    circuit = breaker(monkeypatch)
+    circuit.trip(1000)
+    assert circuit.allow(1030)
+    circuit.record_failure(1031)
+    assert circuit.state == CircuitBreaker.OPEN
+    assert not circuit.allow(1040)
+    assert circuit.open_count == 2
+
+
+def test_stale_probe_is_replaced(monkeypatch):
+    circuit = breaker(monkeypatch)
+    circuit.trip(1000)
+    assert circuit.allow(1030)
+    assert circuit.allow(1061)
+
+
+def test_repeated_shields_fail_fast_without_charging(client, upstream, monkeypatch):
+    breaker(monkeypatch)
+    upstream.handler = lambda url, kwargs: FakeResponse(status_code=403, headers={"content-type": "text/html"}, text="<title>Just a moment...</title>")
+    response = client.post("/v1/chat/completions", json={"model": "grok-3", "messages": HI})
+    assert response.status_code == 503
+    calls = len(upstream.calls)
+    assert calls == 2
+    assert app.shield_breakers.global_open()
+
+    response = client.post("/v1/chat/completions", json={"model": "grok-3", "messages": HI})
+    assert response.status_code == 503
+    assert len(upstream.calls) == calls
+    assert app.token_manager.model_usage["grok-3"]["used"] == 0
@@ -0,0 +1,42 @@
+import app
+
+TOKENS = [f"sso-rw=tok{index};sso=tok{index}" for index in range(3)]
+
+
+def probe_results(monkeypatch, states):
+    probed = []
+
+    def probe(token, model, statsig_id):
+        probed.append((token, model, statsig_id))
+        return states.get((token, model), ("valid", {"remainingQueries": 20}))
+    monkeypatch.setattr(app.Utils, "probe_token", staticmethod(probe))
+    return probed
+
+
+def test_rejected_token_is_revoked_not_expired(token_manager, monkeypatch):
+    token_manager.add_tokens(TOKENS)
+    probe_results(monkeypatch, {(TOKENS[0], "grok-3"): ("invalid", None)})
+    prober = app.TokenHealthProber()
+    prober.probe("grok-3", TOKENS[0], "statsig")
+    assert TOKENS[0] not in [entry["token"] for entry in token_manager.get_token_array_for_model("grok-3")]
+    assert not token_manager.expired_tokens
+    assert token_manager.token_status_map["tok0"]["grok-3"]["invalidatedTime"] is None
+    assert ("grok-3", TOKENS[0]) not in prober.collect_targets()
+
+
+def test_exhausted_token_is_scheduled_for_recovery(token_manager, monkeypatch):
+    token_manager.add_tokens(TOKENS)
+    probe_results(monkeypatch, {(TOKENS[1], "grok-3"): ("valid", {"remainingQueries": 0, "waitTimeSeconds": 60})})
+    prober = app.TokenHealthProber()
+    prober.probe("grok-3", TOKENS[1], "statsig")
+    assert (TOKENS[1], "grok-3") in {item[:2] for item in token_manager.expired_tokens}
+    assert ("grok-3", TOKENS[1]) in prober.collect_targets()
+
+
+def test_readded_revoked_token_is_valid_again(token_manager):
+    token_manager.add_tokens(TOKENS)
+    token_manager.revoke_token_for_model("grok-3", TOKENS[0])
+    assert token_manager.token_status_map["tok0"]["grok-3"]["isValid"] is False
+    token_manager.add_tokens([TOKENS[0]])
+    assert token_manager.token_status_map["tok0"]["grok-3"] == {"isValid": True, "invalidatedTime": None, "totalRequestCount": 0}
+    assert token_manager.model_usage["grok-3"]["live"] == 3
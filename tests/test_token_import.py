@@ -0,0 +1,79 @@
+import itertools
+import threading
+
+import app
+
+STATES = {"good": "valid", "bad": "invalid", "maybe": "unknown"}
+
+
+def fake_probe(probed):
+    lock = threading.Lock()
+
+    def probe(token, model, statsig_id):
+        sso = token.split("sso=")[1]
+        with lock:
+            probed.append((sso, model, statsig_id))
+        return STATES[sso.rstrip("0123456789")], None
+    return probe
+
+
+def setup_probe(monkeypatch):
+    probed = []
+    counter = itertools.count()
+    monkeypatch.setattr(app.Utils, "probe_token", staticmethod(fake_probe(probed)))
+    monkeypatch.setattr(app.statsig_pool, "get", lambda: f"statsig-{next(counter)}")
+    return probed
+
+
+def test_import_probes_and_filters_tokens(token_manager, monkeypatch):
+    probed = setup_probe(monkeypatch)
+    token_manager.add_tokens(["sso-rw=good0;sso=good0"])
+    result = app.import_tokens({"sso": "good0, good1\ngood1,bad1,maybe1,,good2"})
+    assert result == {
+        "received": 6,
+        "duplicates": 1,
+        "existing": 1,
+        "invalid": ["bad1"],
+        "unverified": ["maybe1"],
+        "added": 3
+    }
+    assert sorted(sso for sso, _, _ in probed) == ["bad1", "good1", "good2", "maybe1"]
+    assert token_manager.model_usage["grok-3"]["live"] == 4
+
+
+def test_each_probe_gets_its_own_statsig_id(token_manager, monkeypatch):
+    probed = setup_probe(monkeypatch)
+    app.import_tokens({"sso": [f"good{index}" for index in range(20)]})
+    statsig_ids = [statsig_id for _, _, statsig_id in probed]
+    assert len(statsig_ids) == 20
+    assert len(set(statsig_ids)) == 20
+
+
+def test_strict_import_skips_unverified_tokens(token_manager, monkeypatch):
+    setup_probe(monkeypatch)
+    result = app.import_tokens({"sso": ["good1", "maybe1"], "strict": True})
+    assert result["added"] == 1
+    assert result["unverified"] == ["maybe1"]
+
+
+def test_import_without_validation_adds_everything(token_manager, monkeypatch):
+    probed = setup_probe(monkeypatch)
+    result = app.import_tokens({"sso": ["bad1", "good1"], "validate": False})
+    assert result["added"] == 2
+    assert probed == []
+
+
+def test_pro_tokens_are_probed_for_grok_4(token_manager, monkeypatch):
+    probed = setup_probe(monkeypatch)
+    result = app.import_tokens({"sso": ["good1"], "pro": True})
+    assert result["added"] == 1
+    assert probed[0][1] == "grok-4"
+    assert token_manager.model_usage["grok-4"]["live"] == 1
+
+
+def test_import_endpoint_requires_api_key(client, monkeypatch):
+    setup_probe(monkeypatch)
+    assert client.post("/import/tokens", json={"sso": ["good1"]}, headers={"Authorization": "Bearer wrong"}).status_code == 401
+    response = client.post("/import/tokens", json={"sso": ["good1"]})
+    assert response.status_code == 200
+    assert response.json["added"] == 1
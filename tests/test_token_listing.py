@@ -0,0 +1,60 @@
+import pytest
+
+import app
+
+TOKENS = [f"sso-rw=tok{index:02d};sso=tok{index:02d}" for index in range(25)]
+
+
+@pytest.fixture
+def manager_client(client):
+    with client.session_transaction() as session:
+        session["is_logged_in"] = True
+    return client
+
+
+def test_pages_cover_all_tokens_once(token_manager):
+    token_manager.add_tokens(TOKENS)
+    seen = []
+    for page in (1, 2, 3):
+        result = token_manager.query_token_status(page=page, page_size=10)
+        assert (result["total"], result["totalPages"]) == (25, 3)
+        seen += [item["sso"] for item in result["items"]]
+    assert seen == [f"tok{index:02d}" for index in range(25)]
+    # 超出范围的页码落在最后一页
+    assert token_manager.query_token_status(page=9, page_size=10)["page"] == 3
+
+
+def test_search_sort_and_status_filters(token_manager):
+    token_manager.add_tokens(TOKENS)
+    assert [item["sso"] for item in token_manager.query_token_status(search="TOK1")["items"]] == [f"tok{index}" for index in range(10, 20)]
+    assert token_manager.query_token_status(sort="-token")["items"][0]["sso"] == "tok24"
+
+    token_manager.get_next_token_for_model("grok-3")
+    assert token_manager.query_token_status(sort="-requests")["items"][0]["sso"] == "tok00"
+    token_manager.revoke_token_for_model("grok-3", TOKENS[0])
+    expired = token_manager.query_token_status(status="expired", model="grok-3")
+    assert [item["sso"] for item in expired["items"]] == ["tok00"]
+    assert token_manager.query_token_status(status="active", model="grok-3")["total"] == 24
+
+
+def test_etag_is_stable_until_status_changes(manager_client):
+    first = manager_client.get("/manager/api/get?page=1&page_size=1")
+    assert first.status_code == 200
+    assert first.json["pageSize"] == 1 and first.json["totalPages"] == 2
+    etag = first.headers["ETag"]
+
+    assert manager_client.get("/manager/api/get?page=1&page_size=1", headers={"If-None-Match": etag}).status_code == 304
+    # 不同的查询参数是不同的资源
+    assert manager_client.get("/manager/api/get?page=2&page_size=1", headers={"If-None-Match": etag}).status_code == 200
+
+    app.token_manager.add_token("sso-rw=tokC;sso=tokC")
+    changed = manager_client.get("/manager/api/get?page=1&page_size=1", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert changed.json["totalPages"] == 3
+
+
+def test_without_page_returns_full_map(manager_client):
+    result = manager_client.get("/manager/api/get").json
+    assert set(result["tokens"]) == {"tokA", "tokB"}
+    assert "dailyUsage" in result
@@ -0,0 +1,68 @@
+import pytest
+from curl_cffi import requests as curl_requests
+
+from app import UpstreamErrorClassifier, UpstreamResponseError
+
+
+@pytest.fixture
+def classifier():
+    return UpstreamErrorClassifier()
+
+
+@pytest.mark.parametrize("status_code, content_type, body, expected", [
+    (403, "text/html; charset=UTF-8", "", "shield"),
+    (403, "application/json", "<title>Just a moment...</title>", "shield"),
+    (403, "application/json", '{"error": "forbidden"}', "unauthorized"),
+    (401, "application/json", "", "unauthorized"),
+    (429, "application/json", "", "rate_limited"),
+    (502, "", "", "upstream_unavailable"),
+    (503, "", "", "upstream_unavailable"),
+    (504, "", "", "upstream_unavailable"),
+    (400, "", "", "bad_request"),
+    (404, "", "", "bad_request"),
+    (413, "", "", "bad_request"),
+    (422, "", "", "bad_request"),
+    (500, "", "", "upstream_error"),
+])
+def test_classify_response(classifier, status_code, content_type, body, expected):
+    assert classifier.classify_response(status_code, content_type, body) == expected
+
+
+@pytest.mark.parametrize("error, proxy, expected", [
+    (curl_requests.exceptions.ProxyError("proxy refused"), None, "proxy"),
+    (curl_requests.exceptions.CurlError("connect", 7), "http://proxy", "proxy"),
+    (curl_requests.exceptions.CurlError("connect", 7), None, "network"),
+    (curl_requests.exceptions.CurlError("timeout", 28), None, "timeout"),
+    (curl_requests.exceptions.CurlError("ssl", 35), None, "tls"),
+    (curl_requests.exceptions.CurlError("bad url", 3), None, "config"),
+    (curl_requests.exceptions.CurlError("unknown", 999), None, "network"),
+    (TimeoutError(), None, "timeout"),
+    (ConnectionError(), None, "network"),
+    (UpstreamResponseError("status 429", 429, "rate_limited"), None, "rate_limited"),
+    (ValueError("bug"), None, "internal"),
+])
+def test_classify_exception(classifier, error, proxy, expected):
+    assert classifier.classify_exception(error, proxy) == expected
+
+
+def test_every_class_maps_to_a_known_action(classifier):
+    actions = {
+        UpstreamErrorClassifier.RETRY_SAME_TOKEN,
+        UpstreamErrorClassifier.ROTATE_PROXY,
+        UpstreamErrorClassifier.ROTATE_TOKEN,
+        UpstreamErrorClassifier.FAIL_FAST
+    }
+    for error_class in UpstreamErrorClassifier.CLASSES:
+        action, refund = classifier.record(error_class)
+        assert action in actions
+        assert isinstance(refund, bool)
+    assert set(UpstreamErrorClassifier.CURL_CODE_CLASSES.values()) <= set(UpstreamErrorClassifier.CLASSES)
+
+
+def test_record_counts_and_reports_actions(classifier):
+    assert classifier.record("rate_limited") == (UpstreamErrorClassifier.ROTATE_TOKEN, True)
+    assert classifier.record("unauthorized") == (UpstreamErrorClassifier.ROTATE_TOKEN, False)
+    classifier.record("rate_limited")
+    status = classifier.get_status()
+    assert status["rate_limited"] == {"count": 2, "action": UpstreamErrorClassifier.ROTATE_TOKEN, "refund": True}
+    assert status["shield"]["count"] == 0
@@ -0,0 +1,82 @@
+import json
+import queue
+import time
+
+import pytest
+
+import app
+from app import UpstreamLineReader, UpstreamTimeoutError, Utils
+from tests.conftest import FakeResponse
+
+TIMEOUTS = {"CONNECT": 1, "FIRST_LINE": 0.05, "IDLE": 0.05, "TOTAL": 1}
+
+
+class QueueResponse(FakeResponse):
+    """与 curl_cffi 流式响应一样通过 queue 提供数据块，None 表示传输结束"""
+    def __init__(self, chunks=(), finished=True):
+        super().__init__()
+        self.queue = queue.Queue()
+        for chunk in chunks:
+            self.queue.put(chunk)
+        if finished:
+            self.queue.put(None)
+
+
+def wait_closed(response):
+    deadline = time.monotonic() + 1
+    while not response.closed and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return response.closed
+
+
+def test_model_overrides_replace_default_phases(monkeypatch):
+    monkeypatch.setitem(app.CONFIG, "UPSTREAM_TIMEOUT", {**app.CONFIG["UPSTREAM_TIMEOUT"], "MODELS": "grok-3=5//50, grok-4=1/2/3"})
+    timeouts = Utils.get_upstream_timeouts("grok-3")
+    assert (timeouts["FIRST_LINE"], timeouts["IDLE"], timeouts["TOTAL"]) == (5, app.CONFIG["UPSTREAM_TIMEOUT"]["IDLE"], 50)
+    assert Utils.get_upstream_timeouts("grok-4")["TOTAL"] == 3
+    assert Utils.get_upstream_timeouts("grok-2")["FIRST_LINE"] == app.CONFIG["UPSTREAM_TIMEOUT"]["FIRST_LINE"]
+
+
+def test_lines_split_across_chunks_are_joined():
+    response = QueueResponse([b'{"a":', b'1}\n{"b"', b':2}\n\n{"c":3}'])
+    assert list(UpstreamLineReader(response, TIMEOUTS).prime()) == [b'{"a":1}', b'{"b":2}', b'{"c":3}']
+    assert response.closed
+
+
+def test_first_line_timeout_closes_connection():
+    response = QueueResponse(finished=False)
+    with pytest.raises(UpstreamTimeoutError, match="FIRST_LINE"):
+        UpstreamLineReader(response, TIMEOUTS).prime()
+    assert wait_closed(response)
+
+
+def test_idle_timeout_after_first_line():
+    response = QueueResponse([b"first\n"], finished=False)
+    lines = iter(UpstreamLineReader(response, TIMEOUTS).prime())
+    assert next(lines) == b"first"
+    with pytest.raises(UpstreamTimeoutError, match="IDLE"):
+        next(lines)
+    assert wait_closed(response)
+
+
+def test_total_deadline_caps_idle_wait():
+    response = QueueResponse([b"first\n"], finished=False)
+    reader = UpstreamLineReader(response, {**TIMEOUTS, "IDLE": 5, "TOTAL": 0.1}).prime()
+    lines = iter(reader)
+    next(lines)
+    started = time.monotonic()
+    with pytest.raises(UpstreamTimeoutError, match="TOTAL"):
+        next(lines)
+    assert time.monotonic() - started < 1
+
+
+def test_first_line_timeout_is_retried_with_same_token(client, upstream, monkeypatch):
+    monkeypatch.setattr(Utils, "get_upstream_timeouts", staticmethod(lambda model, config=None: TIMEOUTS))
+    responses = [QueueResponse(finished=False), QueueResponse([json.dumps({"result": {"response": {"token": "Hello"}}}).encode() + b"\n"])]
+    upstream.handler = lambda url, kwargs: responses.pop(0)
+    response = client.post("/v1/chat/completions", json={"model": "grok-3", "messages": [{"role": "user", "content": "hi"}]})
+    assert response.status_code == 200
+    assert response.json["choices"][0]["message"]["content"] == "Hello"
+    cookies = [kwargs["headers"]["Cookie"] for _, kwargs in upstream.chat_calls()]
+    assert len(cookies) == 2 and cookies[0] == cookies[1]
+    assert app.upstream_errors.counters["timeout"] == 1